@@ -14,7 +14,35 @@
 """
 from __future__ import division
 import argparse
-from functools import total_ordering
+import hashlib
+import marshal
+import mmap
+import multiprocessing
+import os
+import re
+import struct
+import sys
+import tempfile
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple, OrderedDict
+from functools import partial, total_ordering
+from itertools import islice
+from math import log
+from timeit import default_timer
+
+try:
+    import numpy
+except ImportError:  # NumPy is optional, only required by vectorized evaluation
+    numpy = None
+
+_python_compile = compile  # builtin, shadowed by calc.compile()
+
+try:
+    _INTEGER_TYPES = (int, long)
+except NameError:  # Python 3
+    _INTEGER_TYPES = (int,)
 
 __author__ = "Matthieu Grandrie"
 __copyright__ = "Copyright 2019, Matthieu Grandrie"
@@ -34,6 +62,12 @@ class OperatorBase(object):
     Operators hierarchy base class
     """
 
+    __slots__ = ('token', 'precedence', 'operands', 'associativy')
+
+    # Python source of the operation, with %s placeholders for operands, used by code generation. Operators without
+    # template, or overriding do_eval without a template of their own, are generated as calls to do_eval.
+    template = None
+
     def __init__(self, token, precedence, operands=2, associativity='left'):
         """
         Constructor
@@ -70,7 +104,7 @@ class OperatorBase(object):
         return self.do_eval(*args)
 
     # Ordering of operators as defined here http://www.engr.mun.ca/~theo/Misc/exp_parsing.htm
-    # This ordering is used by the Shunting Yard algorithm
+    # Evaluators rather compare the integer binding powers of operators, see _operator_code()
     # __eq__, __ne__ and __lt__ are the 3 required methods for custom ordering definition to be compatible with Python 2
     # and Python 3
     def __eq__(self, other):
@@ -106,6 +140,9 @@ class OperatorBase(object):
 class Plus(OperatorBase):
     """Addition"""
 
+    __slots__ = ()
+    template = '%s + %s'
+
     def __init__(self):
         super(Plus, self).__init__('+', 3)
 
@@ -116,6 +153,9 @@ class Plus(OperatorBase):
 class Minus(OperatorBase):
     """Subtraction"""
 
+    __slots__ = ()
+    template = '%s - %s'
+
     def __init__(self):
         super(Minus, self).__init__('-', 3)
 
@@ -126,6 +166,9 @@ class Minus(OperatorBase):
 class Multiply(OperatorBase):
     """Multiplication"""
 
+    __slots__ = ()
+    template = '%s * %s'
+
     def __init__(self):
         super(Multiply, self).__init__('*', 5)
 
@@ -136,6 +179,9 @@ class Multiply(OperatorBase):
 class Divide(OperatorBase):
     """Division"""
 
+    __slots__ = ()
+    template = '%s / %s'
+
     def __init__(self):
         super(Divide, self).__init__('/', 5)
 
@@ -146,6 +192,9 @@ class Divide(OperatorBase):
 class Pow(OperatorBase):
     """Power elevation"""
 
+    __slots__ = ()
+    template = '%s ** %s'
+
     def __init__(self):
         super(Pow, self).__init__('^', 6, associativity='right')
 
@@ -156,6 +205,9 @@ class Pow(OperatorBase):
 class UnaryMinus(OperatorBase):
     """Minus sign, unary operator"""
 
+    __slots__ = ()
+    template = '%s * (-1)'
+
     def __init__(self):
         super(UnaryMinus, self).__init__('-', 4, operands=1)
 
@@ -180,6 +232,61 @@ VALID_TOKENS_SET = {op.token for op in OPERATORS}
 VALID_TOKENS_SET.add('(')
 VALID_TOKENS_SET.add(')')
 
+# Operators by integer opcode, with precomputed binding powers, see _operator_code(). Codes 0 to 2 are not operators:
+# they are the instructions of compact programs pushing values, and code 0 is also the sentinel of the operators stack
+# of the shunting yard algorithm, which binds nothing.
+_OPERATORS_BY_CODE = [None, None, None]
+_LBP = [-1, -1, -1]  # left binding powers: how tightly a binary operator binds its left operand
+_RBP = [-1, -1, -1]  # right binding powers: how tightly an operator binds its right, or only, operand
+_OPERATOR_CODES = {}  # codes by operator id, of the operators of _OPERATORS_BY_CODE
+_OPERATOR_KEYS = {}  # codes by class, token, number of operands, precedence and associativity of operators
+_OPERATOR_CODES_LOCK = threading.Lock()
+_SENTINEL = 0
+# Left binding power of unary operators: they have no left operand, pushing one on the operators stack pops nothing
+_PREFIX_LBP = sys.maxsize
+
+
+def _operator_code(operator):
+    """
+    Opcode of an operator, assigned on first use along with its binding powers.
+
+    Binding powers are derived from precedence and associativity, so that evaluators compare plain integers: an
+    operator binds its left operand with 2 * precedence, its right operand with 2 * precedence + 1 if it is left
+    associative, 2 * precedence otherwise. Opcodes are never reused, compiled programs remain valid whatever happens
+    to the registry. Operators of the same class, token, number of operands, precedence and associativity are taken as
+    equivalent and share their code, so that registering again the same operator does not use up codes.
+    :param operator: operator instance
+    :return: integer opcode
+    """
+    code = _OPERATOR_CODES.get(id(operator))
+    if code is not None and _OPERATORS_BY_CODE[code] is operator:
+        return code
+    key = (type(operator), operator.token, operator.operands, operator.precedence, operator.is_left_assoc())
+    code = _OPERATOR_KEYS.get(key)
+    if code is None:
+        with _OPERATOR_CODES_LOCK:
+            code = _OPERATOR_KEYS.get(key)
+            if code is None:
+                code = len(_OPERATORS_BY_CODE)
+                if code > 255:
+                    raise ValueError("Too many operators, opcodes are bytes")
+                binding_power = 2 * operator.precedence
+                if operator.is_unary():
+                    _LBP.append(_PREFIX_LBP)
+                    _RBP.append(binding_power)
+                else:
+                    _LBP.append(binding_power)
+                    _RBP.append(binding_power + 1 if operator.is_left_assoc() else binding_power)
+                _OPERATORS_BY_CODE.append(operator)
+                _OPERATOR_CODES[id(operator)] = code
+                _OPERATOR_KEYS[key] = code
+    return code
+
+
+# Opcodes of operators tokens
+BINARY_CODES = dict((token, _operator_code(op)) for token, op in BINARY_OPS.items())
+UNARY_CODES = dict((token, _operator_code(op)) for token, op in UNARY_OPS.items())
+
 
 class InvalidTokenError(Exception):
     """Exception raised in case of bad input"""
@@ -191,6 +298,21 @@ class MalformedExpressionError(Exception):
     pass
 
 
+class UndefinedVariableError(InvalidTokenError):
+    """Exception raised when a variable of the expression has no value"""
+    pass
+
+
+class LimitExceededError(Exception):
+    """Exception raised when an expression exceeds Limits"""
+    pass
+
+
+class CircularReferenceError(Exception):
+    """Exception raised when formulas of a Sheet would depend on themselves"""
+    pass
+
+
 def remove_quotes(expr):
     """If single or double quotes in expression, remove them"""
     return expr.replace('\'', '').replace('\"', '')
@@ -249,6 +371,534 @@ def validate_token(token):
     raise InvalidTokenError(token)
 
 
+##################################
+###           SCANNER          ###
+##################################
+
+# Typed token emitted by scan(). kind is the operator or parenthesis symbol, NUMBER for numbers whose value is
+# already cast, or NAME for variables whose value is their name. offset is the position of the token in the scanned
+# string.
+Token = namedtuple('Token', ['kind', 'value', 'offset'])
+NUMBER = 'number'
+NAME = 'name'
+LEAF_KINDS = frozenset([NUMBER, NAME])
+
+
+def _scanner_re(delimiters):
+    """
+    A token is either a delimiter or a word: a run of characters up to the next delimiter or blank. Usual notations of
+    numbers are recognized right away by dedicated groups. Longer delimiters are tried first, e.g. // before /.
+    :param delimiters: tokens of operators and parenthesis
+    :return: compiled regular expression of scan()
+    """
+    chars = re.escape(''.join(sorted(set(''.join(delimiters)))))
+    longer = sorted((token for token in delimiters if len(token) > 1), key=lambda token: (-len(token), token))
+    single = re.escape(''.join(sorted(token for token in delimiters if len(token) == 1)))
+    symbols = '|'.join([re.escape(token) for token in longer] + ['[%s]' % single])
+    return re.compile(r'({s})|([0-9]+)(?=[{d}\s]|$)|((?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][0-9]+)?)(?=[{d}\s]|$)'
+                      r'|([A-Za-z_][A-Za-z0-9_]*)(?=[{d}\s]|$)|([^{d}\s]+|\S)'.format(s=symbols, d=chars))
+
+
+def _literal_re(delimiters):
+    """
+    Numbers literals of template() are the words of scan() matched by its int or float groups: they follow the start of
+    the expression, a delimiter or a blank.
+    :param delimiters: tokens of operators and parenthesis
+    :return: compiled regular expression of int and float literals, one group for each
+    """
+    chars = re.escape(''.join(sorted(set(''.join(delimiters)))))
+    return re.compile(r'(?:^|(?<=[{d}\s]))(?:([0-9]+)|((?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][0-9]+)?))(?=[{d}\s]|$)'
+                      .format(d=chars))
+
+
+_SCAN_RE = _scanner_re(VALID_TOKENS_SET)
+_LITERAL_RE = _literal_re(VALID_TOKENS_SET)
+_SYMBOL, _INT, _FLOAT, _NAME, _WORD = 1, 2, 3, 4, 5
+_DIGITS_RE = re.compile(r'[0-9]+$')
+# names float() understands, they remain numbers rather than variables
+_FLOAT_NAMES = frozenset(['inf', 'infinity', 'nan'])
+
+
+# Longest strings of digits int() converts on all Pythons, 3.11+ refuses more than 4300 digits
+_INT_DIGITS = 4000
+
+
+def _int(digits):
+    """
+    Cast a string of decimal digits of any length to an int, long ones by halves multiplied together
+    :param digits: string of ASCII digits
+    :return: int
+    """
+    if len(digits) <= _INT_DIGITS:
+        return int(digits)
+    half = len(digits) // 2
+    return _int(digits[:-half]) * 10 ** half + _int(digits[-half:])
+
+
+def _number(word):
+    """
+    Cast a word to a number
+    :param word: non blank string
+    :return: int or float, None if word is not a number
+    """
+    if len(word) > _INT_DIGITS and _DIGITS_RE.match(word):
+        return _int(word)
+    try:
+        return int(word)
+    except ValueError:
+        try:
+            return float(word)
+        except ValueError:
+            return None
+
+
+def scan(expr):
+    """
+    Build the list of typed tokens of an expression in a single pass.
+
+    It does the job of remove_quotes(), tokenize() and validate_token() at once, and casts numbers so that evaluators
+    don't have to. Usual notations of numbers are cast without raising any exception. Identifiers are variables.
+    :param expr: Expression to scan, e.g. "5 + 1.5"
+    :return: a list of Token, e.g. [Token(NUMBER, 5, 0), Token('+', None, 2), Token(NUMBER, 1.5, 4)]
+    :raise: InvalidTokenError if a token is neither a number, a variable nor a delimiter
+    """
+    tokens = []
+    append = tokens.append
+    new = tuple.__new__  # builds Token instances faster than Token.__new__
+    for match in _SCAN_RE.finditer(expr):
+        group = match.lastindex
+        if group == _SYMBOL:
+            append(new(Token, (match.group(), None, match.start())))
+        elif group == _INT:
+            append(new(Token, (NUMBER, _int(match.group()), match.start())))
+        elif group == _FLOAT:
+            append(new(Token, (NUMBER, float(match.group()), match.start())))
+        elif group == _NAME and match.group().lower() not in _FLOAT_NAMES:
+            append(new(Token, (NAME, match.group(), match.start())))
+        else:
+            value = _word_value(match.group())
+            if value is not None:
+                append(new(Token, (NUMBER, value, match.start())))
+    return tokens
+
+
+def _word_value(word):
+    """
+    Cast a word of unusual notation, such as "inf" or "1_000", to a number
+    :param word: word matched by the last group of the scanner
+    :return: int or float, None if the word is only quotes
+    :raise: InvalidTokenError if the word is not a number
+    """
+    if '\'' in word or '"' in word:
+        word = remove_quotes(word)
+        if not word:
+            return None
+    value = _number(word)
+    if value is None:
+        raise InvalidTokenError(word)
+    return value
+
+
+def _stream_matches(stream, chunk_size):
+    """
+    Scanner matches of a text read by chunks. The last match of a chunk may be the start of a longer token, it is
+    matched again with the next chunk
+    :return: generator of (match, offset of the matched string in the stream)
+    """
+    base = 0
+    buffer = ''
+    while True:
+        chunk = stream.read(chunk_size)
+        buffer += chunk
+        pending = None
+        for match in _SCAN_RE.finditer(buffer):
+            if pending is not None:
+                yield pending, base
+            pending = match
+        if not chunk:
+            if pending is not None:
+                yield pending, base
+            return
+        start = len(buffer) if pending is None else pending.start()
+        base += start
+        buffer = buffer[start:]
+
+
+def iscan(source, chunk_size=1 << 16):
+    """
+    Lazy variant of scan(): generate the typed tokens of an expression one at a time, without building their list
+    :param source: expression string, or text file object read by chunks, so that it is never read whole
+    :param chunk_size: number of characters read at once from a file object
+    :return: generator of Token, offsets are counted from the start of source
+    :raise: InvalidTokenError if a token is neither a number, a variable nor a delimiter, when it is reached
+    """
+    if hasattr(source, 'read'):
+        matches = _stream_matches(source, chunk_size)
+    else:
+        matches = ((match, 0) for match in _SCAN_RE.finditer(source))
+    for match, base in matches:
+        token = _match_token(match, base + match.start())
+        if token is not None:
+            yield token
+
+
+def _match_token(match, offset):
+    """
+    :param match: match of the scanner regular expression
+    :param offset: offset of the Token
+    :return: Token of the match, None if the word is only quotes
+    :raise: InvalidTokenError if the word is not a number
+    """
+    group = match.lastindex
+    if group == _SYMBOL:
+        return Token(match.group(), None, offset)
+    elif group == _INT:
+        return Token(NUMBER, _int(match.group()), offset)
+    elif group == _FLOAT:
+        return Token(NUMBER, float(match.group()), offset)
+    elif group == _NAME and match.group().lower() not in _FLOAT_NAMES:
+        return Token(NAME, match.group(), offset)
+    value = _word_value(match.group())
+    return Token(NUMBER, value, offset) if value is not None else None
+
+
+# Kind codes of CompactTokens: numbers and names, then delimiters
+_KIND_INT = 0  # int exactly held by a double
+_KIND_FLOAT = 1
+_KIND_OTHER = 2  # other number, held by the side table
+_KIND_NAME = 3  # name held by the side table
+_KINDS = [NUMBER, NUMBER, NUMBER, NAME] + sorted(VALID_TOKENS_SET)
+_KIND_CODES = dict((kind, code) for code, kind in enumerate(_KINDS) if code > _KIND_NAME)
+_MAX_EXACT_INT = 2 ** 53
+# Typecode of 64 bits offsets, for inputs beyond 2 GB: 'q' is Python 3.3+, 'l' is 64 bits on 64 bits POSIX systems
+try:
+    _OFFSET_TYPECODE = array('q').typecode
+except ValueError:
+    _OFFSET_TYPECODE = 'l'
+
+
+class CompactTokens(object):
+    """
+    Memory efficient sequence of Token, for very large expressions.
+
+    Tokens are stored in arrays: one byte for the kind, a double for the value and a 64 bits int for the offset. Names
+    and numbers a double cannot hold exactly are kept in a side table. Evaluators accept it in place of a list of Token:
+    Token instances are built on access, which is slower but keeps about 17 bytes per token instead of 80 to 100.
+
+    :Example:
+    >>> tokens = CompactTokens(scan("5 + x"))
+    >>> tokens[2]
+    Token(kind='name', value='x', offset=4)
+    """
+
+    __slots__ = ('_kinds', '_values', '_offsets', '_others')
+
+    def __init__(self, tokens=()):
+        """
+        Constructor
+        :param tokens: iterable of Token
+        """
+        kinds = self._kinds = array('B')
+        values = self._values = array('d')
+        offsets = self._offsets = array(_OFFSET_TYPECODE)
+        others = self._others = {}
+        for kind, value, offset in tokens:
+            if kind == NUMBER:
+                if type(value) is float:
+                    kinds.append(_KIND_FLOAT)
+                    values.append(value)
+                elif type(value) is int and -_MAX_EXACT_INT <= value <= _MAX_EXACT_INT:
+                    kinds.append(_KIND_INT)
+                    values.append(value)
+                else:
+                    others[len(kinds)] = value
+                    kinds.append(_KIND_OTHER)
+                    values.append(0.)
+            elif kind == NAME:
+                others[len(kinds)] = value
+                kinds.append(_KIND_NAME)
+                values.append(0.)
+            else:
+                kinds.append(_KIND_CODES[kind])
+                values.append(0.)
+            offsets.append(-1 if offset is None else offset)
+
+    def __len__(self):
+        return len(self._kinds)
+
+    def __getitem__(self, index):
+        code = self._kinds[index]
+        if code == _KIND_INT:
+            value = int(self._values[index])
+        elif code == _KIND_FLOAT:
+            value = self._values[index]
+        elif code <= _KIND_NAME:
+            value = self._others[index if index >= 0 else index + len(self._kinds)]
+        else:
+            value = None
+        offset = self._offsets[index]
+        return tuple.__new__(Token, (_KINDS[code], value, None if offset < 0 else offset))
+
+    def __iter__(self):
+        for index in range(len(self._kinds)):
+            yield self[index]
+
+
+##################################
+###      OPERATOR REGISTRY     ###
+##################################
+
+_REGISTRY_LOCK = threading.Lock()
+# characters a token cannot contain, they would be ambiguous with numbers, names and quotes
+_RESERVED_CHARS = re.compile(r'[\w\s.\'"()]', re.UNICODE)
+
+
+def _update_delimiters():
+    """Update the tokens set and the scanner after a change of operators"""
+    global _SCAN_RE, _LITERAL_RE
+    VALID_TOKENS_SET.clear()
+    VALID_TOKENS_SET.update(BINARY_OPS)
+    VALID_TOKENS_SET.update(UNARY_OPS)
+    VALID_TOKENS_SET.update('()')
+    for token in VALID_TOKENS_SET:
+        if token not in _KIND_CODES:
+            _KIND_CODES[token] = len(_KINDS)
+            _KINDS.append(token)
+    _SCAN_RE = _scanner_re(VALID_TOKENS_SET)
+    _LITERAL_RE = _literal_re(VALID_TOKENS_SET)
+
+
+def register_operator(operator):
+    """
+    Make an operator available to all evaluators, or replace the operator of the same token and number of operands.
+
+    Registration is global to the process, and meant to happen before evaluations. Compiled expressions keep the
+    operators they were compiled with.
+    :param operator: OperatorBase instance. Its token may have several characters, but no letter, digit, blank, dot, \
+    quote or parenthesis
+    :raise: ValueError if the token is invalid
+
+    :Example:
+    >>> class Modulo(OperatorBase):
+    ...     def __init__(self):
+    ...         super(Modulo, self).__init__('%', 5)
+    ...     def do_eval(self, *args):
+    ...         return args[0] % args[1]
+    >>> register_operator(Modulo())
+    >>> calc("7 % 4")
+    3
+    """
+    if not operator.token or _RESERVED_CHARS.search(operator.token):
+        raise ValueError("Invalid operator token %r" % operator.token)
+    with _REGISTRY_LOCK:
+        code = _operator_code(operator)
+        if operator.is_unary():
+            UNARY_OPS[operator.token] = operator
+            UNARY_CODES[operator.token] = code
+        else:
+            BINARY_OPS[operator.token] = operator
+            BINARY_CODES[operator.token] = code
+        OPERATORS[:] = [op for op in OPERATORS if op.token != operator.token or op.operands != operator.operands]
+        OPERATORS.append(operator)
+        _update_delimiters()
+
+
+def unregister_operator(token, operands=2):
+    """
+    Remove an operator from expressions
+    :param token: token of the operator
+    :param operands: 2 for a binary operator, 1 for an unary one
+    :return: the removed operator
+    :raise: KeyError if there is no such operator
+    """
+    with _REGISTRY_LOCK:
+        if operands == 1:
+            operator = UNARY_OPS.pop(token)
+            del UNARY_CODES[token]
+        else:
+            operator = BINARY_OPS.pop(token)
+            del BINARY_CODES[token]
+        OPERATORS[:] = [op for op in OPERATORS if op is not operator]  # not remove(): operators == compares precedence
+        _update_delimiters()
+    return operator
+
+
+##################################
+###         VALIDATION         ###
+##################################
+
+Diagnostic = namedtuple('Diagnostic', ['offset', 'kind', 'message'])
+# Diagnostic kinds
+INVALID_TOKEN = 'invalid token'
+UNEXPECTED_TOKEN = 'unexpected token'
+UNEXPECTED_END = 'unexpected end'
+UNBALANCED_PARENTHESIS = 'unbalanced parenthesis'
+
+
+def check(expr):
+    """
+    Check the syntax of an expression without evaluating it nor raising any exception.
+
+    The grammar of the evaluators is checked in a single pass over the scanner matches, with the state of expecting an
+    operand or an operator and the offsets of open parenthesis. An expression passing check() only fails evaluation on
+    arithmetic errors, undefined variables or limits.
+    :param expr: Expression to check
+    :return: None if the expression is valid, the Diagnostic of its first error otherwise, e.g.
+    Diagnostic(offset=4, kind='unexpected end', message='expected an operand, got the end of the expression')
+    """
+    operand_expected = True
+    parenthesis = []  # offsets of open parenthesis
+    for match in _SCAN_RE.finditer(expr):
+        group = match.lastindex
+        if group == _SYMBOL:
+            token = match.group()
+            if token == '(':
+                if not operand_expected:
+                    return Diagnostic(match.start(), UNEXPECTED_TOKEN, "expected an operator, got '('")
+                parenthesis.append(match.start())
+            elif token == ')':
+                if operand_expected:
+                    return Diagnostic(match.start(), UNEXPECTED_TOKEN, "expected an operand, got ')'")
+                if not parenthesis:
+                    return Diagnostic(match.start(), UNBALANCED_PARENTHESIS, "')' has no matching '('")
+                parenthesis.pop()
+            elif operand_expected:
+                if token not in UNARY_OPS:
+                    return Diagnostic(match.start(), UNEXPECTED_TOKEN, "expected an operand, got '%s'" % token)
+            elif token in BINARY_OPS:
+                operand_expected = True
+            else:
+                return Diagnostic(match.start(), UNEXPECTED_TOKEN, "expected an operator, got '%s'" % token)
+            continue
+        if group == _WORD:
+            word = match.group()
+            if '\'' in word or '"' in word:
+                word = remove_quotes(word)
+                if not word:
+                    continue
+            if _number(word) is None:
+                return Diagnostic(match.start(), INVALID_TOKEN, "'%s' is neither a number nor a variable" % word)
+        if not operand_expected:
+            return Diagnostic(match.start(), UNEXPECTED_TOKEN, "expected an operator, got '%s'" % match.group())
+        operand_expected = False
+    if operand_expected:
+        return Diagnostic(len(expr), UNEXPECTED_END, "expected an operand, got the end of the expression")
+    if parenthesis:
+        return Diagnostic(parenthesis[-1], UNBALANCED_PARENTHESIS, "'(' is never closed")
+    return None
+
+
+def validate_many(expressions):
+    """
+    Check the syntax of many expressions, e.g. to filter out bad lines before evaluation
+    :param expressions: iterable of expressions
+    :return: generator of check() results in input order: None for valid expressions, Diagnostic otherwise
+    """
+    for expr in expressions:
+        yield check(expr)
+
+
+##################################
+###           LIMITS           ###
+##################################
+
+class Limits(object):
+    """
+    Bounds on the cost of an expression, to fail fast on hostile or buggy input instead of computing for minutes.
+
+    Token count and nesting depth are checked before parsing, integers sizes during evaluation: operations whose
+    results would have more than max_int_bits bits raise LimitExceededError. The size of a power of integers is
+    estimated before computing it, other operations are checked on their result, whose size is at most about the sum
+    of their operands sizes. Every limit is optional.
+
+    :Example:
+    >>> try:
+    ...     calc("9^9^9", limits=Limits(max_int_bits=4096))
+    ... except LimitExceededError as e:
+    ...     print(e)
+    9^387420489 would have about 1228093894 bits, more than 4096
+    """
+
+    def __init__(self, max_tokens=None, max_depth=None, max_int_bits=None):
+        """
+        Constructor
+        :param max_tokens: maximum number of tokens of an expression
+        :param max_depth: maximum nesting depth of parenthesis and unary operators
+        :param max_int_bits: maximum bit length of integers, literals as well as results
+        """
+        self.max_tokens = max_tokens
+        self.max_depth = max_depth
+        self.max_int_bits = max_int_bits
+
+    def check_tokens(self, tokens):
+        """
+        Check token count, nesting depth and integer literals of an expression
+        :param tokens: list of Token
+        :raise: LimitExceededError
+        """
+        if self.max_tokens is not None and len(tokens) > self.max_tokens:
+            raise LimitExceededError("%d tokens, more than %d" % (len(tokens), self.max_tokens))
+        for _ in self.iter_checked(tokens):
+            pass
+
+    def iter_checked(self, tokens):
+        """
+        Check token count, nesting depth and integer literals of an expression as its tokens are read
+        :param tokens: iterable of Token, e.g. from iscan()
+        :return: generator of the same tokens
+        :raise: LimitExceededError when the token exceeding limits is reached
+        """
+        max_tokens = self.max_tokens
+        max_depth = self.max_depth
+        max_int_bits = self.max_int_bits
+        parenthesis = unary = 0  # unary counts operators applying to the next operand
+        operand_expected = True
+        for count, token in enumerate(tokens, 1):
+            if max_tokens is not None and count > max_tokens:
+                raise LimitExceededError("more than %d tokens" % max_tokens)
+            kind, value, offset = token
+            if kind in LEAF_KINDS:
+                if max_int_bits is not None and isinstance(value, _INTEGER_TYPES) and \
+                        value.bit_length() > max_int_bits:
+                    raise LimitExceededError("integer of %d bits, more than %d" % (value.bit_length(), max_int_bits))
+                operand_expected = False
+                unary = 0
+            elif kind == '(':
+                parenthesis += 1
+            elif kind == ')':
+                parenthesis -= 1
+                operand_expected = False
+            elif operand_expected:
+                unary += 1
+            else:
+                operand_expected = True
+            if max_depth is not None and parenthesis + unary > max_depth:  # only grows on ( and unary operators
+                raise LimitExceededError("nesting deeper than %d" % max_depth)
+            yield token
+
+    def eval(self, operator, args):
+        """
+        Compute an operation within limits
+        :param operator: operator
+        :param args: tuple of operands
+        :return: result
+        :raise: LimitExceededError if the result is an integer too large
+        """
+        max_int_bits = self.max_int_bits
+        if max_int_bits is None:
+            return operator.eval(*args)
+        if isinstance(operator, Pow):
+            base, exponent = args
+            if isinstance(base, _INTEGER_TYPES) and isinstance(exponent, _INTEGER_TYPES) and abs(base) > 1 and \
+                    exponent > 0 and exponent * log(abs(base), 2) > max_int_bits:
+                raise LimitExceededError("%d^%d would have about %d bits, more than %d" % (
+                    base, exponent, exponent * log(abs(base), 2), max_int_bits))
+        result = operator.eval(*args)
+        if isinstance(result, _INTEGER_TYPES) and result.bit_length() > max_int_bits:
+            raise LimitExceededError("result of %d bits, more than %d" % (result.bit_length(), max_int_bits))
+        return result
+
+
 class EvaluatorBase(object):
     """
     Base class of evaluator algorithms.
@@ -266,24 +916,57 @@ class EvaluatorBase(object):
     Methods docstring are taken from the article.
     """
 
-    def __init__(self, tokexpr):
+    __slots__ = ('tokens', 'cursor', 'variables', 'limits')
+
+    def __init__(self, tokexpr, variables=None, limits=None):
         """
         Builder
-        :param tokexpr: Tokenize expression to be evaluated
+        :param tokexpr: Tokenized expression to be evaluated: list of Token from scan(), or list of strings from \
+        tokenize()
+        :param variables: mapping of variable names to their values
+        :param limits: optional Limits of the evaluation
+        :raise: LimitExceededError if the expression exceeds limits
         """
         assert tokexpr is not None, "Expression to recognize cannot be None, should at least be []"
+        if tokexpr and not isinstance(tokexpr[0], Token):
+            tokexpr = [self._typed(token) for token in tokexpr]
+        if limits is not None:
+            limits.check_tokens(tokexpr)
         self.tokens = tokexpr
         self.cursor = 0
+        self.variables = variables
+        self.limits = limits
+
+    def _typed(self, token):
+        """
+        Convert a string token from tokenize() to a Token. Call _error() if a value cannot be cast to a number
+        :param token: string token
+        :return: Token without offset
+        """
+        if token in VALID_TOKENS_SET:
+            return Token(token, None, None)
+        value = _number(token)
+        if value is None:
+            self._error("'%s' cannot be cast to a number" % token)
+        return Token(NUMBER, value, None)
 
     def _next(self):
         """
-        :return: the next token of input or None to represent that there are no more input tokens. \
-        Does not alter the input tokens.
+        :return: the kind of the next token of input (see Token) or None to represent that there are no more input \
+        tokens. Does not alter the input tokens.
         """
         if self.cursor < len(self.tokens):
-            return self.tokens[self.cursor]
+            return self.tokens[self.cursor].kind
         return None  # all tokens consumed
 
+    def _token(self):
+        """
+        :return: the next Token of input, or None. Does not alter the input tokens.
+        """
+        if self.cursor < len(self.tokens):
+            return self.tokens[self.cursor]
+        return None
+
     def _consume(self):
         """
         Consume one token. When "_next() == None", _consume is still allowed, but has no effect.
@@ -303,11 +986,14 @@ class EvaluatorBase(object):
         :param token: Expected token
         :return: None
         """
-        try:
-            assert self._next() == token
-            self._consume()
-        except AssertionError:
-            self._error("Expected %s, got %s" % (token, self._next()))
+        if self._next() != token:
+            got = self._token()
+            if got is not None and got.value is not None:  # a number or a variable, report it as written
+                got = got.value
+            elif got is not None:
+                got = got.kind
+            self._error("Expected %s, got %s" % (token, got))
+        self._consume()
 
     @staticmethod
     def _binary(token):
@@ -325,17 +1011,23 @@ class EvaluatorBase(object):
 
     def _eval_leaf(self, token):
         """
-        Convert a "value" token to its numerical value. Call _error() if casting fails
-        :param token: stringified value
-        :return: int or float depending on the token
+        Convert a "value" token to its numerical value
+        :param token: NUMBER Token, its value is already cast, or NAME Token
+        :return: int or float depending on the token, or the value of the variable
         """
-        try:
-            return int(token)
-        except ValueError:
-            try:
-                return float(token)
-            except ValueError:
-                self._error("'%s' cannot be cast to a number" % token)
+        if token.kind == NAME:
+            return self._variable(token.value)
+        return token.value
+
+    def _variable(self, name):
+        """
+        :param name: variable name
+        :return: value of the variable
+        :raise: UndefinedVariableError if the variable has no value
+        """
+        if self.variables is None or name not in self.variables:
+            raise UndefinedVariableError(name)
+        return self.variables[name]
 
     def _eval_node(self, operator, *args):
         """
@@ -344,12 +1036,26 @@ class EvaluatorBase(object):
         :param args: operands
         :return: result
         """
+        if self.limits is not None:
+            return self.limits.eval(operator, args)
         return operator.eval(*args)
 
+    # Class of compile() results, CompiledExpression when None
+    compiled_class = None
+
     def evaluate(self):
         """Override in subclasses"""
         raise NotImplementedError()
 
+    @classmethod
+    def parse(cls, tokexpr):
+        """
+        Run the algorithm over the tokens without computing anything
+        :param tokexpr: Tokenized expression to parse
+        :return: the expression tree, made of Leaf and Node
+        """
+        return _tree_builder_class(cls)(tokexpr).evaluate()
+
 
 class ShuntingYardEvaluator(EvaluatorBase):
     """
@@ -368,57 +1074,62 @@ class ShuntingYardEvaluator(EvaluatorBase):
     - pushOperator => _pushoperator
     """
 
+    __slots__ = ()
+
     def evaluate(self):
         """
         Evaluate self.tokens by parsing the Grammar and holding 2 stacks : 1 stack of operators, 1 stack of operands.
         :return: evaluation result as a numerical value
         """
-        operators = []
+        operators = []  # opcodes
         operands = []
-        operators.append(None)
+        operators.append(_SENTINEL)
         self._e(operators, operands)
         self._expect(None)
         return operands[-1]
 
     def _e(self, operators, operands):
         self._p(operators, operands)
-        while self._next() in BINARY_OPS:
-            self._pushoperator(self._binary(self._next()), operators, operands)
+        while self._next() in BINARY_CODES:
+            self._pushoperator(BINARY_CODES[self._next()], operators, operands)
             self._consume()
             self._p(operators, operands)
         # remaining operators are ordered by precedence desc : pop it all taking operands in operands stack :
-        while operators[-1] is not None:
+        while operators[-1] != _SENTINEL:
             self._popoperator(operators, operands)
 
     def _p(self, operators, operands):
-        if self._next() and self._next() not in VALID_TOKENS_SET:
-            operands.append(self._eval_leaf(self._next()))
+        if self._next() in LEAF_KINDS:
+            operands.append(self._eval_leaf(self._token()))
             self._consume()
         elif self._next() == '(':
             self._consume()
-            operators.append(None)
+            operators.append(_SENTINEL)
             self._e(operators, operands)
             self._expect(')')
             operators.pop()
-        elif self._next() in UNARY_OPS:
-            self._pushoperator(self._unary(self._next()), operators, operands)
+        elif self._next() in UNARY_CODES:
+            self._pushoperator(UNARY_CODES[self._next()], operators, operands)
             self._consume()
             self._p(operators, operands)
         else:
             self._error()
 
     def _popoperator(self, operators, operands):
-        if operators[-1] is not None and operators[-1].is_binary():
+        op = _OPERATORS_BY_CODE[operators.pop()]
+        if op.operands == 2:
             second = operands.pop()
             first = operands.pop()
-            operands.append(self._eval_node(operators.pop(), first, second))
+            operands.append(self._eval_node(op, first, second))
         else:  # unary
-            operands.append(self._eval_node(operators.pop(), operands.pop()))
+            operands.append(self._eval_node(op, operands.pop()))
 
-    def _pushoperator(self, op, operators, operands):
-        while operators[-1] > op:
+    def _pushoperator(self, code, operators, operands):
+        # operators on the stack binding their right operand tighter than the new one binds its left operand are done
+        lbp = _LBP[code]
+        while _RBP[operators[-1]] > lbp:
             self._popoperator(operators, operands)
-        operators.append(op)
+        operators.append(code)
 
 
 class PrecedenceClimbingEvaluator(EvaluatorBase):
@@ -437,67 +1148,2892 @@ class PrecedenceClimbingEvaluator(EvaluatorBase):
     - P => _p
     """
 
+    __slots__ = ()
+
     def evaluate(self):
         val = self._exp(0)
         self._expect(None)
         return val
 
     def _exp(self, precedence):
+        """
+        :param precedence: minimum binding power of the operators of this Exp
+        """
         t = self._p()
-        while self._next() in BINARY_OPS and EvaluatorBase._binary(self._next()).precedence >= precedence:
-            op = EvaluatorBase._binary(self._next())
+        code = BINARY_CODES.get(self._next())
+        while code is not None and _LBP[code] >= precedence:
             self._consume()
-            if op.is_right_assoc():
-                q = op.precedence
-            else:
-                q = op.precedence + 1
-            t1 = self._exp(q)
-            t = self._eval_node(op, t, t1)
+            t1 = self._exp(_RBP[code])
+            t = self._eval_node(_OPERATORS_BY_CODE[code], t, t1)
+            code = BINARY_CODES.get(self._next())
         return t
 
     def _p(self):
-        if self._next() in UNARY_OPS:
-            op = EvaluatorBase._unary(self._next())
+        code = UNARY_CODES.get(self._next())
+        if code is not None:
             self._consume()
-            q = op.precedence
-            t = self._exp(q)
-            return self._eval_node(op, t)
+            t = self._exp(_RBP[code])
+            return self._eval_node(_OPERATORS_BY_CODE[code], t)
         elif self._next() == '(':
             self._consume()
             t = self._exp(0)
             self._expect(')')
             return t
-        elif self._next() and self._next() not in VALID_TOKENS_SET:  # must be digits at this point
-            t = self._eval_leaf(self._next())
+        elif self._next() in LEAF_KINDS:
+            t = self._eval_leaf(self._token())
             self._consume()
             return t
         else:
             self._error()
 
 
-def calc(expr, evaluator_class=PrecedenceClimbingEvaluator):
+class IterativeShuntingYardEvaluator(ShuntingYardEvaluator):
     """
-    Do the whole work
-    :param expr: String expression
-    :param evaluator_class: class name of the evaluator to use for computation
-    :return: Evaluation result
+    "The shunting yard algorithm" without recursion.
+
+    The recursion of _e and _p over parenthesis and unary operators is replaced by a loop alternating between the 2
+    states of the grammar: expecting a P, or expecting a B after a P. Parenthesis push their sentinel on the operators
+    stack as before, and a counter tells how many are open. Stack usage is bounded whatever the nesting depth.
     """
-    tokens = tokenize(remove_quotes(expr))
-    for t in tokens:
-        validate_token(t)
-    return evaluator_class(tokens).evaluate()
 
+    __slots__ = ()
 
-if __name__ == "__main__":  # pragma: no cover
-    parser = argparse.ArgumentParser(
-        description="A simple calculator for infixed mathematical expressions. Supports operators +-/*^")
-    parser.add_argument('expression', nargs='+', help="Expression to evaluate")
-    parser.add_argument('-a', '--algo',
-                        help="Choose evaluator algorithm: pc for Precedence Climbing (default) or sh for Shunting Yard",
-                        choices=['pc', 'sh'], default='pc')
-    expression = ''.join(parser.parse_args().expression)
-    if parser.parse_args().algo == 'sh':
-        res = calc(expression, ShuntingYardEvaluator)
-    else:
-        res = calc(expression)
-    print(res)
+    def evaluate(self):
+        operators = [_SENTINEL]
+        operands = []
+        depth = 0  # number of open parenthesis
+        while True:
+            # P
+            kind = self._next()
+            if kind in LEAF_KINDS:
+                operands.append(self._eval_leaf(self._token()))
+                self._consume()
+            elif kind == '(':
+                self._consume()
+                operators.append(_SENTINEL)
+                depth += 1
+                continue
+            elif kind in UNARY_CODES:
+                self._pushoperator(UNARY_CODES[kind], operators, operands)
+                self._consume()
+                continue
+            else:
+                self._error()
+            # {B P}
+            while self._next() not in BINARY_CODES:
+                while operators[-1] != _SENTINEL:
+                    self._popoperator(operators, operands)
+                if not depth:
+                    self._expect(None)
+                    return operands[-1]
+                self._expect(')')
+                operators.pop()
+                depth -= 1
+            self._pushoperator(BINARY_CODES[self._next()], operators, operands)
+            self._consume()
+
+
+# Frames of the IterativePrecedenceClimbingEvaluator stack: what to do with the value of the Exp being parsed
+_FRAME_BINARY = 0  # right operand of a binary operator
+_FRAME_UNARY = 1  # operand of an unary operator
+_FRAME_PAREN = 2  # content of parenthesis
+
+
+class IterativePrecedenceClimbingEvaluator(PrecedenceClimbingEvaluator):
+    """
+    "Precedence climbing" without recursion.
+
+    Each recursive call of Exp(q) made by the original algorithm pushes a frame on an explicit stack instead, holding
+    the precedence of the calling Exp, the pending opcode and, for binary ones, the left operand. When an Exp is
+    complete, its value is handed to the frame on top of the stack. Stack usage is bounded whatever the nesting depth.
+    """
+
+    __slots__ = ()
+
+    def evaluate(self):
+        frames = []
+        precedence = 0  # parameter of the Exp being parsed
+        while True:
+            # P
+            kind = self._next()
+            if kind in UNARY_CODES:
+                code = UNARY_CODES[kind]
+                self._consume()
+                frames.append((_FRAME_UNARY, code, precedence, None))
+                precedence = _RBP[code]
+                continue
+            elif kind == '(':
+                self._consume()
+                frames.append((_FRAME_PAREN, None, precedence, None))
+                precedence = 0
+                continue
+            elif kind in LEAF_KINDS:
+                t = self._eval_leaf(self._token())
+                self._consume()
+            else:
+                self._error()
+            # { B Exp(q) }, then return the value of Exp to the waiting frame
+            while True:
+                code = BINARY_CODES.get(self._next())
+                if code is not None and _LBP[code] >= precedence:
+                    self._consume()
+                    frames.append((_FRAME_BINARY, code, precedence, t))
+                    precedence = _RBP[code]
+                    break
+                if not frames:
+                    self._expect(None)
+                    return t
+                frame, code, precedence, left = frames.pop()
+                if frame == _FRAME_BINARY:
+                    t = self._eval_node(_OPERATORS_BY_CODE[code], left, t)
+                elif frame == _FRAME_UNARY:
+                    t = self._eval_node(_OPERATORS_BY_CODE[code], t)
+                else:
+                    self._expect(')')
+
+
+class PrattEvaluator(EvaluatorBase):
+    """
+    "Top down operator precedence" parsing, after Vaughan Pratt.
+
+    Tokens are dispatched through tables rather than grammar rules: the "null denotation" of a token starting an
+    operand (value, parenthesis or unary operator) and the "left denotation" of a binary operator following one. The
+    binding powers of the operator registry decide alone where an expression ends, with integer comparisons.
+    """
+
+    __slots__ = ()
+
+    def evaluate(self):
+        t = self._expression(0)
+        self._expect(None)
+        return t
+
+    def _expression(self, min_bp):
+        """
+        Parse an expression whose operators bind at least with min_bp
+        """
+        t = self._nud()
+        code = BINARY_CODES.get(self._next())
+        while code is not None and _LBP[code] >= min_bp:
+            self._consume()
+            t = self._eval_node(_OPERATORS_BY_CODE[code], t, self._expression(_RBP[code]))
+            code = BINARY_CODES.get(self._next())
+        return t
+
+    def _nud(self):
+        kind = self._next()
+        nud = self._NUDS.get(kind)
+        if nud is not None:
+            token = self._token()
+            self._consume()
+            return nud(self, token)
+        code = UNARY_CODES.get(kind)
+        if code is None:
+            self._error()
+        self._consume()
+        return self._eval_node(_OPERATORS_BY_CODE[code], self._expression(_RBP[code]))
+
+    def _leaf(self, token):
+        return self._eval_leaf(token)
+
+    def _group(self, token):
+        t = self._expression(0)
+        self._expect(')')
+        return t
+
+    _NUDS = {NUMBER: _leaf, NAME: _leaf, '(': _group}
+
+
+##################################
+###          STREAMING         ###
+##################################
+
+class StreamingMixin(object):
+    """
+    Turns an evaluator into a streaming one: tokens are pulled one at a time from an iterator, e.g. iscan(), keeping
+    only the next one as lookahead instead of indexing a list. Evaluators reduce operations as soon as their operands
+    are known, so that memory use grows with the nesting depth of the expression rather than with its length.
+    """
+
+    __slots__ = ()  # the streaming class adds _lookahead, see _streaming_class()
+
+    def __init__(self, tokexpr, variables=None, limits=None):
+        """
+        Builder
+        :param tokexpr: iterable of Token, or of strings from tokenize()
+        :param variables: mapping of variable names to their values
+        :param limits: optional Limits of the evaluation, checked as tokens are read
+        """
+        tokens = iter(tokexpr)
+        if limits is not None:
+            tokens = limits.iter_checked(self._typed(token) if not isinstance(token, Token) else token
+                                         for token in tokens)
+        self.tokens = tokens
+        self.cursor = 0  # number of tokens consumed
+        self.variables = variables
+        self.limits = limits
+        self._lookahead = None
+        self._pull()
+
+    def _pull(self):
+        token = next(self.tokens, None)
+        if token is not None and not isinstance(token, Token):
+            token = self._typed(token)
+        self._lookahead = token
+
+    def _next(self):
+        token = self._lookahead
+        return token.kind if token is not None else None
+
+    def _token(self):
+        return self._lookahead
+
+    def _consume(self):
+        if self._lookahead is not None:
+            self.cursor += 1
+            self._pull()
+
+
+_STREAMING_CLASSES = {}
+
+
+def _streaming_class(evaluator_class):
+    """
+    :param evaluator_class: an evaluator class computing values as it parses
+    :return: the streaming variant of evaluator_class, created once
+    :raise: ValueError for evaluators compiling whole expressions, such as CodegenEvaluator
+    """
+    streaming = _STREAMING_CLASSES.get(evaluator_class)
+    if streaming is None:
+        if evaluator_class.compiled_class is not None:
+            raise ValueError("%s compiles whole expressions, it cannot stream" % evaluator_class.__name__)
+        streaming = type(evaluator_class.__name__ + 'Streaming', (StreamingMixin, evaluator_class),
+                         {'__slots__': ('_lookahead',)})
+        _STREAMING_CLASSES[evaluator_class] = streaming
+    return streaming
+
+
+def calc_stream(source, evaluator_class=PrecedenceClimbingEvaluator, variables=None, limits=None,
+                chunk_size=1 << 16):
+    """
+    Evaluate a single, possibly enormous, expression without materializing its tokens: it is scanned and evaluated
+    token by token. Non recursive evaluators handle any nesting depth.
+    :param source: expression string, or text file object read by chunks of chunk_size characters
+    :param evaluator_class: class name of the evaluator to use for computation, not CodegenEvaluator
+    :param variables: mapping of variable names to their values
+    :param limits: optional Limits of the evaluation cost
+    :param chunk_size: number of characters read at once from a file object
+    :return: Evaluation result, same as calc() would return
+    """
+    return _streaming_class(evaluator_class)(iscan(source, chunk_size), variables, limits).evaluate()
+
+
+##################################
+###         COMPILATION        ###
+##################################
+
+# Expression tree: the evaluators build it when their _eval_leaf and _eval_node produce nodes instead of values
+Leaf = namedtuple('Leaf', ['value'])
+Variable = namedtuple('Variable', ['name'])
+Node = namedtuple('Node', ['operator', 'operands'])
+
+# Postfix program instructions codes
+_PUSH = 0
+_UNARY = 1
+_BINARY = 2
+_LOAD = 3
+
+# Codes of compact programs, one byte per instruction. Instructions have no argument: pushes take the next value of a
+# side table, operators are their opcode
+_CODE_FLOAT = 0  # push the next float of the floats array
+_CODE_CONSTANT = 1  # push the next constant: int, or any other number
+_CODE_LOAD = 2  # push the value of the variable named by the next constant
+
+
+class TreeBuilderMixin(object):
+    """
+    Turns an evaluator into a parser: instead of computing values, the algorithm assembles the expression tree.
+    """
+
+    __slots__ = ()
+
+    def _eval_leaf(self, token):
+        if token.kind == NAME:
+            return Variable(token.value)
+        return Leaf(super(TreeBuilderMixin, self)._eval_leaf(token))
+
+    def _eval_node(self, operator, *args):
+        return Node(operator, args)
+
+
+_TREE_BUILDERS = {}
+
+
+def _tree_builder_class(evaluator_class):
+    """
+    :param evaluator_class: an evaluator class
+    :return: the tree building variant of evaluator_class, created once
+    """
+    builder = _TREE_BUILDERS.get(evaluator_class)
+    if builder is None:
+        builder = type(evaluator_class.__name__ + 'TreeBuilder', (TreeBuilderMixin, evaluator_class), {'__slots__': ()})
+        _TREE_BUILDERS[evaluator_class] = builder
+    return builder
+
+
+def _postorder(tree):
+    """
+    Walk an expression tree children first, without recursion so that deep trees are fine
+    :param tree: root Leaf, Variable or Node
+    :return: generator of the tree's Leaf, Variable and Node
+    """
+    stack = [(tree, False)]
+    while stack:
+        node, visited = stack.pop()
+        if visited or not isinstance(node, Node):
+            yield node
+        else:
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(node.operands))
+
+
+def _flatten(tree):
+    """
+    Convert an expression tree to a postfix program
+    :param tree: root Leaf, Variable or Node
+    :return: tuple of (code, argument) instructions
+    """
+    program = []
+    for node in _postorder(tree):
+        if isinstance(node, Leaf):
+            program.append((_PUSH, node.value))
+        elif isinstance(node, Variable):
+            program.append((_LOAD, node.name))
+        elif node.operator.is_unary():
+            program.append((_UNARY, node.operator))
+        else:
+            program.append((_BINARY, node.operator))
+    return tuple(program)
+
+
+def _unflatten(program):
+    """
+    Convert a postfix program back to an expression tree
+    :param program: iterable of (code, argument) instructions
+    :return: root Leaf, Variable or Node
+    """
+    stack = []
+    for code, arg in program:
+        if code == _PUSH:
+            stack.append(Leaf(arg))
+        elif code == _LOAD:
+            stack.append(Variable(arg))
+        elif code == _UNARY:
+            stack[-1] = Node(arg, (stack[-1],))
+        else:
+            right = stack.pop()
+            stack[-1] = Node(arg, (stack[-1], right))
+    return stack[-1]
+
+
+def _compact(program):
+    """
+    Convert a postfix program to its compact form
+    :param program: iterable of (code, argument) instructions
+    :return: (codes, floats, constants): array of bytes codes, array of doubles, tuple of other constants and variable
+    names. Empty side tables are empty tuples
+    """
+    codes = array('B')
+    floats = array('d')
+    constants = []
+    for code, arg in program:
+        if code == _PUSH:
+            if type(arg) is float:
+                codes.append(_CODE_FLOAT)
+                floats.append(arg)
+            else:
+                codes.append(_CODE_CONSTANT)
+                constants.append(arg)
+        elif code == _LOAD:
+            codes.append(_CODE_LOAD)
+            constants.append(arg)
+        else:
+            codes.append(_operator_code(arg))
+    return codes, floats or (), tuple(constants)
+
+
+class CompiledExpression(object):
+    """
+    Expression parsed once, ready to be evaluated many times.
+
+    It holds the flattened postfix form of the expression tree, which evaluate() runs with a simple value stack. The
+    program is stored compact, for caches of many expressions to stay small: one byte per instruction, float literals
+    in an array of doubles and other constants in a tuple. The tree is rebuilt on demand.
+    """
+
+    __slots__ = ('_codes', '_floats', '_constants', '_source')
+
+    def __init__(self, tree, source=None):
+        """
+        Constructor
+        :param tree: root of the expression tree
+        :param source: original expression string, informative only
+        """
+        self._codes, self._floats, self._constants = _compact(_flatten(tree))
+        self._source = source
+
+    @classmethod
+    def _load(cls, codes, floats, constants, source=None):
+        """
+        Alternate constructor from the compact form of a program, e.g. read back from a DiskCache
+        """
+        compiled = cls.__new__(cls)
+        compiled._codes, compiled._floats, compiled._constants = codes, floats, constants
+        compiled._source = source
+        return compiled
+
+    @property
+    def tree(self):
+        return _unflatten(self.program)
+
+    @property
+    def source(self):
+        return self._source
+
+    @property
+    def program(self):
+        """Tuple of (code, argument) instructions"""
+        program = []
+        floats = iter(self._floats)
+        constants = iter(self._constants)
+        for code in self._codes:
+            if code == _CODE_FLOAT:
+                program.append((_PUSH, next(floats)))
+            elif code == _CODE_CONSTANT:
+                program.append((_PUSH, next(constants)))
+            elif code == _CODE_LOAD:
+                program.append((_LOAD, next(constants)))
+            else:
+                operator = _OPERATORS_BY_CODE[code]
+                program.append((_UNARY if operator.is_unary() else _BINARY, operator))
+        return tuple(program)
+
+    @property
+    def variables(self):
+        """Sorted names of the variables of the expression"""
+        return tuple(sorted(set(arg for code, arg in self.program if code == _LOAD)))
+
+    def evaluate(self, variables=None, limits=None):
+        """
+        Run the postfix program
+        :param variables: mapping of variable names to their values. Values may as well be NumPy arrays, then each \
+        operator runs once over whole arrays
+        :param limits: optional Limits of integers sizes
+        :return: evaluation result, same as calc() would return
+        :raise: UndefinedVariableError if a variable has no value, LimitExceededError
+        """
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        floats = iter(self._floats)
+        constants = iter(self._constants)
+        operators = _OPERATORS_BY_CODE
+        for code in self._codes:
+            if code == _CODE_FLOAT:
+                push(next(floats))
+            elif code == _CODE_CONSTANT:
+                push(next(constants))
+            elif code == _CODE_LOAD:
+                name = next(constants)
+                if variables is None or name not in variables:
+                    raise UndefinedVariableError(name)
+                push(variables[name])
+            else:
+                operator = operators[code]
+                if operator.operands == 1:
+                    stack[-1] = operator.eval(stack[-1]) if limits is None else limits.eval(operator, (stack[-1],))
+                else:
+                    right = pop()
+                    stack[-1] = operator.eval(stack[-1], right) if limits is None else \
+                        limits.eval(operator, (stack[-1], right))
+        return stack[-1]
+
+    def evaluate_columns(self, columns):
+        """
+        Vectorized evaluation of the expression over rows of values, with NumPy.
+
+        Each operator runs once over whole columns instead of once per row, with NumPy semantics: e.g. integers
+        columns are 64 bits integers, and dividing by zero gives inf with a warning.
+        :param columns: mapping of variable names to sequences of values, of the same length
+        :return: NumPy array of results, one per row
+        :raise: UndefinedVariableError if a variable has no column
+        """
+        if numpy is None:
+            raise ImportError("evaluate_columns() requires NumPy")
+        arrays = dict((name, numpy.asarray(values)) for name, values in columns.items())
+        result = self.evaluate(arrays)
+        if numpy.ndim(result) == 0:  # no variable in the expression, same result for every row
+            size = len(next(iter(arrays.values()))) if arrays else 1
+            result = numpy.full(size, result)
+        return result
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self._source)
+
+
+def compile(expr, evaluator_class=PrecedenceClimbingEvaluator, limits=None):
+    """
+    Parse an expression once for many evaluations
+    :param expr: String expression
+    :param evaluator_class: class name of the evaluator whose algorithm parses the expression
+    :param limits: optional Limits, token count and nesting depth are checked before parsing
+    :return: CompiledExpression
+    :raise: InvalidTokenError, MalformedExpressionError or LimitExceededError, as calc() does
+    """
+    tokens = scan(expr)
+    if limits is not None:
+        limits.check_tokens(tokens)
+    return (evaluator_class.compiled_class or CompiledExpression)(evaluator_class.parse(tokens), expr)
+
+
+##################################
+###          OPTIMIZER         ###
+##################################
+
+# Constants are folded unless their result would be too large for the compiled expression to carry
+_FOLD_LIMITS = Limits(max_int_bits=4096)
+
+
+def _is_int(node, value):
+    """
+    :return: True if node is the int constant value. Floats don't count: they would change the result type
+    """
+    return isinstance(node, Leaf) and type(node.value) is int and node.value == value
+
+
+def _fold(operator, operands):
+    """
+    Compute an operation of constants at compile time
+    :return: Leaf of the result, None if it should rather be left to evaluation
+    """
+    try:
+        return Leaf(_FOLD_LIMITS.eval(operator, tuple(operand.value for operand in operands)))
+    except (ArithmeticError, ValueError, LimitExceededError):  # e.g. division by zero: let evaluate() raise it
+        return None
+
+
+def _simplify(operator, operands):
+    """
+    Rewrite a node whose operands are already simplified
+    :param operator: operator of the node
+    :param operands: simplified operands
+    :return: simplified Leaf, Variable or Node
+    """
+    if all(isinstance(operand, Leaf) for operand in operands):
+        folded = _fold(operator, operands)
+        if folded is not None:
+            return folded
+    if isinstance(operator, UnaryMinus):
+        operand = operands[0]
+        if isinstance(operand, Node) and isinstance(operand.operator, UnaryMinus):  # --x => x
+            return operand.operands[0]
+    elif isinstance(operator, Multiply):
+        if _is_int(operands[1], 1):  # x*1 => x
+            return operands[0]
+        if _is_int(operands[0], 1):  # 1*x => x
+            return operands[1]
+    elif isinstance(operator, Minus):
+        if _is_int(operands[1], 0):  # x-0 => x. Not x+0, which turns -0.0 into 0.0
+            return operands[0]
+    elif isinstance(operator, Pow):
+        if _is_int(operands[1], 1):  # x^1 => x
+            return operands[0]
+        if _is_int(operands[1], 2) and not isinstance(operands[0], Node):  # x^2 => x*x
+            return Node(BINARY_OPS['*'], (operands[0], operands[0]))
+    return Node(operator, tuple(operands))
+
+
+def _size(tree):
+    """:return: number of nodes of a tree, leaves included"""
+    return sum(1 for _ in _postorder(tree))
+
+
+def optimize(compiled):
+    """
+    Simplify a compiled expression, so that evaluations dispatch fewer operations:
+    - constant sub expressions are folded, e.g. (60*60*24) => 86400
+    - identities are removed: x*1, 1*x, x-0, x^1 and --x are x
+    - x^2 is turned into x*x when x is a number or a variable
+    Results remain the same, ints remain ints and floats remain floats. Only a float overflow of x^2 becomes inf
+    rather than OverflowError. Operations that fail, like 1/0, are not folded so that evaluate() raises as usual.
+    :param compiled: CompiledExpression
+    :return: tuple (optimized CompiledExpression, number of nodes eliminated)
+    """
+    original = compiled.tree
+    simplified = {}  # id of original node => simplified node
+    for node in _postorder(original):
+        if isinstance(node, Node):
+            simplified[id(node)] = _simplify(node.operator, [simplified[id(operand)] for operand in node.operands])
+        else:
+            simplified[id(node)] = node
+    tree = simplified[id(original)]
+    return compiled.__class__(tree, compiled.source), _size(original) - _size(tree)
+
+
+##################################
+###   SHARED SUBEXPRESSIONS    ###
+##################################
+
+DagStats = namedtuple('DagStats', ['expressions', 'nodes', 'unique', 'ratio'])
+_UNEVALUATED = object()  # value of the nodes of an ExpressionDag not computed yet
+
+
+class ExpressionDag(object):
+    """
+    Set of expressions whose trees are merged into one directed acyclic graph, so that each distinct sub expression is
+    evaluated once for all of them, e.g. (1+0.05)^12 shared by many formulas.
+
+    Nodes are hash-consed: a leaf is identified by the type and value of its number, a variable by its name, an
+    operation by its operator and the nodes of its operands. evaluate() computes nodes on demand, operands from left to
+    right as evaluators do: operations calc() would not reach after an error, e.g. 9^9^9 in 1/0+9^9^9, are not computed.
+
+    :Example:
+    >>> dag = ExpressionDag(['1000*(1+0.05)^12', '2000*(1+0.05)^12'])
+    >>> dag.evaluate()
+    [1795.8563260221301, 3591.7126520442603]
+    >>> dag.stats()
+    DagStats(expressions=2, nodes=14, unique=9, ratio=1.5555555555555556)
+    """
+
+    def __init__(self, expressions=(), evaluator_class=PrecedenceClimbingEvaluator):
+        """
+        Constructor
+        :param expressions: iterable of expressions to add
+        :param evaluator_class: class name of the evaluator whose algorithm parses the expressions
+        """
+        self.evaluator_class = evaluator_class
+        self._nodes = []  # (code, argument, indexes of operands)
+        self._index = {}  # key of node => index in _nodes
+        self._roots = []  # per expression, index of its root node, or the exception parsing it raised
+        self._parsed = {}  # expression string => (root, number of nodes of its tree)
+        self._size = 0  # number of nodes of the trees of the expressions, as evaluated one by one
+        for expr in expressions:
+            self.add(expr)
+
+    def _intern(self, key, code, arg, operands=()):
+        index = self._index.get(key)
+        if index is None:
+            index = self._index[key] = len(self._nodes)
+            self._nodes.append((code, arg, operands))
+        return index
+
+    def add(self, expr):
+        """
+        Parse an expression and merge its tree into the graph
+        :param expr: String expression
+        :return: position of the expression, in results of evaluate()
+        """
+        parsed = self._parsed.get(expr)
+        if parsed is None:
+            size = 0
+            try:
+                tree = compile(expr, self.evaluator_class).tree
+            except CALC_ERRORS as e:
+                root = e
+            else:
+                indexes = {}  # id of tree node => index of DAG node
+                for node in _postorder(tree):
+                    if isinstance(node, Leaf):
+                        index = self._intern((_PUSH, type(node.value), node.value), _PUSH, node.value)
+                    elif isinstance(node, Variable):
+                        index = self._intern((_LOAD, node.name), _LOAD, node.name)
+                    else:
+                        operands = tuple(indexes[id(operand)] for operand in node.operands)
+                        index = self._intern((_operator_code(node.operator), operands), _BINARY, node.operator,
+                                             operands)
+                    indexes[id(node)] = index
+                root = indexes[id(tree)]
+                size = len(indexes)
+            parsed = self._parsed[expr] = root, size
+        root, size = parsed
+        self._size += size
+        self._roots.append(root)
+        return len(self._roots) - 1
+
+    def evaluate(self, variables=None, limits=None):
+        """
+        Evaluate all the expressions, each distinct sub expression once
+        :param variables: mapping of variable names to their values
+        :param limits: optional Limits of integers sizes
+        :return: list of results, in the order expressions were added. Expressions that fail give their exception
+        instead of a result, the same as calc() would raise
+        """
+        nodes = self._nodes
+        values = [_UNEVALUATED] * len(nodes)
+        errors = {}  # index of node => exception, its value is None
+        for root in self._roots:
+            if isinstance(root, Exception):
+                continue
+            stack = [root]
+            while stack:
+                index = stack[-1]
+                if values[index] is not _UNEVALUATED:
+                    stack.pop()
+                    continue
+                code, arg, operands = nodes[index]
+                if code == _PUSH:
+                    values[index] = arg
+                elif code == _LOAD:
+                    if variables is None or arg not in variables:
+                        errors[index] = UndefinedVariableError(arg)
+                        values[index] = None
+                    else:
+                        values[index] = variables[arg]
+                else:
+                    pending = None
+                    for operand in operands:
+                        if values[operand] is _UNEVALUATED:
+                            pending = operand
+                            break
+                        if operand in errors:  # next operands are not evaluated
+                            errors[index] = errors[operand]
+                            values[index] = None
+                            break
+                    if pending is not None:
+                        stack.append(pending)
+                        continue
+                    if index not in errors:
+                        args = tuple(values[operand] for operand in operands)
+                        try:
+                            values[index] = arg.eval(*args) if limits is None else limits.eval(arg, args)
+                        except CALC_ERRORS as e:
+                            errors[index] = e
+                            values[index] = None
+                stack.pop()
+        return [root if isinstance(root, Exception) else errors.get(root, values[root]) for root in self._roots]
+
+    def stats(self):
+        """
+        :return: DagStats: number of expressions, of nodes as evaluated one by one, of nodes of the graph evaluated
+        once each, and deduplication ratio of the former by the latter
+        """
+        return DagStats(len(self._roots), self._size, len(self._nodes),
+                        self._size / len(self._nodes) if self._nodes else 1.)
+
+    def __len__(self):
+        return len(self._roots)
+
+
+##################################
+###        FORMULA SHEET       ###
+##################################
+
+SheetStats = namedtuple('SheetStats', ['formulas', 'recalculations', 'recomputed', 'skipped'])
+
+
+class _Cells(dict):
+    """Values of the cells of a Sheet: reading a cell whose formula failed raises its error"""
+
+    def __getitem__(self, name):
+        value = dict.__getitem__(self, name)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+
+def _same_value(old, new):
+    """:return: True if a recomputed cell value is unchanged, int and float values are not the same"""
+    if isinstance(old, Exception) or isinstance(new, Exception):
+        return old is new
+    return type(old) is type(new) and old == new
+
+
+class Sheet(object):
+    """
+    Named formulas referencing each other and input cells, recomputed incrementally.
+
+    Names in formulas are the names of other cells. Changing an input or a formula marks the formulas downstream of it
+    dirty, recalculate() recomputes only them, in topological order, and stops propagating where a recomputed value
+    is unchanged. Formulas that would depend on themselves are rejected.
+
+    :Example:
+    >>> sheet = Sheet()
+    >>> sheet.set_input('rate', 0.05)
+    >>> sheet.set_formula('factor', '(1+rate)^12')
+    >>> sheet.set_formula('total', '1000*factor')
+    >>> sheet['total']
+    1795.8563260221301
+    >>> sheet.set_input('rate', 0)
+    >>> sheet['total']
+    1000
+    """
+
+    def __init__(self, evaluator_class=PrecedenceClimbingEvaluator, limits=None):
+        """
+        Constructor
+        :param evaluator_class: class name of the evaluator whose algorithm parses the formulas
+        :param limits: optional Limits of each formula evaluation
+        """
+        self.evaluator_class = evaluator_class
+        self.limits = limits
+        self._formulas = {}  # name => CompiledExpression
+        self._dependencies = {}  # formula name => names of the cells it reads
+        self._dependents = {}  # cell name => names of the formulas reading it
+        self._values = _Cells()  # name => value of the input, or result or exception of the formula
+        self._order = None  # positions of the formulas in topological order, None when formulas changed
+        self._changed = set()  # names of the cells changed since last recalculation
+        self._recalculations = self._recomputed = self._skipped = 0
+
+    def set_input(self, name, value):
+        """
+        Set the value of an input cell, replacing the formula of the same name if any
+        :param name: cell name
+        :param value: number
+        """
+        if name in self._formulas:
+            self._remove_formula(name)
+        elif name in self._values and _same_value(self._values[name], value):
+            return
+        self._values[name] = value
+        self._changed.add(name)
+
+    def update(self, inputs):
+        """
+        Set the values of several input cells
+        :param inputs: mapping of cell names to numbers
+        """
+        for name, value in inputs.items():
+            self.set_input(name, value)
+
+    def set_formula(self, name, expr):
+        """
+        Set the formula of a cell, replacing its input value or previous formula
+        :param name: cell name
+        :param expr: String expression, its variables are the names of the cells it reads
+        :raise: InvalidTokenError, MalformedExpressionError or LimitExceededError as compile() does, \
+        CircularReferenceError if the formula would depend on itself. The sheet is then unchanged
+        """
+        compiled = compile(expr, self.evaluator_class, self.limits)
+        dependencies = frozenset(compiled.variables)
+        cycle = self._path(dependencies, name)
+        if cycle is not None:
+            raise CircularReferenceError(' -> '.join([name] + cycle))
+        if name in self._formulas:
+            self._remove_formula(name)
+        else:
+            dict.pop(self._values, name, None)
+        self._formulas[name] = compiled
+        self._dependencies[name] = dependencies
+        for dependency in dependencies:
+            self._dependents.setdefault(dependency, set()).add(name)
+        self._order = None
+        self._changed.add(name)
+
+    def _path(self, starts, target):
+        """
+        :return: names of the cells from one of starts to target following dependencies, or None if there is none
+        """
+        parents = dict((start, None) for start in starts)
+        stack = list(starts)
+        while stack:
+            name = stack.pop()
+            if name == target:
+                path = []
+                while name is not None:
+                    path.append(name)
+                    name = parents[name]
+                return path[::-1]
+            for dependency in self._dependencies.get(name, ()):
+                if dependency not in parents:
+                    parents[dependency] = name
+                    stack.append(dependency)
+        return None
+
+    def _remove_formula(self, name):
+        del self._formulas[name]
+        for dependency in self._dependencies.pop(name):
+            dependents = self._dependents[dependency]
+            dependents.discard(name)
+            if not dependents:
+                del self._dependents[dependency]
+        dict.pop(self._values, name, None)
+        self._order = None
+
+    def __delitem__(self, name):
+        """Remove an input or formula cell, formulas reading it become undefined"""
+        if name in self._formulas:
+            self._remove_formula(name)
+        elif name in self._values:
+            dict.__delitem__(self._values, name)
+        else:
+            raise KeyError(name)
+        self._changed.add(name)
+
+    def _topological_order(self):
+        """:return: dict of formula names to their positions, each formula after the formulas it reads"""
+        if self._order is None:
+            order = {}
+            for root in self._formulas:
+                if root in order:
+                    continue
+                stack = [(root, False)]
+                while stack:
+                    name, visited = stack.pop()
+                    if visited:
+                        order.setdefault(name, len(order))
+                    elif name not in order:
+                        stack.append((name, True))
+                        stack.extend((dependency, False) for dependency in self._dependencies[name]
+                                     if dependency in self._formulas and dependency not in order)
+            self._order = order
+        return self._order
+
+    def recalculate(self):
+        """
+        Recompute the formulas downstream of the cells changed since last recalculation
+        :return: number of formulas recomputed
+        """
+        if not self._changed:
+            return 0
+        order = self._topological_order()
+        changed = self._changed
+        self._changed = set()
+        dirty = set()
+        stack = list(changed)
+        while stack:
+            for dependent in self._dependents.get(stack.pop(), ()):
+                if dependent not in dirty:
+                    dirty.add(dependent)
+                    stack.append(dependent)
+        dirty.update(name for name in changed if name in self._formulas)
+        recomputed = 0
+        for name in sorted(dirty, key=order.__getitem__):
+            if name not in changed and changed.isdisjoint(self._dependencies[name]):
+                continue  # what it reads is unchanged after all
+            try:
+                value = self._formulas[name].evaluate(self._values, self.limits)
+            except CALC_ERRORS as e:
+                value = e
+            recomputed += 1
+            if name not in self._values or not _same_value(dict.__getitem__(self._values, name), value):
+                changed.add(name)
+            self._values[name] = value
+        self._recalculations += 1
+        self._recomputed += recomputed
+        self._skipped += len(self._formulas) - recomputed
+        return recomputed
+
+    def __getitem__(self, name):
+        """
+        :param name: cell name
+        :return: value of the cell, recalculating the sheet first if needed
+        :raise: KeyError if there is no such cell, the error of the formula if it failed
+        """
+        self.recalculate()
+        return self._values[name]
+
+    def results(self):
+        """
+        :return: dict of all the cell names to their values, formulas that fail give their exception instead
+        """
+        self.recalculate()
+        return dict(self._values)
+
+    def formula(self, name):
+        """:return: the CompiledExpression of a formula cell"""
+        return self._formulas[name]
+
+    def stats(self):
+        """
+        :return: SheetStats: number of formulas, of recalculations, and of formulas they recomputed and skipped
+        """
+        return SheetStats(len(self._formulas), self._recalculations, self._recomputed, self._skipped)
+
+    def __contains__(self, name):
+        return name in self._values or name in self._formulas
+
+    def __len__(self):
+        return len(set(self._values) | set(self._formulas))
+
+
+##################################
+###        EDIT SESSIONS       ###
+##################################
+
+SessionStats = namedtuple('SessionStats', ['edits', 'scanned', 'reused', 'parsed', 'evaluated'])
+INVALID = 'invalid'  # kind of the tokens of an EditSession that are not valid words, their value is the word
+
+# Kinds of the nodes of an EditSession tree
+_NODE_LEAF = 0
+_NODE_GROUP = 1
+_NODE_UNARY = 2
+_NODE_BINARY = 3
+
+
+class _SessionNode(object):
+    """
+    Node of the tree of an EditSession. Nodes know how many tokens they span, rather than where, so that they stay
+    valid when edits before them shift the tokens.
+    """
+
+    __slots__ = ('kind', 'arg', 'children', 'length', 'precedence', 'value', 'stamp')
+
+    def __init__(self, kind, arg, children, length, precedence=None):
+        """
+        Constructor
+        :param kind: _NODE_LEAF, _NODE_GROUP, _NODE_UNARY or _NODE_BINARY
+        :param arg: Token of a leaf, operator of an operation
+        :param children: tuple of operand nodes, the content of a group
+        :param length: number of tokens spanned, parenthesis included
+        :param precedence: for binary nodes, parameter of the Exp that built them
+        """
+        self.kind = kind
+        self.arg = arg
+        self.children = children
+        self.length = length
+        self.precedence = precedence
+        self.value = None  # cached value, or exception
+        self.stamp = -1  # EditSession stamp of the cached value
+
+
+class _IncrementalParser(PrecedenceClimbingEvaluator):
+    """
+    Precedence climbing building the tree of an EditSession, reusing the nodes of its previous tree that the tokens
+    replaced since do not affect.
+
+    An Exp(p) starting at a token is a function of the tokens from there up to the first token it does not consume: a
+    binary node built by the loop of an Exp(p) is reusable by the Exp(p) starting at the same token, as its state
+    before reading the next operator, when none of these tokens changed. Leaves and groups do not depend on the next
+    token. Exp calls start at increasing positions, so that previous nodes are found with a finger search.
+    """
+
+    __slots__ = ('previous', 'hull', 'path', 'reused', 'parsed')
+
+    def __init__(self, tokexpr, previous=None, hull=None):
+        """
+        Builder
+        :param tokexpr: list of Token
+        :param previous: root _SessionNode of the previous tree, None to parse from scratch
+        :param hull: (lo, hi_old, hi_new): tokens lo to hi_new replace tokens lo to hi_old of the previous tree
+        """
+        super(_IncrementalParser, self).__init__(tokexpr)
+        self.previous = previous
+        self.hull = hull
+        self.path = [(previous, 0)] if previous is not None else []  # (node, position) from the root of previous
+        self.reused = self.parsed = 0
+
+    def _node(self, kind, arg, children, length, precedence=None):
+        self.parsed += 1
+        return _SessionNode(kind, arg, children, length, precedence)
+
+    def _exp(self, precedence):
+        start = self.cursor
+        t = self._reusable(start, precedence)
+        if t is None:
+            t = self._p()
+        else:
+            self.reused += 1
+            self.cursor = start + t.length
+        code = BINARY_CODES.get(self._next())
+        while code is not None and _LBP[code] >= precedence:
+            self._consume()
+            t1 = self._exp(_RBP[code])
+            t = self._node(_NODE_BINARY, _OPERATORS_BY_CODE[code], (t, t1), t.length + 1 + t1.length, precedence)
+            code = BINARY_CODES.get(self._next())
+        return t
+
+    def _p(self):
+        code = UNARY_CODES.get(self._next())
+        if code is not None:
+            self._consume()
+            t = self._exp(_RBP[code])
+            return self._node(_NODE_UNARY, _OPERATORS_BY_CODE[code], (t,), t.length + 1)
+        elif self._next() == '(':
+            self._consume()
+            t = self._exp(0)
+            self._expect(')')
+            return self._node(_NODE_GROUP, None, (t,), t.length + 2)
+        elif self._next() in LEAF_KINDS:
+            token = self._token()
+            self._consume()
+            return self._node(_NODE_LEAF, token, (), 1)
+        else:
+            self._error()
+
+    def _reusable(self, start, precedence):
+        """
+        :return: the largest previous node starting at token start that Exp(precedence) may take as is, or None
+        """
+        if self.previous is None:
+            return None
+        lo, hi_old, hi_new = self.hull
+        if lo <= start < hi_new:
+            return None
+        position = start if start < lo else start - hi_new + hi_old
+        node = self._find(position)
+        while node is not None:
+            end = position + node.length
+            if node.kind == _NODE_BINARY:
+                if node.precedence == precedence and (end < lo or position >= hi_old):
+                    return node
+                node = node.children[0]
+            elif node.kind == _NODE_UNARY:
+                return node if end < lo or position >= hi_old else None
+            else:
+                return node if end <= lo or position >= hi_old else None
+        return None
+
+    def _find(self, position):
+        """
+        :return: the outermost previous node starting at token position, None if there is none
+        """
+        path = self.path
+        while path:
+            node, start = path[-1]
+            if start <= position < start + node.length:
+                break
+            path.pop()
+        else:
+            return None
+        while start != position:
+            child_start = start + (node.kind != _NODE_BINARY)
+            for child in node.children:
+                if child_start <= position < child_start + child.length:
+                    break
+                child_start += child.length + 1
+            else:
+                return None
+            node, start = child, child_start
+            path.append((node, start))
+        return node
+
+
+def _evaluate_session_node(root, variables, stamp):
+    """
+    Evaluate the nodes of an EditSession tree whose cached value is not of stamp, without recursion
+    :return: (value or exception, number of nodes evaluated)
+    """
+    evaluated = 0
+    stack = [root]
+    while stack:
+        node = stack[-1]
+        if node.stamp == stamp:
+            stack.pop()
+            continue
+        kind = node.kind
+        if kind == _NODE_LEAF:
+            kind, value, _ = node.arg
+            if kind == NAME:
+                value = variables[value] if variables is not None and value in variables else \
+                    UndefinedVariableError(value)
+        else:
+            first = node.children[0]
+            if first.stamp != stamp:
+                stack.append(first)
+                continue
+            value = first.value
+            if kind == _NODE_BINARY and not isinstance(value, Exception):
+                second = node.children[1]
+                if second.stamp != stamp:
+                    stack.append(second)
+                    continue
+                value = second.value if isinstance(second.value, Exception) else (first.value, second.value)
+            if not isinstance(value, Exception) and kind != _NODE_GROUP:
+                try:
+                    value = node.arg.eval(*value) if kind == _NODE_BINARY else node.arg.eval(value)
+                except CALC_ERRORS as e:
+                    value = e
+        node.value = value
+        node.stamp = stamp
+        evaluated += 1
+        stack.pop()
+    return root.value, evaluated
+
+
+def _scan_range(text, start, end):
+    """
+    Scan a range of text, as scan() would scan it within the whole text. Words that are not valid are INVALID tokens
+    :return: (tokens, starts, ends): Token without offset, and offsets of their first and past last characters
+    """
+    tokens = []
+    starts = []
+    ends = []
+    for match in _SCAN_RE.finditer(text, start, end):
+        try:
+            token = _match_token(match, None)
+        except InvalidTokenError as e:
+            token = Token(INVALID, e.args[0], None)  # the word without quotes
+        if token is not None:
+            tokens.append(token)
+            starts.append(match.start())
+            ends.append(match.end())
+    return tokens, starts, ends
+
+
+def _same_token(token, other):
+    """:return: True if tokens are equal, 2 and 2.0 are not"""
+    return token == other and type(token.value) is type(other.value)
+
+
+class EditSession(object):
+    """
+    Expression edited interactively and evaluated after every edit, with a latency depending on the edit rather than
+    on the length of the expression.
+
+    An edit only rescans the tokens it touches. Parsing then reuses the subtrees of the previous tree whose tokens did
+    not change, with their cached values, so that only the nodes along the changed path are built and evaluated again.
+    Results and errors are the same as compile(text).evaluate() gives: syntax errors come before evaluation errors.
+    Variables are copied: they change by assigning the variables property or with set_variable() only.
+
+    :Example:
+    >>> session = EditSession('2*(3+4)')
+    >>> session.evaluate()
+    14
+    >>> session.edit(5, 1, '40')
+    >>> session.text
+    '2*(3+40)'
+    >>> session.evaluate()
+    86
+    """
+
+    def __init__(self, text='', variables=None):
+        """
+        Constructor
+        :param text: initial expression
+        :param variables: mapping of variable names to their values, copied
+        """
+        self._text = ''
+        self._tokens = []
+        self._starts = []  # offsets of the first characters of the tokens
+        self._ends = []  # offsets following the last characters of the tokens
+        self._invalid = 0  # number of INVALID tokens
+        self._tree = None  # tree of the last successful parse
+        self._hull = None  # (lo, hi_old, hi_new): tokens lo to hi_new replace tokens lo to hi_old of the tree
+        self._dirty = True  # tokens changed since last parse
+        self._error = None  # error of the last parse
+        self._variables = dict(variables or {})
+        self._stamp = 0  # changes with variables, to invalidate cached values
+        self._edits = self._scanned = self._reused = self._parsed = self._evaluated = 0
+        self.edit(0, 0, text)
+
+    @property
+    def text(self):
+        return self._text
+
+    @property
+    def variables(self):
+        """Copy of the variables: changing it does not change the session"""
+        return dict(self._variables)
+
+    @variables.setter
+    def variables(self, variables):
+        self._variables = dict(variables or {})
+        self._stamp += 1
+
+    def set_variable(self, name, value):
+        """
+        Set the value of one variable
+        :param name: variable name
+        :param value: number
+        """
+        self._variables[name] = value
+        self._stamp += 1
+
+    def edit(self, offset, deleted, inserted):
+        """
+        Replace characters of the expression
+        :param offset: offset of the first character replaced
+        :param deleted: number of characters replaced
+        :param inserted: replacing string
+        """
+        text = self._text
+        if offset < 0 or deleted < 0 or offset + deleted > len(text):
+            raise ValueError("edit of %d characters at %d is out of the expression" % (deleted, offset))
+        new_text = text[:offset] + inserted + text[offset + deleted:]
+        shift = len(inserted) - deleted
+        if '\'' in new_text or '"' in new_text:  # quotes may join words apart: rescan all
+            first, last = 0, len(self._tokens)
+            start, end = 0, len(new_text)
+        else:
+            first = bisect_left(self._ends, offset)  # first token ending at or after the edit
+            last = bisect_right(self._starts, offset + deleted)  # first token starting after the edit
+            start = min(offset, self._starts[first]) if first < last else offset
+            end = (max(offset + deleted, self._ends[last - 1]) if first < last else offset + deleted) + shift
+        tokens, starts, ends = _scan_range(new_text, start, end)
+        self._edits += 1
+        self._scanned += len(tokens)
+        # tokens scanned again but unchanged are kept
+        old_tokens, old_starts, old_ends = self._tokens, self._starts, self._ends
+        while tokens and first < last and _same_token(tokens[0], old_tokens[first]) and \
+                (starts[0], ends[0]) == (old_starts[first], old_ends[first]):
+            del tokens[0], starts[0], ends[0]
+            first += 1
+        while tokens and first < last and _same_token(tokens[-1], old_tokens[last - 1]) and \
+                (starts[-1], ends[-1]) == (old_starts[last - 1] + shift, old_ends[last - 1] + shift):
+            del tokens[-1], starts[-1], ends[-1]
+            last -= 1
+        self._text = new_text
+        if first == last and not tokens:
+            if shift:
+                self._starts[first:] = [position + shift for position in self._starts[first:]]
+                self._ends[first:] = [position + shift for position in self._ends[first:]]
+            return
+        self._invalid += sum(token.kind == INVALID for token in tokens) - \
+            sum(token.kind == INVALID for token in old_tokens[first:last])
+        self._tokens[first:last] = tokens
+        self._starts[first:] = starts + [position + shift for position in self._starts[last:]]
+        self._ends[first:] = ends + [position + shift for position in self._ends[last:]]
+        if self._hull is None:
+            self._hull = (first, last, first + len(tokens))
+        else:
+            lo, hi_old, hi_new = self._hull
+            suffix = max(hi_new, last)  # first token unchanged since the tree was parsed, before this edit
+            self._hull = (min(lo, first), suffix - hi_new + hi_old, suffix + len(tokens) - (last - first))
+        self._dirty = True
+
+    def _parse(self):
+        """
+        :return: root _SessionNode of the current tokens
+        :raise: InvalidTokenError or MalformedExpressionError, as calc() does
+        """
+        if self._dirty:
+            self._dirty = False
+            if self._invalid:
+                self._error = InvalidTokenError(next(token.value for token in self._tokens if token.kind == INVALID))
+            else:
+                parser = _IncrementalParser(self._tokens, self._tree, self._hull)
+                try:
+                    tree = parser.evaluate()
+                except CALC_ERRORS as e:
+                    self._error = e
+                else:
+                    self._tree, self._hull, self._error = tree, None, None
+                self._reused += parser.reused
+                self._parsed += parser.parsed
+        if self._error is not None:
+            raise self._error
+        return self._tree
+
+    def evaluate(self):
+        """
+        :return: evaluation result of the expression, same as compile(text).evaluate() would return
+        :raise: the same errors as compile(text).evaluate()
+        """
+        value, evaluated = _evaluate_session_node(self._parse(), self._variables, self._stamp)
+        self._evaluated += evaluated
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def stats(self):
+        """
+        :return: SessionStats: number of edits, and of tokens scanned, subtrees reused, nodes parsed and evaluated
+        since the session started
+        """
+        return SessionStats(self._edits, self._scanned, self._reused, self._parsed, self._evaluated)
+
+
+##################################
+###       CODE GENERATION      ###
+##################################
+
+def _undefined(variables, names):
+    """Raise UndefinedVariableError for the first of names without value"""
+    for name in names:
+        if variables is None or name not in variables:
+            raise UndefinedVariableError(name)
+
+
+def _operand_source(node, names, namespace):
+    """
+    :return: Python source of an operand: its literal, or the name of the local holding its value
+    """
+    if isinstance(node, Leaf):
+        value = node.value
+        if type(value) is int or (type(value) is float and value - value == 0):  # inf and nan have no literal
+            literal = repr(value)
+            return '(%s)' % literal if literal.startswith('-') else literal
+        name = '_c%d' % len(namespace)
+        namespace[name] = value
+        return name
+    return names[id(node)]
+
+
+def _template(operator):
+    """
+    :return: template of an operator, None if it has none or if its class overrides do_eval but not the template
+    """
+    for cls in type(operator).__mro__:
+        if 'template' in vars(cls):
+            return cls.template
+        if 'do_eval' in vars(cls):
+            return None
+    return None
+
+
+def generate_source(tree):
+    """
+    Generate a Python function computing an expression tree with straight line arithmetic: one statement per
+    operation, whatever the nesting depth.
+    :param tree: root Leaf, Variable or Node
+    :return: tuple (source of the _expression(_variables) function, namespace it needs)
+    """
+    names = {}  # id of Variable or Node => name of its local
+    variables = {}  # variable name => name of its local
+    namespace = {'_undefined': _undefined}
+    statements = []
+    for node in _postorder(tree):
+        if isinstance(node, Variable):
+            if node.name not in variables:  # read where evaluators first read it, so that errors come in the same order
+                local = variables[node.name] = '_v%d' % len(variables)
+                statements.extend(['try:', '    %s = _variables[%r]' % (local, node.name),
+                                   'except (KeyError, TypeError):', '    _undefined(_variables, (%r,))' % node.name])
+            names[id(node)] = variables[node.name]
+        elif isinstance(node, Node):
+            operands = tuple(_operand_source(operand, names, namespace) for operand in node.operands)
+            template = _template(node.operator)
+            if template is not None:
+                operation = template % operands
+            else:
+                function = '_f%d' % len(namespace)
+                namespace[function] = node.operator.do_eval
+                operation = '%s(%s)' % (function, ', '.join(operands))
+            names[id(node)] = '_t%d' % len(statements)
+            statements.append('%s = %s' % (names[id(node)], operation))
+    lines = ['def _expression(_variables):']
+    lines.extend('    ' + statement for statement in statements)
+    lines.append('    return %s' % _operand_source(tree, names, namespace))
+    return '\n'.join(lines) + '\n', namespace
+
+
+def generate_function(tree):
+    """
+    :param tree: root Leaf, Variable or Node
+    :return: Python function computing the expression tree, taking the mapping of variables values as parameter
+    """
+    source, namespace = generate_source(tree)
+    code = _python_compile(source, '<calc>', 'exec', division.compiler_flag, True)
+    exec(code, namespace)
+    return namespace['_expression']
+
+
+class GeneratedExpression(CompiledExpression):
+    """
+    Compiled expression evaluated by a generated Python function, see generate_function().
+
+    Evaluation is a single call running straight line arithmetic, without walking nodes nor dispatching operators.
+    """
+
+    __slots__ = ('_function',)
+
+    def __init__(self, tree, source=None):
+        super(GeneratedExpression, self).__init__(tree, source)
+        self._function = generate_function(tree)
+
+    @classmethod
+    def _load(cls, codes, floats, constants, source=None):
+        compiled = super(GeneratedExpression, cls)._load(codes, floats, constants, source)
+        compiled._function = generate_function(compiled.tree)
+        return compiled
+
+    def evaluate(self, variables=None, limits=None):
+        if limits is not None:  # generated code has no hook for checks, run the postfix program instead
+            return super(GeneratedExpression, self).evaluate(variables, limits)
+        return self._function(variables)
+
+
+class CodegenEvaluator(EvaluatorBase):
+    """
+    Code generation backend.
+
+    The expression is parsed by the non recursive precedence climbing algorithm and turned into a Python function by
+    generate_function(). Generating the function costs much more than a single evaluation: this backend pays off
+    through compile() or a ParseCache, when the same expression is evaluated many times.
+    """
+
+    __slots__ = ()
+
+    compiled_class = GeneratedExpression
+
+    @classmethod
+    def parse(cls, tokexpr):
+        return IterativePrecedenceClimbingEvaluator.parse(tokexpr)
+
+    def evaluate(self):
+        return GeneratedExpression(self.parse(self.tokens)).evaluate(self.variables, self.limits)
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'evictions', 'maxsize', 'currsize'])
+
+
+def _limits_key(limits):
+    """
+    :return: part of a cache key for the limits checked before parsing, None without limits. Expressions compiled
+    within some limits are not served to callers of other limits, which they may exceed
+    """
+    if limits is None:
+        return None
+    return limits.max_tokens, limits.max_depth, limits.max_int_bits
+
+
+class ParseCache(object):
+    """
+    Size-bounded, thread-safe LRU cache of compiled expressions, keyed by expression string, evaluator class and limits.
+
+    :Example:
+    >>> cache = ParseCache(maxsize=1024)
+    >>> calc("2+2", cache=cache)
+    4
+    """
+
+    def __init__(self, maxsize=1024, backing=None):
+        """
+        Constructor
+        :param maxsize: maximum number of compiled expressions kept
+        :param backing: optional cache to fetch misses from, e.g. a DiskCache shared by processes
+        """
+        assert maxsize > 0, "Cache size must be positive"
+        self.maxsize = maxsize
+        self.backing = backing
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, expr, evaluator_class=PrecedenceClimbingEvaluator, limits=None):
+        """
+        Fetch the compiled form of an expression, compiling and storing it on miss
+        :param expr: String expression
+        :param evaluator_class: class name of the evaluator whose algorithm parses the expression
+        :param limits: optional Limits checked before parsing, part of the key
+        :return: CompiledExpression
+        :raise: InvalidTokenError, MalformedExpressionError or LimitExceededError, errors are not cached
+        """
+        key = (expr, evaluator_class, _limits_key(limits))
+        with self._lock:
+            compiled = self._data.pop(key, None)
+            if compiled is not None:
+                self._data[key] = compiled  # reinsert as most recently used
+                self._hits += 1
+                return compiled
+            self._misses += 1
+        # compile outside of the lock, so that other threads are not blocked meanwhile
+        if self.backing is not None:
+            compiled = self.backing.get(expr, evaluator_class, limits)
+        else:
+            compiled = compile(expr, evaluator_class, limits)
+        with self._lock:
+            if key not in self._data:
+                self._data[key] = compiled
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+                    self._evictions += 1
+        return compiled
+
+    def clear(self):
+        """Drop all compiled expressions and reset statistics"""
+        with self._lock:
+            self._data.clear()
+            self._hits = self._misses = self._evictions = 0
+
+    def info(self):
+        """
+        :return: CacheInfo statistics
+        """
+        with self._lock:
+            return CacheInfo(self._hits, self._misses, self._evictions, self.maxsize, len(self._data))
+
+    def __len__(self):
+        return len(self._data)
+
+
+##################################
+###         DISK CACHE         ###
+##################################
+
+_replace = getattr(os, 'replace', os.rename)  # os.replace() is Python 3.3+, rename() replaces files on POSIX
+
+
+class DiskCache(object):
+    """
+    Persistent cache of compiled expressions, in a directory shared by processes, so that cold processes load programs
+    instead of tokenizing and parsing them.
+
+    Each entry is a file named by a hash of the expression, the evaluator, the limits, the calc version and the Python
+    version, holding the compact program serialized with marshal. Entries are written to a temporary file first then
+    renamed, so that concurrent readers and writers only ever see complete files. Entries are stored in a directory per
+    calc and Python version: a new version never reads entries of another one, and removes them on its first eviction.
+
+    Files are touched on hit, evictions remove the least recently used ones once the directory holds more than maxbytes.
+    Operators are stored by token and arity, programs using an operator not registered in the loading process miss.
+
+    :Example:
+    >>> path = tempfile.mkdtemp()
+    >>> cache = ParseCache(backing=DiskCache(path))
+    >>> calc("2+2", cache=cache)
+    4
+    >>> import shutil
+    >>> shutil.rmtree(path)
+    """
+
+    _MAGIC = b'calc\x01'
+    _SUFFIX = '.calc'
+
+    def __init__(self, path, maxbytes=64 << 20):
+        """
+        Constructor
+        :param path: root directory of the cache, created if missing
+        :param maxbytes: size of the entries above which the least recently used ones are removed
+        """
+        assert maxbytes > 0, "Cache size must be positive"
+        self.root = path
+        self.maxbytes = maxbytes
+        self.path = os.path.join(path, '%s-py%d.%d' % (__version__, sys.version_info[0], sys.version_info[1]))
+        try:
+            os.makedirs(self.path)
+        except OSError:  # already exists, possibly created by another process meanwhile
+            if not os.path.isdir(self.path):
+                raise
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._size = sum(size for _, size, _ in self._entries())
+
+    def _file(self, expr, evaluator_class, limits=None):
+        key = '%s\0%s.%s\0%s' % (expr, evaluator_class.__module__, evaluator_class.__name__, __version__)
+        if limits is not None:
+            key += '\0%r' % (_limits_key(limits),)
+        return os.path.join(self.path, hashlib.sha1(key.encode('utf-8')).hexdigest() + self._SUFFIX)
+
+    def _entries(self, path=None):
+        """
+        :return: list of (mtime, size, path) of the entries of a directory, the one of this version by default
+        """
+        path = self.path if path is None else path
+        entries = []
+        for name in os.listdir(path):
+            if name.endswith(self._SUFFIX):
+                try:
+                    stat = os.stat(os.path.join(path, name))
+                except OSError:  # removed by another process meanwhile
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(path, name)))
+        return entries
+
+    @staticmethod
+    def _dump(expr, compiled):
+        operators = tuple((code, _OPERATORS_BY_CODE[code].token, _OPERATORS_BY_CODE[code].operands)
+                          for code in sorted(set(compiled._codes)) if code > _CODE_LOAD)
+        return marshal.dumps((expr, bytes(bytearray(compiled._codes)), tuple(compiled._floats), compiled._constants,
+                              operators))
+
+    @staticmethod
+    def _undump(data, expr, evaluator_class):
+        """
+        :return: CompiledExpression, None if the entry is of another expression or uses unknown operators
+        """
+        source, codes, floats, constants, operators = marshal.loads(data)
+        if source != expr:  # hash collision
+            return None
+        codes = array('B', bytearray(codes))
+        translation = {}
+        for code, token, operands in operators:
+            current = (UNARY_CODES if operands == 1 else BINARY_CODES).get(token)
+            if current is None:
+                return None
+            if current != code:
+                translation[code] = current
+        if translation:  # opcodes of registered operators depend on the order of registration
+            codes = array('B', [translation.get(code, code) for code in codes])
+        compiled_class = evaluator_class.compiled_class or CompiledExpression
+        return compiled_class._load(codes, array('d', floats) if floats else (), constants, expr)
+
+    def get(self, expr, evaluator_class=PrecedenceClimbingEvaluator, limits=None):
+        """
+        Fetch the compiled form of an expression, compiling and storing it on miss
+        :param expr: String expression
+        :param evaluator_class: class name of the evaluator whose algorithm parses the expression
+        :param limits: optional Limits checked before parsing, part of the key
+        :return: CompiledExpression
+        :raise: InvalidTokenError, MalformedExpressionError or LimitExceededError, errors are not cached
+        """
+        path = self._file(expr, evaluator_class, limits)
+        compiled = None
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            if data.startswith(self._MAGIC):
+                compiled = self._undump(data[len(self._MAGIC):], expr, evaluator_class)
+            if compiled is not None:
+                os.utime(path, None)
+        except (IOError, OSError):  # missing, or removed by another process meanwhile
+            pass
+        except (EOFError, ValueError, TypeError):  # corrupted
+            compiled = None
+        if compiled is not None:
+            with self._lock:
+                self._hits += 1
+            return compiled
+        with self._lock:
+            self._misses += 1
+        compiled = compile(expr, evaluator_class, limits)
+        self._store(path, expr, compiled)
+        return compiled
+
+    def _store(self, path, expr, compiled):
+        try:
+            data = self._MAGIC + self._dump(expr, compiled)
+        except ValueError:  # unmarshallable constant
+            return
+        try:
+            fd, temporary = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        except (IOError, OSError):
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            _replace(temporary, path)
+        except (IOError, OSError):  # e.g. full disk, or on Windows a file written by another process meanwhile
+            self._remove(temporary)
+            return
+        with self._lock:
+            self._size += len(data)
+            evict = self._size > self.maxbytes
+        if evict:
+            self._evict()
+
+    def _evict(self):
+        """
+        Remove entries of other versions, then least recently used entries down to 90% of maxbytes. The size of the
+        entries is counted again: other processes store and remove entries as well
+        """
+        for name in os.listdir(self.root):
+            other = os.path.join(self.root, name)
+            if other != self.path and os.path.isdir(other):
+                for _, _, path in self._entries(other):
+                    self._remove(path)
+        entries = sorted(self._entries())
+        size = sum(entry[1] for entry in entries)
+        evictions = 0
+        for _, entry_size, path in entries:
+            if size <= self.maxbytes * 0.9:
+                break
+            if self._remove(path):
+                evictions += 1
+            size -= entry_size
+        with self._lock:
+            self._size = size
+            self._evictions += evictions
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:  # removed by another process meanwhile
+            return False
+
+    def clear(self):
+        """Remove all entries of this version and reset statistics"""
+        for _, _, path in self._entries():
+            self._remove(path)
+        with self._lock:
+            self._size = 0
+            self._hits = self._misses = self._evictions = 0
+
+    def info(self):
+        """
+        :return: CacheInfo statistics of this process, with sizes in bytes
+        """
+        with self._lock:
+            return CacheInfo(self._hits, self._misses, self._evictions, self.maxbytes, self._size)
+
+
+##################################
+###           METRICS          ###
+##################################
+
+class Metrics(object):
+    """
+    Counters of calc() calls, collected while enabled with enable_metrics():
+    - time spent per phase: scan (tokenizing and validating tokens) and evaluate without cache, cache (lookup, and
+      compilation on miss) and evaluate with a ParseCache
+    - number of tokens scanned
+    - number of evaluations of each operator, for successful calls
+    - number of errors by exception type
+
+    :Example:
+    >>> metrics = enable_metrics()
+    >>> calc("2+2*3")
+    8
+    >>> metrics.snapshot()['operators']['Multiply']
+    1
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Set all counters to zero"""
+        with self._lock:
+            self._calls = 0
+            self._tokens = 0
+            self._phases = {}
+            self._operators = {}
+            self._errors = {}
+
+    def record(self, phases, tokens=0, operators=(), error=None):
+        """
+        Account for a calc() call
+        :param phases: mapping of phase names to seconds spent
+        :param tokens: number of tokens scanned
+        :param operators: operators evaluated, OperatorBase instances
+        :param error: exception raised by the call, if any
+        """
+        with self._lock:
+            self._calls += 1
+            self._tokens += tokens
+            for phase, seconds in phases.items():
+                self._phases[phase] = self._phases.get(phase, 0.) + seconds
+            for operator in operators:
+                name = operator.__class__.__name__
+                self._operators[name] = self._operators.get(name, 0) + 1
+            if error is not None:
+                name = error.__class__.__name__
+                self._errors[name] = self._errors.get(name, 0) + 1
+
+    def snapshot(self):
+        """
+        :return: dict of the current counters: calls, tokens, phases (seconds by phase), operators (evaluations by
+        operator class name), errors (count by exception class name)
+        """
+        with self._lock:
+            return {
+                'calls': self._calls,
+                'tokens': self._tokens,
+                'phases': dict(self._phases),
+                'operators': dict(self._operators),
+                'errors': dict(self._errors),
+            }
+
+    def to_prometheus(self, prefix='calc'):
+        """
+        :param prefix: prefix of metric names
+        :return: counters in Prometheus text exposition format
+        """
+        snapshot = self.snapshot()
+        lines = []
+
+        def counter(name, description, samples):
+            lines.append('# HELP %s_%s %s' % (prefix, name, description))
+            lines.append('# TYPE %s_%s counter' % (prefix, name))
+            lines.extend('%s_%s%s %r' % (prefix, name, labels, value) for labels, value in samples)
+
+        counter('calls_total', "Number of calc() calls.", [('', snapshot['calls'])])
+        counter('tokens_total', "Number of tokens scanned.", [('', snapshot['tokens'])])
+        counter('phase_seconds_total', "Time spent in each phase of calc().",
+                [('{phase="%s"}' % phase, seconds) for phase, seconds in sorted(snapshot['phases'].items())])
+        counter('operator_evaluations_total', "Number of evaluations of each operator.",
+                [('{operator="%s"}' % name, count) for name, count in sorted(snapshot['operators'].items())])
+        counter('errors_total', "Number of failed calc() calls, by exception type.",
+                [('{type="%s"}' % name, count) for name, count in sorted(snapshot['errors'].items())])
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """
+        :return: human readable report of the counters
+        """
+        snapshot = self.snapshot()
+
+        def items(counts, template):
+            return ', '.join(template % item for item in sorted(counts.items())) or 'none'
+
+        return '\n'.join([
+            'calls: %d, tokens: %d' % (snapshot['calls'], snapshot['tokens']),
+            'phases: ' + items(snapshot['phases'], '%s %.6f s'),
+            'operators: ' + items(snapshot['operators'], '%s %d'),
+            'errors: ' + items(snapshot['errors'], '%s %d'),
+        ])
+
+
+# Metrics collected by calc(), None while disabled so that the only cost of disabled metrics is a global lookup
+_metrics = None
+
+
+def enable_metrics():
+    """
+    Start collecting metrics of calc() calls of the current process
+    :return: Metrics being collected, the same ones if metrics were already enabled
+    """
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
+
+
+def disable_metrics():
+    """
+    Stop collecting metrics
+    :return: Metrics collected so far, None if metrics were not enabled
+    """
+    global _metrics
+    metrics, _metrics = _metrics, None
+    return metrics
+
+
+def get_metrics():
+    """
+    :return: Metrics being collected, None if metrics are disabled
+    """
+    return _metrics
+
+
+def _token_operators(tokens):
+    """Operators of a valid list of tokens, a - being unary where an operand is expected"""
+    operators = []
+    operand_expected = True
+    for kind, value, offset in tokens:
+        if kind in LEAF_KINDS or kind == ')':
+            operand_expected = False
+        elif kind != '(':
+            operators.append((UNARY_OPS if operand_expected else BINARY_OPS)[kind])
+            operand_expected = True
+    return operators
+
+
+def _measured_calc(metrics, expr, evaluator_class, cache, variables, limits):
+    """calc() accounting for the call in metrics"""
+    phases = {}
+    tokens = 0
+    operators = ()
+    phase = 'scan' if cache is None else 'cache'
+    start = default_timer()
+    try:
+        if cache is None:
+            tokenized = scan(expr)
+            tokens = len(tokenized)
+            phases[phase] = default_timer() - start
+            phase, start = 'evaluate', default_timer()
+            result = evaluator_class(tokenized, variables, limits).evaluate()
+            phases[phase] = default_timer() - start
+            operators = _token_operators(tokenized)
+        else:
+            compiled = cache.get(expr, evaluator_class, limits)
+            phases[phase] = default_timer() - start
+            phase, start = 'evaluate', default_timer()
+            result = compiled.evaluate(variables, limits)
+            phases[phase] = default_timer() - start
+            operators = [arg for code, arg in compiled.program if code == _UNARY or code == _BINARY]
+    except Exception as e:
+        phases[phase] = default_timer() - start
+        metrics.record(phases, tokens, error=e)
+        raise
+    metrics.record(phases, tokens, operators)
+    return result
+
+
+def calc(expr, evaluator_class=PrecedenceClimbingEvaluator, cache=None, variables=None, limits=None):
+    """
+    Do the whole work
+    :param expr: String expression
+    :param evaluator_class: class name of the evaluator to use for computation
+    :param cache: optional ParseCache, to skip tokenizing and parsing of already seen expressions
+    :param variables: mapping of variable names to their values
+    :param limits: optional Limits of the evaluation cost
+    :return: Evaluation result
+    """
+    if _metrics is not None:
+        return _measured_calc(_metrics, expr, evaluator_class, cache, variables, limits)
+    if cache is not None:
+        return cache.get(expr, evaluator_class, limits).evaluate(variables, limits)
+    return evaluator_class(scan(expr), variables, limits).evaluate()
+
+
+##################################
+###        BATCH & MAIN        ###
+##################################
+
+# Errors evaluating an expression may raise. RuntimeError covers too deeply nested expressions for recursive evaluators.
+CALC_ERRORS = (InvalidTokenError, MalformedExpressionError, LimitExceededError, ArithmeticError, ValueError,
+               RuntimeError)
+
+
+def evaluate_lines(lines, evaluator_class=PrecedenceClimbingEvaluator, cache=None, limits=None):
+    """
+    Evaluate a stream of expressions lazily, one per line
+    :param lines: iterable of expressions, e.g. an opened file
+    :param evaluator_class: class name of the evaluator to use for computation
+    :param cache: optional ParseCache
+    :param limits: optional Limits of each evaluation
+    :return: generator of results in input order. Lines that fail give their exception instead of a result
+    """
+    for line in lines:
+        try:
+            yield calc(line, evaluator_class, cache, limits=limits)
+        except CALC_ERRORS as e:
+            yield e
+
+
+# ParseCache of a calc_many() worker process, reused by all the chunks it evaluates
+_worker_cache = None
+
+
+def _init_worker(cache_size, cache_dir=None):
+    global _worker_cache
+    _worker_cache = ParseCache(cache_size, DiskCache(cache_dir) if cache_dir is not None else None)
+
+
+def _worker_calc(evaluator_class, limits, expr):
+    try:
+        return calc(expr, evaluator_class, _worker_cache, limits=limits)
+    except CALC_ERRORS as e:
+        return e
+
+
+def calc_many(expressions, evaluator_class=PrecedenceClimbingEvaluator, workers=None, chunksize=256,
+              cache_size=1024, limits=None, cache_dir=None):
+    """
+    Evaluate many expressions with a pool of processes, to use all cores.
+
+    Expressions are dispatched to worker processes by chunks, each worker keeping a ParseCache of its own. They are read
+    from the input by windows of a few chunks per worker, so that memory use does not depend on the input length.
+    :param expressions: iterable of expressions
+    :param evaluator_class: class name of the evaluator to use for computation
+    :param workers: number of worker processes, number of CPUs when None. 1 evaluates in the current process
+    :param chunksize: number of expressions sent to a worker at once
+    :param cache_size: size of each worker's ParseCache
+    :param limits: optional Limits of each evaluation
+    :param cache_dir: optional directory of a DiskCache shared by workers, and by later runs
+    :return: generator of results in input order. Expressions that fail give their exception instead of a result
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1:
+        cache = ParseCache(cache_size, DiskCache(cache_dir) if cache_dir is not None else None)
+        for result in evaluate_lines(expressions, evaluator_class, cache, limits):
+            yield result
+        return
+    function = partial(_worker_calc, evaluator_class, limits)
+    expressions = iter(expressions)
+    window = chunksize * workers * 4
+    pool = multiprocessing.Pool(workers, _init_worker, (cache_size, cache_dir))
+    try:
+        while True:
+            batch = list(islice(expressions, window))
+            if not batch:
+                break
+            for result in pool.imap(function, batch, chunksize):
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+FileStats = namedtuple('FileStats', ['lines', 'bytes', 'total_bytes', 'seconds'])
+
+
+def _line_ranges(data, range_bytes):
+    """
+    Split a buffer into ranges of about range_bytes bytes, ending just after a newline
+    :param data: bytes-like, e.g. a mmap
+    :param range_bytes: size of the ranges
+    :return: generator of (start, end) offsets
+    """
+    size = len(data)
+    start = 0
+    while start < size:
+        end = start + range_bytes
+        if end >= size:
+            end = size
+        else:
+            newline = data.find(b'\n', end - 1)
+            end = size if newline < 0 else newline + 1
+        yield start, end
+        start = end
+
+
+def _evaluate_range(path, evaluator_class, limits, bounds, cache=None, npy=False):
+    """
+    Evaluate the lines of a byte range of a file, memory-mapped so that only that range is read
+    :return: (results, lines): results as UTF-8 lines, or as bytes of records of RESULTS_DTYPE when npy, number of lines
+    """
+    start, end = bounds
+    cache = cache if cache is not None else _worker_cache
+    output = []
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            while start < end:
+                newline = data.find(b'\n', start, end)
+                stop = end if newline < 0 else newline
+                try:
+                    result = calc(data[start:stop].decode('utf-8'), evaluator_class, cache, limits=limits)
+                except CALC_ERRORS as e:
+                    result = e
+                output.append(result)
+                start = stop + 1
+        finally:
+            data.close()
+    if npy:
+        return results_records(output).tobytes(), len(output)
+    output = [format_result(result) for result in output]
+    output.append('')
+    return '\n'.join(output).encode('utf-8'), len(output) - 1
+
+
+def evaluate_file(path, output, evaluator_class=PrecedenceClimbingEvaluator, workers=None, range_bytes=8 << 20,
+                  cache_size=1024, limits=None, cache_dir=None, progress=None, npy=False):
+    """
+    Evaluate a file of expressions, one per line, writing results to another file, one per line in the same order.
+
+    The input is memory-mapped and split into newline-aligned byte ranges. Each worker process maps the file too and
+    evaluates its ranges straight from the mapping, so that the file is never read whole into memory.
+    :param path: path of the file of expressions, UTF-8
+    :param output: binary file object results are written to, formatted as format_result() does
+    :param evaluator_class: class name of the evaluator to use for computation
+    :param workers: number of worker processes, number of CPUs when None. 1 evaluates in the current process
+    :param range_bytes: size of the byte ranges handed to workers
+    :param cache_size: size of each worker's ParseCache
+    :param limits: optional Limits of each evaluation
+    :param cache_dir: optional directory of a DiskCache shared by workers, and by later runs
+    :param progress: optional callable, called with the FileStats so far after each range is written
+    :param npy: write results as a .npy file of records of RESULTS_DTYPE rather than as lines, output must be seekable
+    :return: FileStats of the whole file
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    started = default_timer()
+    lines = done = 0
+    pool = None
+    writer = NpyResultsWriter(output) if npy else None
+    with open(path, 'rb') as f:
+        total = os.fstat(f.fileno()).st_size
+        if total == 0:  # empty files cannot be mapped
+            if writer is not None:
+                writer.close()
+            return FileStats(0, 0, 0, default_timer() - started)
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        ranges = _line_ranges(data, range_bytes)
+        if workers <= 1:
+            cache = ParseCache(cache_size, DiskCache(cache_dir) if cache_dir is not None else None)
+            results = (_evaluate_range(path, evaluator_class, limits, bounds, cache, npy) + (bounds,)
+                       for bounds in ranges)
+        else:
+            function = partial(_evaluate_range, path, evaluator_class, limits, npy=npy)
+            pool = multiprocessing.Pool(workers, _init_worker, (cache_size, cache_dir))
+            windows = iter(lambda: list(islice(ranges, workers * 4)), [])
+            results = (result + (bounds,) for window in windows
+                       for result, bounds in zip(pool.imap(function, window), window))
+        for text, count, (start, end) in results:
+            if writer is not None:
+                writer.write_records(text, count)
+            else:
+                output.write(text)
+            lines += count
+            done += end - start
+            if progress is not None:
+                progress(FileStats(lines, done, total, default_timer() - started))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        data.close()
+    if writer is not None:
+        writer.close()
+    return FileStats(lines, done, total, default_timer() - started)
+
+
+def format_progress(stats):
+    """
+    :param stats: FileStats
+    :return: printable line for the progress of evaluate_file()
+    """
+    seconds = stats.seconds or 1e-9
+    return '%5.1f%% %d lines %.1f MB/s %d lines/s' % (
+        100. * stats.bytes / (stats.total_bytes or 1), stats.lines, stats.bytes / seconds / 1e6, stats.lines / seconds)
+
+
+# Operators of chains evaluated by chunks, by operator class: the operators of the same chain
+_CHAIN_OPERATORS = {Plus: (Plus, Minus), Minus: (Plus, Minus), Multiply: (Multiply,)}
+
+
+def _chain(tree):
+    """
+    Split the top-level chain of additions and subtractions, or of multiplications, of an expression tree
+    :param tree: root Leaf, Variable or Node
+    :return: (operators, operands) from left to right: operators[i] applies the value so far and operands[i], the first
+    operator is None. None if the tree is not such a chain
+    """
+    if not isinstance(tree, Node) or type(tree.operator) not in _CHAIN_OPERATORS:
+        return None
+    group = _CHAIN_OPERATORS[type(tree.operator)]
+    operators = []
+    operands = []
+    node = tree
+    while isinstance(node, Node) and type(node.operator) in group:
+        operators.append(node.operator)
+        operands.append(node.operands[1])
+        node = node.operands[0]
+    operators.append(None)
+    operands.append(node)
+    return operators[::-1], operands[::-1]
+
+
+def _evaluate_chain_chunk(additive, variables, limits, chunk):
+    """
+    Evaluate a chunk of the operands of a chain
+    :param additive: True for a chain of additions and subtractions, False for multiplications
+    :param chunk: list of (negated, codes, floats, constants): whether the operand is subtracted, its compact program
+    :return: (values, exact, error): values of the operands up to the first error, result of the chunk when all are
+    integers and their size is not limited, or None, and the error or None
+    """
+    values = []
+    for negated, codes, floats, constants in chunk:
+        try:
+            values.append(CompiledExpression._load(codes, floats, constants).evaluate(variables, limits))
+        except CALC_ERRORS as e:
+            return values, None, e
+    exact = None
+    if (limits is None or limits.max_int_bits is None) and all(type(value) in _INTEGER_TYPES for value in values):
+        if additive:
+            exact = sum(-value if negated else value for (negated, _, _, _), value in zip(chunk, values))
+        else:
+            exact = 1
+            for value in values:
+                exact *= value
+    return values, exact, None
+
+
+def calc_parallel(expr, evaluator_class=PrecedenceClimbingEvaluator, variables=None, limits=None, workers=None,
+                  min_operands=4096, chunk_operands=None):
+    """
+    Evaluate a long flat expression, such as a1+a2+...+aN or a long product, over a pool of processes.
+
+    The top-level chain of additions and subtractions, or of multiplications, is split into chunks of operands
+    evaluated by workers. Their values are then combined from left to right, so that results, including int or float
+    types and floats rounding, are the same as calc() gives. Integer chunks, whose operations are exact, are combined
+    whole while the value so far is an integer, e.g. long products of large integers are computed by chunks in parallel.
+    :param expr: String expression
+    :param evaluator_class: class name of the evaluator whose algorithm parses the expression
+    :param variables: mapping of variable names to their values
+    :param limits: optional Limits of the evaluation cost
+    :param workers: number of worker processes, number of CPUs when None. 1 evaluates in the current process
+    :param min_operands: shorter chains are evaluated in the current process
+    :param chunk_operands: number of operands sent to a worker at once, to get 4 chunks per worker when None
+    :return: Evaluation result
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    tokens = scan(expr)
+    if limits is not None:
+        limits.check_tokens(tokens)
+    tree = evaluator_class.parse(tokens)
+    chain = _chain(tree)
+    if workers <= 1 or chain is None or len(chain[1]) < min_operands:
+        return CompiledExpression(tree, expr).evaluate(variables, limits)
+    operators, operands = chain
+    additive = not isinstance(operators[1], Multiply)
+    if chunk_operands is None:
+        chunk_operands = -(-len(operands) // (workers * 4))
+    chunks = []
+    for start in range(0, len(operands), chunk_operands):
+        chunk = []
+        for operator, operand in zip(operators[start:start + chunk_operands], operands[start:start + chunk_operands]):
+            compiled = CompiledExpression(operand)
+            chunk.append((isinstance(operator, Minus), compiled._codes, compiled._floats, compiled._constants))
+        chunks.append(chunk)
+    result = None
+    position = 0  # of the next operand
+    pool = multiprocessing.Pool(min(workers, len(chunks)))
+    try:
+        for values, exact, error in pool.imap(partial(_evaluate_chain_chunk, additive, variables, limits), chunks):
+            if exact is not None and (position == 0 or type(result) in _INTEGER_TYPES):
+                result = exact if position == 0 else result + exact if additive else result * exact
+                position += len(values)
+            else:
+                for value in values:
+                    operator = operators[position]
+                    if operator is None:
+                        result = value
+                    else:
+                        result = operator.eval(result, value) if limits is None else \
+                            limits.eval(operator, (result, value))
+                    position += 1
+            if error is not None:
+                raise error
+    finally:
+        pool.terminate()
+        pool.join()
+    return result
+
+
+# Prefix of the names of the variables standing for literals in templates, the scanner never gives such names
+_LITERAL_PREFIX = '#'
+# Operators whose NumPy evaluation gives Python's results, as long as _vectorizable() holds. Not Pow: NumPy's floats
+# powers may differ from Python's in the last bit
+_VECTORIZED_OPERATORS = (Plus, Minus, Multiply, Divide, UnaryMinus)
+# Largest absolute int64 value of vectorized integer operations, with a margin for the rounding of bounds
+_MAX_VECTOR_INT = 2 ** 62
+# Smallest group of expressions evaluated with NumPy, smaller ones are faster evaluated one by one
+_MIN_VECTOR_ROWS = 8
+# Number of lines grouped by template at once in batch mode
+_TEMPLATES_WINDOW = 1 << 16
+
+
+def template(expr):
+    """
+    Split an expression into its template and its numbers literals, e.g. "2*(x+1.5)" into the template of "#0*(x+#1)"
+    and the literals [2, 1.5]. Only the literals are cast: the template is neither scanned nor validated.
+    :param expr: expression string
+    :return: (key, literals): key is hashable, the same for expressions differing only by the values of their
+    literals, not by their types. Literals are int, float or big for ints beyond 64 bits
+    """
+    parts = _LITERAL_RE.split(expr)
+    kinds = []
+    literals = []
+    for index in range(1, len(parts), 3):
+        if parts[index] is not None:
+            value = _int(parts[index])
+            kinds.append('int' if value <= _MAX_VECTOR_INT else 'big')
+        else:
+            value = float(parts[index + 1])
+            kinds.append('float')
+        literals.append(value)
+    return (tuple(parts[::3]), tuple(kinds)), literals
+
+
+def _compile_template(expr, evaluator_class):
+    """
+    Compile the template of an expression, with its literals replaced by the variables #0, #1...
+    :return: CompiledExpression, None if scan() does not give the literals of template() as numbers tokens
+    :raise: InvalidTokenError, MalformedExpressionError
+    """
+    tokens = scan(expr)
+    names = dict((match.start(), '%s%d' % (_LITERAL_PREFIX, index))
+                 for index, match in enumerate(_LITERAL_RE.finditer(expr)))
+    template_tokens = [Token(NAME, names[token.offset], token.offset)
+                       if token.kind == NUMBER and token.offset in names else token for token in tokens]
+    if sum(1 for token in tokens if token.kind == NUMBER and token.offset in names) != len(names):
+        return None
+    return (evaluator_class.compiled_class or CompiledExpression)(evaluator_class.parse(template_tokens), expr)
+
+
+def _vectorizable(compiled, bounds):
+    """
+    Tell whether NumPy evaluation of a compiled template gives the results of Python's. Floats overflows, invalid
+    operations and divisions of finite values by zero raise within numpy.errstate(all='raise'), but int64 operations
+    overflow silently: they are checked from the bounds of their operands. Ints divisions must be exact in float64.
+    :param compiled: CompiledExpression of the template
+    :param bounds: mapping of the variables of the template to the largest absolute value of their column for ints,
+    None for finite floats
+    :return: True if the template can be evaluated with NumPy
+    """
+    stack = []
+    for code, arg in compiled.program:
+        if code == _LOAD:
+            bound = bounds[arg]
+        elif code == _PUSH:
+            if isinstance(arg, _INTEGER_TYPES):
+                bound = abs(arg)
+            elif numpy.isfinite(arg):
+                bound = None
+            else:  # inf / 0 would not raise
+                return False
+        elif not isinstance(arg, _VECTORIZED_OPERATORS):
+            return False
+        elif code == _BINARY:
+            right = stack.pop()
+            left = stack.pop()
+            if left is None or right is None:  # float operation
+                bound = None
+            elif isinstance(arg, (Plus, Minus)):
+                bound = left + right
+            elif isinstance(arg, Multiply):
+                bound = left * right
+            elif isinstance(arg, Divide) and max(left, right) <= _MAX_EXACT_INT:
+                bound = None
+            else:
+                return False
+        else:  # unary minus, e.g. of -2 ** 63 which int64 cannot negate
+            bound = stack.pop()
+        if bound is not None and bound > _MAX_VECTOR_INT:
+            return False
+        stack.append(bound)
+    return True
+
+
+def _evaluate_template(compiled, kinds, rows, variables):
+    """
+    Evaluate a compiled template for rows of literals at once with NumPy
+    :param compiled: CompiledExpression of the template
+    :param kinds: kinds of the literals of the template, as in template() keys
+    :param rows: lists of literals
+    :param variables: mapping of other variable names to their values
+    :return: list of results, None if the template cannot be evaluated with NumPy or raised: the caller should then
+    evaluate rows one by one to get Python's results or errors
+    """
+    columns = {}
+    bounds = {}
+    for index, (kind, column) in enumerate(zip(kinds, zip(*rows))):
+        name = '%s%d' % (_LITERAL_PREFIX, index)
+        if kind == 'int':
+            columns[name] = numpy.array(column, numpy.int64)
+            bounds[name] = max(abs(value) for value in column)
+        elif kind == 'big':
+            return None
+        else:
+            columns[name] = numpy.array(column, numpy.float64)
+            if not numpy.isfinite(columns[name]).all():
+                return None
+            bounds[name] = None
+    for name in compiled.variables:
+        if name not in columns:
+            value = variables.get(name) if variables is not None else None
+            if type(value) is float and numpy.isfinite(value):
+                bounds[name] = None
+            elif type(value) in _INTEGER_TYPES and abs(value) <= _MAX_VECTOR_INT:
+                bounds[name] = abs(value)
+            else:  # undefined, or a value of another type
+                return None
+            columns[name] = value
+    return _evaluate_vectorized(compiled, columns, bounds)
+
+
+def _evaluate_vectorized(compiled, columns, bounds):
+    """
+    Evaluate a compiled expression over columns with NumPy, if it gives the same results as Python
+    :param columns: mapping of the variables to int64 or float64 arrays, or to scalars
+    :param bounds: mapping of the variables to bounds, as _vectorizable() takes them
+    :return: list of results, None if the expression cannot be evaluated with NumPy or raised
+    """
+    if not _vectorizable(compiled, bounds):
+        return None
+    try:
+        with numpy.errstate(all='raise'):
+            return compiled.evaluate(columns).tolist()
+    except (ArithmeticError, ValueError):  # e.g. a division by zero in some row
+        return None
+
+
+def evaluate_templates(expressions, evaluator_class=PrecedenceClimbingEvaluator, variables=None, limits=None):
+    """
+    Evaluate a batch of expressions grouped by template, for batches of a few formulas with varying literals.
+
+    Expressions differing only by the values of their literals, e.g. "a*(1+2)-3^2" and "a*(4+5)-6^2", share a template
+    where literals are variables. Expressions are split by a regular expression instead of being scanned, each template
+    is parsed once, and evaluated once for all the expressions of its group with NumPy when available and when NumPy
+    gives the same results as Python, e.g. without int64 overflow. Other groups are evaluated one expression at a time,
+    from their compiled template.
+    :param expressions: list of expressions
+    :param evaluator_class: class name of the evaluator whose algorithm parses the templates
+    :param variables: mapping of variable names to their values, shared by all the expressions
+    :param limits: optional Limits of each evaluation, then expressions are scanned each and NumPy is not used
+    :return: list of results in input order. Expressions that fail give their exception instead of a result
+    """
+    results = [None] * len(expressions)
+    groups = OrderedDict()  # key => (indexes, rows of literals)
+    for index, expr in enumerate(expressions):
+        key, literals = template(expr)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = ([], [])
+        group[0].append(index)
+        group[1].append(literals)
+
+    for key, (indexes, rows) in groups.items():
+        try:
+            compiled = _compile_template(expressions[indexes[0]], evaluator_class)
+        except CALC_ERRORS:
+            compiled = None
+        if compiled is None:  # e.g. malformed: evaluate expressions one by one, for their own error messages
+            for index in indexes:
+                try:
+                    results[index] = calc(expressions[index], evaluator_class, variables=variables, limits=limits)
+                except CALC_ERRORS as e:
+                    results[index] = e
+            continue
+        values = None
+        if numpy is not None and limits is None and rows[0] and len(rows) >= _MIN_VECTOR_ROWS:
+            values = _evaluate_template(compiled, key[1], rows, variables)
+        if values is not None:
+            for index, value in zip(indexes, values):
+                results[index] = value
+            continue
+        names = ['%s%d' % (_LITERAL_PREFIX, i) for i in range(len(rows[0]))]
+        row_variables = dict(variables) if variables is not None else {}
+        for index, row in zip(indexes, rows):
+            row_variables.update(zip(names, row))
+            try:
+                if limits is not None:
+                    limits.check_tokens(scan(expressions[index]))
+                results[index] = compiled.evaluate(row_variables, limits)
+            except CALC_ERRORS as e:
+                results[index] = e
+    return results
+
+
+##################################
+###        COLUMNAR I/O        ###
+##################################
+
+# Kinds of results of .npy results records
+RESULT_INT = 0
+RESULT_FLOAT = 1
+RESULT_ERROR = 2
+RESULT_OTHER = 3  # number held neither by int64 nor by float64, e.g. an int of more than 64 bits
+# Record of a result: its kind, its value in the column of its kind, 0 or nan in the other one
+RESULTS_DTYPE = numpy.dtype([('kind', 'u1'), ('int', '<i8'), ('float', '<f8')]) if numpy is not None else None
+_NPY_HEADER_SIZE = 128  # fixed, so that the header is rewritten in place once rows are counted
+_MIN_INT64 = -2 ** 63
+_MAX_INT64 = 2 ** 63 - 1
+
+
+def results_records(results):
+    """
+    Convert results to records, int and float results staying apart
+    :param results: iterable of results, or exceptions
+    :return: NumPy array of RESULTS_DTYPE
+    """
+    if numpy is None:
+        raise ImportError("results_records() requires NumPy")
+    kinds = []
+    ints = []
+    floats = []
+    nan = float('nan')
+    for result in results:
+        kind = type(result)
+        if kind is float:
+            kinds.append(RESULT_FLOAT)
+            ints.append(0)
+            floats.append(result)
+        elif kind in _INTEGER_TYPES and _MIN_INT64 <= result <= _MAX_INT64:
+            kinds.append(RESULT_INT)
+            ints.append(result)
+            floats.append(nan)
+        else:
+            kinds.append(RESULT_ERROR if isinstance(result, Exception) else RESULT_OTHER)
+            ints.append(0)
+            floats.append(nan)
+    records = numpy.empty(len(kinds), RESULTS_DTYPE)
+    records['kind'] = kinds
+    records['int'] = ints
+    records['float'] = floats
+    return records
+
+
+def _npy_header(rows):
+    """:return: header of a .npy file of rows records of RESULTS_DTYPE, _NPY_HEADER_SIZE bytes long"""
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (
+        numpy.lib.format.dtype_to_descr(RESULTS_DTYPE), rows)
+    magic = numpy.lib.format.magic(1, 0)
+    header = header.ljust(_NPY_HEADER_SIZE - len(magic) - 3) + '\n'
+    return magic + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+class NpyResultsWriter(object):
+    """
+    Writes results to a .npy file of records of RESULTS_DTYPE, as they come: the number of rows is written last.
+    numpy.load(path, mmap_mode='r') maps the results without copying them. Requires NumPy, so the example is skipped.
+
+    :Example:
+    >>> with tempfile.TemporaryFile() as f:  # doctest: +SKIP
+    ...     with NpyResultsWriter(f) as writer:
+    ...         writer.write([2, 2.5, ZeroDivisionError()])
+    ...     _ = f.seek(0)
+    ...     print(numpy.load(f)['kind'].tolist())
+    [0, 1, 2]
+    """
+
+    def __init__(self, output):
+        """
+        Constructor
+        :param output: binary file object, seekable
+        """
+        if numpy is None:
+            raise ImportError("NpyResultsWriter requires NumPy")
+        self.output = output
+        self.rows = 0
+        self._start = output.tell()
+        output.write(_npy_header(0))
+
+    def write(self, results):
+        """
+        :param results: iterable of results, or exceptions
+        """
+        records = results_records(results)
+        self.write_records(records.tobytes(), len(records))
+
+    def write_records(self, data, rows):
+        """
+        :param data: bytes of records of RESULTS_DTYPE
+        :param rows: number of records
+        """
+        self.output.write(data)
+        self.rows += rows
+
+    def close(self):
+        """Write the number of rows in the header"""
+        end = self.output.tell()
+        self.output.seek(self._start)
+        self.output.write(_npy_header(self.rows))
+        self.output.seek(end)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def write_results(results, output, npy=False):
+    """
+    Write results to a binary file object
+    :param results: iterable of results, or exceptions
+    :param output: binary file object
+    :param npy: True for .npy records of RESULTS_DTYPE, False for UTF-8 lines formatted by format_result()
+    """
+    if npy:
+        results = iter(results)
+        with NpyResultsWriter(output) as writer:
+            for window in iter(lambda: list(islice(results, _TEMPLATES_WINDOW)), []):
+                writer.write(window)
+    else:
+        output.writelines((format_result(result) + '\n').encode('utf-8') for result in results)
+
+
+def read_columns(path):
+    """
+    Read columns of variables from a NumPy file: a .npz file of named arrays, or a .npy file of a structured array
+    whose fields are the variables. A .npy file is memory-mapped rather than read.
+    :param path: path of the file
+    :return: dict of variable names to arrays, of the same length
+    :raise: ValueError if the file does not hold such columns
+    """
+    if numpy is None:
+        raise ImportError("read_columns() requires NumPy")
+    data = numpy.load(path, mmap_mode='r')
+    if isinstance(data, numpy.ndarray):
+        if data.dtype.names is None or data.ndim != 1:
+            raise ValueError("%s does not hold a structured array, whose fields would be variables" % path)
+        columns = dict((name, data[name]) for name in data.dtype.names)
+    else:
+        with data:
+            columns = dict((name, data[name]) for name in data.files)
+    if len(set(len(column) for column in columns.values())) > 1:
+        raise ValueError("columns of %s are not of the same length" % path)
+    return columns
+
+
+def evaluate_rows(expr, columns, evaluator_class=PrecedenceClimbingEvaluator, limits=None):
+    """
+    Evaluate an expression for each row of columns of variables, with the results calc() gives for each row.
+
+    The expression is parsed once, and evaluated once for all the rows with NumPy when available and when NumPy
+    gives the same results as Python, as evaluate_templates() does. Other rows are evaluated one by one.
+    :param expr: String expression
+    :param columns: mapping of variable names to sequences of values of the same length, e.g. from read_columns()
+    :param evaluator_class: class name of the evaluator whose algorithm parses the expression
+    :param limits: optional Limits of each evaluation, then NumPy is not used
+    :return: list of results, one per row. Rows that fail give their exception instead of a result
+    :raise: InvalidTokenError, MalformedExpressionError or LimitExceededError if the expression cannot be parsed
+    """
+    compiled = compile(expr, evaluator_class, limits)
+    size = len(next(iter(columns.values()))) if columns else 1
+    names = [name for name in compiled.variables if name in columns]
+    if numpy is not None and limits is None and names and len(names) == len(compiled.variables) and \
+            size >= _MIN_VECTOR_ROWS:
+        arrays = {}
+        bounds = {}
+        for name in names:
+            column = numpy.asarray(columns[name])
+            if column.dtype.kind == 'i' or column.dtype.kind == 'u' and column.dtype.itemsize < 8:
+                arrays[name] = column.astype(numpy.int64)
+                bounds[name] = max(abs(int(arrays[name].max())), abs(int(arrays[name].min())))
+            elif column.dtype.kind == 'f' and numpy.isfinite(column).all():
+                arrays[name] = column.astype(numpy.float64)
+                bounds[name] = None
+            else:
+                break
+        else:
+            values = _evaluate_vectorized(compiled, arrays, bounds)
+            if values is not None:
+                return values
+    lists = [(name, numpy.asarray(columns[name]).tolist() if numpy is not None else list(columns[name]))
+             for name in names]
+    results = []
+    for row in range(size):
+        try:
+            results.append(compiled.evaluate(dict((name, values[row]) for name, values in lists), limits))
+        except CALC_ERRORS as e:
+            results.append(e)
+    return results
+
+
+def format_result(result):
+    """
+    :param result: evaluation result, or exception
+    :return: printable line for result
+    """
+    if isinstance(result, Exception):
+        return 'error: %s: %s' % (result.__class__.__name__, result)
+    try:
+        return str(result)
+    except ValueError as e:  # int of more digits than Python 3.11+ converts to a string
+        return format_result(e)
+
+
+def format_diagnostic(diagnostic):
+    """
+    :param diagnostic: check() result
+    :return: printable line for diagnostic
+    """
+    if diagnostic is None:
+        return 'ok'
+    return 'error: %d: %s: %s' % diagnostic
+
+
+# Evaluators selectable from the command line
+EVALUATORS = {
+    'pc': PrecedenceClimbingEvaluator,
+    'sh': ShuntingYardEvaluator,
+    'ipc': IterativePrecedenceClimbingEvaluator,
+    'ish': IterativeShuntingYardEvaluator,
+    'cg': CodegenEvaluator,
+    'pratt': PrattEvaluator,
+}
+
+
+def main(argv=None):
+    """
+    Command line entry point
+    :param argv: command line arguments, sys.argv[1:] when None
+    """
+    parser = argparse.ArgumentParser(
+        description="A simple calculator for infixed mathematical expressions. Supports operators +-/*^")
+    parser.add_argument('expression', nargs='*', help="Expression to evaluate")
+    parser.add_argument('-a', '--algo',
+                        help="Choose evaluator algorithm: pc for Precedence Climbing (default), sh for Shunting Yard, "
+                             "ipc or ish for their non recursive variants, for deeply nested expressions, pratt "
+                             "for Pratt parsing, cg for Python code generation",
+                        choices=sorted(EVALUATORS), default='pc')
+    parser.add_argument('-f', '--file', type=argparse.FileType('r'),
+                        help="Batch mode: evaluate expressions of FILE, one per line, - for standard input. Results "
+                             "are written one per line in the same order, failing lines give an error line")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Number of worker processes, 0 for one per CPU (default 1). Batch mode spreads lines "
+                             "over them, a single expression the operands of its long top-level chain of + and -, "
+                             "or of *")
+    parser.add_argument('-o', '--output',
+                        help="Batch mode: write results to file OUTPUT. FILE is then memory-mapped and split into byte "
+                             "ranges evaluated by the --jobs workers, for very large files. Also takes the results "
+                             "of --columns")
+    parser.add_argument('--npy', action='store_true',
+                        help="Write the results to OUTPUT as a NumPy .npy array of records: kind (0 int, 1 float, "
+                             "2 error, 3 other number), int64 and float64 value, to be loaded without copy")
+    parser.add_argument('--columns',
+                        help="Evaluate the expression for each row of the variables of COLUMNS, a NumPy .npz file of "
+                             "named arrays or .npy file of a structured array, with NumPy when available")
+    parser.add_argument('--progress', action='store_true',
+                        help="Batch mode with --output: report progress and throughput to standard error")
+    parser.add_argument('--templates', action='store_true',
+                        help="Batch mode: group expressions differing only in their numbers, parse each group once and "
+                             "evaluate it at once, with NumPy when available")
+    parser.add_argument('--cache-dir',
+                        help="Batch mode: keep compiled expressions in directory CACHE_DIR, shared by processes and "
+                             "runs")
+    parser.add_argument('--stream', action='store_true',
+                        help="Evaluate FILE as one single expression, scanned and evaluated as it is read, so that it "
+                             "is never held whole in memory")
+    parser.add_argument('--max-tokens', type=int, help="Fail expressions of more tokens than MAX_TOKENS")
+    parser.add_argument('--max-depth', type=int,
+                        help="Fail expressions nesting parenthesis and unary operators deeper than MAX_DEPTH")
+    parser.add_argument('--max-int-bits', type=int,
+                        help="Fail expressions computing integers of more than MAX_INT_BITS bits")
+    parser.add_argument('--stats', action='store_true',
+                        help="Report phase timings, token, operator and error counts to standard error")
+    parser.add_argument('--check', action='store_true',
+                        help="Check the syntax of expressions without evaluating them: write ok, or the character "
+                             "offset, kind and message of the first error")
+    args = parser.parse_args(argv)
+    try:
+        evaluator_class = EVALUATORS[args.algo]
+        limits = None
+        if args.max_tokens is not None or args.max_depth is not None or args.max_int_bits is not None:
+            limits = Limits(args.max_tokens, args.max_depth, args.max_int_bits)
+        if args.stats:
+            if args.jobs != 1:
+                parser.error("--stats counts evaluations of the current process only, it requires --jobs 1")
+            if args.templates or args.columns is not None or args.stream or args.check:
+                parser.error("--stats counts calc() evaluations, --templates, --columns, --stream and --check "
+                             "bypass it")
+            enable_metrics()
+        if args.templates and args.jobs != 1:
+            parser.error("--templates evaluates in the current process, it requires --jobs 1")
+        if args.columns is not None and (not args.expression or args.file is not None or args.check or args.jobs != 1):
+            parser.error("--columns evaluates one expression in the current process, without --file, --check or --jobs")
+        if args.output is not None and args.columns is None and \
+                (args.file is None or args.file is sys.stdin or args.templates or args.check):
+            parser.error("--output memory-maps the input, it requires --columns or a --file other than standard input, "
+                         "without --templates or --check")
+        if args.npy and args.output is None:
+            parser.error("--npy requires --output")
+        if args.progress and (args.output is None or args.columns is not None):
+            parser.error("--progress requires --output of a --file")
+        if args.stream and (args.file is None or args.templates or args.check or args.output is not None or
+                            args.jobs != 1 or evaluator_class is CodegenEvaluator):
+            parser.error("--stream evaluates one --file in the current process, without --templates, --check, "
+                         "--output, --jobs or --algo cg")
+        if args.check:
+            expressions = args.file if args.file is not None else [''.join(args.expression)]
+            sys.stdout.writelines(format_diagnostic(diagnostic) + '\n' for diagnostic in validate_many(expressions))
+            sys.stdout.flush()
+        elif args.stream:
+            print(calc_stream(args.file, evaluator_class, limits=limits))
+        elif args.columns is not None:
+            results = evaluate_rows(''.join(args.expression), read_columns(args.columns), evaluator_class, limits)
+            if args.output is not None:
+                with open(args.output, 'wb') as output:
+                    write_results(results, output, args.npy)
+            else:
+                sys.stdout.writelines(format_result(result) + '\n' for result in results)
+                sys.stdout.flush()
+        elif args.file is not None and args.templates:
+            windows = iter(lambda: list(islice(args.file, _TEMPLATES_WINDOW)), [])
+            results = (result for window in windows
+                       for result in evaluate_templates(window, evaluator_class, limits=limits))
+            sys.stdout.writelines(format_result(result) + '\n' for result in results)
+            sys.stdout.flush()
+        elif args.output is not None:
+            args.file.close()
+            progress = None
+            if args.progress:
+                progress = lambda stats: sys.stderr.write('\r' + format_progress(stats))
+            with open(args.output, 'wb') as output:
+                evaluate_file(args.file.name, output, evaluator_class, workers=args.jobs or None, limits=limits,
+                              cache_dir=args.cache_dir, progress=progress, npy=args.npy)
+            if args.progress:
+                sys.stderr.write('\n')
+        elif args.file is not None:
+            results = calc_many(args.file, evaluator_class, workers=args.jobs or None, limits=limits,
+                                cache_dir=args.cache_dir)
+            sys.stdout.writelines(format_result(result) + '\n' for result in results)
+            sys.stdout.flush()
+        elif args.expression and args.jobs != 1:
+            print(calc_parallel(''.join(args.expression), evaluator_class, limits=limits, workers=args.jobs or None))
+        elif args.expression:
+            print(calc(''.join(args.expression), evaluator_class, limits=limits))
+        else:
+            parser.error("an expression or a --file is required")
+    finally:
+        if args.file is not None and args.file is not sys.stdin:
+            args.file.close()
+    if args.stats:
+        sys.stderr.write(disable_metrics().summary() + '\n')
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
@@ -1,12 +1,325 @@
+"""
+    Calculator benchmarks
+    =====================
+
+    Measure every evaluator of calc.EVALUATORS over generated expressions of controlled size, nesting depth and
+    operator mix, and over fixed reference expressions:
+    - throughput and per-call latency percentiles of calc()
+    - separate timings of its phases: tokenize (scan), validate (parse) and evaluate (of the compiled expression)
+    - peak memory allocated by one calc() call, when tracemalloc is available (Python 3.4+)
+    - memory held per token and per compiled expression, compact forms against lists and tuples
+
+    Results can be written as JSON, and compared to the JSON of a previous run to flag regressions.
+
+    :Example:
+    $ python perfs.py --output baseline.json
+    $ python perfs.py --baseline baseline.json --threshold 0.1
+"""
+from __future__ import division, print_function
+
+import argparse
+import json
+import platform
+import random
+import sys
+from timeit import default_timer
+
+import calc
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# Operator mixes: weights of binary operator symbols, and probability for an operand to be negated
+MIXES = {
+    'additive': ({'+': 1, '-': 1}, 0.),
+    'multiplicative': ({'*': 1, '/': 1}, 0.),
+    'mixed': ({'+': 2, '-': 2, '*': 2, '/': 1, '^': 1}, 0.1),
+    'unary': ({'+': 1, '-': 1, '*': 1}, 0.5),
+}
+
+
+def generate(size, depth=0, mix='mixed', seed=0):
+    """
+    Generate a valid expression which evaluates without error
+    :param size: number of operands
+    :param depth: nesting depth of parentheses
+    :param mix: name of the operator mix, key of MIXES
+    :param seed: seed of the random generator, the same arguments give the same expression
+    :return: expression string
+    """
+    weights, negate = MIXES[mix]
+    symbols = sorted(weights)
+    cumulative = []
+    total = 0
+    for symbol in symbols:
+        total += weights[symbol]
+        cumulative.append(total)
+    while True:
+        rng = random.Random(seed)
+
+        def choose():
+            draw = rng.random() * total
+            return next(symbol for symbol, bound in zip(symbols, cumulative) if draw < bound)
+
+        def operand():
+            leaf = str(rng.randint(1, 9))
+            return '-' + leaf if rng.random() < negate else leaf
+
+        def build(size, depth):
+            if depth > 0:
+                # the first operand is a group holding half of the operands, one level deeper
+                inner = max(1, size // 2)
+                parts = ['(' + build(inner, depth - 1) + ')']
+                size -= inner
+            else:
+                parts = [operand()]
+                size -= 1
+            for _ in range(size):
+                symbol = choose()
+                if symbol == '^':
+                    if parts[-1].endswith(')') or parts[-1].startswith('^'):  # towers of powers would overflow
+                        symbol = '*'
+                    else:
+                        parts.append('^' + str(rng.randint(2, 3)))
+                        continue
+                parts.append(symbol + operand())
+            return ''.join(parts)
+
+        expr = build(size, depth)
+        try:
+            calc.calc(expr)
+            return expr
+        except calc.CALC_ERRORS:  # e.g. a division by a group evaluating to zero
+            seed += 1
+
+
+# Workloads: name, size, depth, mix of generated expressions, or name, expression of fixed ones
+WORKLOADS = [
+    ('reference', '5*(2+4)-2*-2^5+1/8*8-2'),
+    ('size-8', 8, 0, 'mixed'),
+    ('size-64', 64, 0, 'mixed'),
+    ('size-512', 512, 0, 'mixed'),
+    ('depth-16', 64, 16, 'mixed'),
+    ('depth-64', 128, 64, 'mixed'),
+    ('mix-additive', 64, 0, 'additive'),
+    ('mix-multiplicative', 64, 0, 'multiplicative'),
+    ('mix-unary', 64, 0, 'unary'),
+]
+
+
+def workload_expression(workload):
+    """
+    :param workload: item of WORKLOADS
+    :return: (expression, size, depth, mix): size is the number of operands, depth and mix are None for fixed
+    expressions
+    """
+    if len(workload) == 2:
+        expr = workload[1]
+        return expr, sum(1 for token in calc.scan(expr) if token.kind in calc.LEAF_KINDS), None, None
+    name, size, depth, mix = workload
+    return generate(size, depth, mix), size, depth, mix
+
+
+def _per_call(func, number, repeat):
+    """Best average duration of a call of func over repeat runs of number calls, in seconds"""
+    best = None
+    for _ in range(repeat):
+        start = default_timer()
+        for _ in range(number):
+            func()
+        elapsed = (default_timer() - start) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _percentile(ordered, fraction):
+    return ordered[int(fraction * (len(ordered) - 1))]
+
+
+def _peak_memory(func):
+    """Peak of memory allocated during a call of func, in bytes, None without tracemalloc"""
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _retained(build):
+    """Memory held by the result of build(), in bytes, None without tracemalloc"""
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()
+        return tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+
+def measure_memory(expr):
+    """
+    Measure memory held by the tokens and the compiled form of an expression
+    :param expr: expression string
+    :return: dict of sizes in bytes, None without tracemalloc: per token as a list of Token and as CompactTokens, per
+    compiled expression as tree and tuple program and as compact program
+    """
+    tokens = len(calc.scan(expr))
+    compiled = calc.compile(expr)
+    token_list = _retained(lambda: calc.scan(expr))
+    compact_tokens = _retained(lambda: calc.CompactTokens(calc.scan(expr)))
+    return {
+        'tokens': tokens,
+        'token_list_per_token': token_list and token_list / tokens,
+        'compact_tokens_per_token': compact_tokens and compact_tokens / tokens,
+        'tuple_program': _retained(lambda: (compiled.tree, compiled.program)),
+        'compact_program': _retained(lambda: calc.compile(expr)),
+    }
+
+
+def measure(expr, evaluator_class, calls=1000, repeat=5):
+    """
+    Benchmark one evaluator on one expression
+    :param expr: expression string
+    :param evaluator_class: class of the evaluator
+    :param calls: number of calls of each measurement
+    :param repeat: number of repetitions of phase timings, the best one is kept
+    :return: dict of metrics, durations in microseconds
+    """
+    tokens = calc.scan(expr)
+    compiled = calc.compile(expr, evaluator_class)
+    phases = {
+        'tokenize': _per_call(lambda: calc.scan(expr), calls, repeat),
+        'validate': _per_call(lambda: evaluator_class.parse(tokens), calls, repeat),
+        'evaluate': _per_call(compiled.evaluate, calls, repeat),
+    }
+
+    latencies = []
+    for _ in range(calls):
+        start = default_timer()
+        calc.calc(expr, evaluator_class)
+        latencies.append(default_timer() - start)
+    latencies.sort()
+    return {
+        'throughput': len(latencies) / sum(latencies),
+        'p50_us': _percentile(latencies, 0.5) * 1e6,
+        'p90_us': _percentile(latencies, 0.9) * 1e6,
+        'p99_us': _percentile(latencies, 0.99) * 1e6,
+        'phases_us': dict((phase, seconds * 1e6) for phase, seconds in phases.items()),
+        'peak_memory': _peak_memory(lambda: calc.calc(expr, evaluator_class)),
+    }
+
+
+def run(workloads=WORKLOADS, evaluators=None, calls=1000, repeat=5, log=None):
+    """
+    Benchmark evaluators over workloads
+    :param workloads: list of items of WORKLOADS
+    :param evaluators: dict of evaluator names to classes, calc.EVALUATORS when None
+    :param calls: number of calls of each measurement, divided by the size of the expression
+    :param repeat: number of repetitions of phase timings
+    :param log: optional file to report progress to
+    :return: results dict, ready for JSON
+    """
+    evaluators = calc.EVALUATORS if evaluators is None else evaluators
+    results = {
+        'python': platform.python_implementation() + ' ' + platform.python_version(),
+        'calc': calc.__version__,
+        'benchmarks': {},
+        'memory': {},
+    }
+    for workload in workloads:
+        name = workload[0]
+        expr, size, depth, mix = workload_expression(workload)
+        memory = results['memory'][name] = measure_memory(expr)
+        if log is not None and tracemalloc is not None:
+            print('%-28s %d tokens: %.1f B/token in a list, %.1f B/token compact; program %d B as tuples, %d B compact'
+                  % (name, memory['tokens'], memory['token_list_per_token'], memory['compact_tokens_per_token'],
+                     memory['tuple_program'], memory['compact_program']), file=log)
+        for algo in sorted(evaluators):
+            key = '%s/%s' % (name, algo)
+            metrics = measure(expr, evaluators[algo], max(10, calls * 8 // size), repeat)
+            metrics.update(size=size, depth=depth, mix=mix)
+            results['benchmarks'][key] = metrics
+            if log is not None:
+                print('%-28s %10.0f calls/s  p50 %9.1f us  p99 %9.1f us  tokenize %8.1f validate %8.1f evaluate '
+                      '%8.1f us  peak %s B' % (key, metrics['throughput'], metrics['p50_us'], metrics['p99_us'],
+                                               metrics['phases_us']['tokenize'], metrics['phases_us']['validate'],
+                                               metrics['phases_us']['evaluate'], metrics['peak_memory']), file=log)
+    return results
+
+
+def compare(results, baseline, threshold=0.1):
+    """
+    Compare results to a baseline
+    :param results: results of run()
+    :param baseline: results of a previous run()
+    :param threshold: relative slow down above which a metric is a regression
+    :return: list of (benchmark, metric, baseline value, value) regressions
+    """
+    regressions = []
+    for key, metrics in sorted(results['benchmarks'].items()):
+        previous = baseline['benchmarks'].get(key)
+        if previous is None:
+            continue
+        # throughput regresses when it goes down, durations and memory when they go up
+        checks = [('throughput', previous['throughput'], metrics['throughput'], -1)]
+        checks += [(metric, previous[metric], metrics[metric], 1) for metric in ('p50_us', 'p99_us', 'peak_memory')]
+        checks += [('phases_us.' + phase, previous['phases_us'][phase], metrics['phases_us'][phase], 1)
+                   for phase in sorted(metrics['phases_us']) if phase in previous['phases_us']]
+        for metric, before, after, direction in checks:
+            if before and after is not None and direction * (after - before) / before > threshold:
+                regressions.append((key, metric, before, after))
+    for name, memory in sorted(results.get('memory', {}).items()):
+        previous = baseline.get('memory', {}).get(name)
+        if previous is None:
+            continue
+        for metric in ('compact_tokens_per_token', 'compact_program'):
+            before, after = previous[metric], memory[metric]
+            if before and after is not None and (after - before) / before > threshold:
+                regressions.append((name, metric, before, after))
+    return regressions
+
+
+def main(argv=None):
+    """
+    Command line entry point
+    :param argv: command line arguments, sys.argv[1:] when None
+    :return: exit status, 1 when regressions were found
+    """
+    parser = argparse.ArgumentParser(description="Calculator benchmarks")
+    parser.add_argument('-a', '--algo', action='append', choices=sorted(calc.EVALUATORS),
+                        help="Evaluator to benchmark, can be repeated. All of them by default")
+    parser.add_argument('-w', '--workload', action='append', choices=[workload[0] for workload in WORKLOADS],
+                        help="Workload to run, can be repeated. All of them by default")
+    parser.add_argument('--calls', type=int, default=1000, help="Number of calls of each measurement, for size 8")
+    parser.add_argument('--repeat', type=int, default=5, help="Repetitions of phase timings, the best one is kept")
+    parser.add_argument('-o', '--output', help="Write results to this JSON file")
+    parser.add_argument('-b', '--baseline', help="Compare results to this JSON file of a previous run")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="Relative slow down above which a metric is reported as a regression")
+    args = parser.parse_args(argv)
+
+    evaluators = dict((algo, calc.EVALUATORS[algo]) for algo in (args.algo or calc.EVALUATORS))
+    workloads = [workload for workload in WORKLOADS if not args.workload or workload[0] in args.workload]
+    results = run(workloads, evaluators, args.calls, args.repeat, log=sys.stdout)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for key, metric, before, after in regressions:
+            print('REGRESSION %s %s: %.1f -> %.1f' % (key, metric, before, after))
+        print('%d regressions above %d%%' % (len(regressions), args.threshold * 100))
+        return 1 if regressions else 0
+    return 0
+
+
 if __name__ == "__main__":
-    import timeit
-
-    for expr in ['5*(2+4)-2*-2^5+1/8*8-2']:
-        loop_nb = 10000
-        print('time for calc with ShuntingYard algo (%s) looped %d times' % (expr, loop_nb))
-        print(timeit.repeat("calc('%s', ShuntingYardEvaluator)" % expr,
-                            setup="from calc import calc, ShuntingYardEvaluator", number=loop_nb, repeat=5))
-        print('time for calc with PrecedenceClimbing algo (%s) looped %d times' % (expr, loop_nb))
-        print(timeit.repeat("calc('%s', PrecedenceClimbingEvaluator)" % expr,
-                            setup="from calc import calc, PrecedenceClimbingEvaluator",
-                            number=loop_nb, repeat=5))
+    sys.exit(main())
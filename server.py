@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+"""
+    Calculator server
+    =================
+
+    asyncio server evaluating expressions for other processes over TCP or Unix sockets, with a JSON lines protocol.
+
+    Each request is a JSON object on its own line, only "expression" is required:
+        {"id": 1, "expression": "2*x+1", "evaluator": "pc", "variables": {"x": 3}}
+    Each response is a JSON object on its own line, in the same order as the requests of the connection:
+        {"id": 1, "result": 7}
+        {"id": 2, "error": {"type": "MalformedExpressionError", "message": "Expected ), got None"}}
+
+    Requests of a connection are pipelined: they are read and evaluated without waiting for previous responses to be
+    written, up to a bound after which the connection is not read anymore. Evaluation runs in a pool of processes, so
+    that the event loop stays responsive, with a bound on the number of evaluations in progress.
+
+    Unlike calc.py, requires Python 3.5+.
+
+    :Example:
+    $ python server.py serve --tcp 127.0.0.1:8765
+    $ python server.py bench --tcp 127.0.0.1:8765 --connections 8 --requests 10000
+"""
+import argparse
+import asyncio
+import collections
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import calc
+
+# ParseCache of the process evaluating requests: the server process itself or a worker process
+_cache = None
+
+# Bounds on the cost of a request, so that hostile or buggy expressions fail fast instead of holding a worker
+LIMITS = calc.Limits(max_tokens=100000, max_depth=200, max_int_bits=1 << 16)
+
+
+def _error(request_id, error_type, message):
+    return {'id': request_id, 'error': {'type': error_type, 'message': message}}
+
+
+def handle_line(line):
+    """
+    Decode a request, evaluate it and encode its response
+    :param line: request line, bytes
+    :return: response line, bytes
+    """
+    global _cache
+    if _cache is None:
+        _cache = calc.ParseCache()
+    request_id = None
+    try:
+        request = json.loads(line.decode('utf-8'))
+        if not isinstance(request, dict):
+            raise ValueError("request must be a JSON object")
+        request_id = request.get('id')
+        expression = request.get('expression')
+        if not isinstance(expression, str):
+            raise ValueError("expression must be a string")
+        evaluator_class = calc.EVALUATORS.get(request.get('evaluator', 'pc'))
+        if evaluator_class is None:
+            raise ValueError("evaluator must be one of %s" % ', '.join(sorted(calc.EVALUATORS)))
+        variables = request.get('variables')
+        if variables is not None and not isinstance(variables, dict):
+            raise ValueError("variables must be a JSON object")
+        for name, value in (variables or {}).items():
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                raise ValueError("variable %s must be a number" % name)
+    except ValueError as e:  # includes JSON and UTF-8 decoding errors
+        response = _error(request_id, 'BadRequest', str(e))
+    else:
+        try:
+            response = {'id': request_id, 'result': calc.calc(expression, evaluator_class, _cache, variables, LIMITS)}
+        except Exception as e:  # any error answers this request only, so that the connection goes on
+            response = _error(request_id, e.__class__.__name__, str(e))
+    try:
+        return (json.dumps(response, allow_nan=False) + '\n').encode('utf-8')
+    except TypeError:  # e.g. complex result
+        return (json.dumps(_error(request_id, 'TypeError', "result is not a number")) + '\n').encode('utf-8')
+    except ValueError as e:  # inf or nan result, or int of more digits than Python 3.11+ converts
+        return (json.dumps(_error(request_id, 'ValueError', "result cannot be written as JSON: %s" % e)) +
+                '\n').encode('utf-8')
+
+
+class CalcServer(object):
+    """
+    JSON lines evaluation server, see module documentation.
+    """
+
+    def __init__(self, workers=None, max_concurrency=64, pipeline=32, max_line=1 << 20):
+        """
+        Constructor
+        :param workers: number of evaluation processes, number of CPUs when None. 0 evaluates in the event loop
+        :param max_concurrency: maximum number of evaluations in progress, for all connections
+        :param pipeline: maximum number of requests of a connection read before their responses are written
+        :param max_line: maximum length of a request line
+        """
+        self.workers = workers
+        self.max_concurrency = max_concurrency
+        self.pipeline = pipeline
+        self.max_line = max_line
+        self._executor = None
+        self._semaphore = None
+        self._server = None
+        self._connections = set()  # futures of connections in progress
+
+    async def start(self, host=None, port=None, path=None):
+        """
+        Start listening, on a Unix socket if path is given, on TCP otherwise
+        :return: asyncio Server
+        """
+        if self.workers != 0:
+            self._executor = ProcessPoolExecutor(self.workers)
+            # Start evaluation processes before accepting connections: forked later, they would inherit the sockets
+            # of the connections, which would then never be seen closed
+            await asyncio.get_event_loop().run_in_executor(self._executor, handle_line, b'{}')
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        if path is not None:
+            self._server = await asyncio.start_unix_server(self._serve_connection, path, limit=self.max_line)
+        else:
+            self._server = await asyncio.start_server(self._serve_connection, host, port, limit=self.max_line)
+        return self._server
+
+    async def close(self):
+        """Stop listening, wait for connections in progress to end and release evaluation processes"""
+        self._server.close()
+        await self._server.wait_closed()
+        await asyncio.gather(*self._connections)
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    async def _evaluate(self, line):
+        async with self._semaphore:
+            if self._executor is None:
+                return handle_line(line)
+            return await asyncio.get_event_loop().run_in_executor(self._executor, handle_line, line)
+
+    async def _serve_connection(self, reader, writer):
+        connection = asyncio.Future()
+        self._connections.add(connection)
+        pending = asyncio.Queue(self.pipeline)  # evaluations in request order, None when the connection is over
+        responder = asyncio.ensure_future(self._respond(pending, writer))
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:  # longer than max_line, the end of the request cannot be found
+                    response = _error(None, 'BadRequest', "request longer than %d bytes" % self.max_line)
+                    await pending.put(_done((json.dumps(response) + '\n').encode('utf-8')))
+                    break
+                if not line:
+                    break
+                if line.strip():
+                    await pending.put(asyncio.ensure_future(self._evaluate(line)))
+        except ConnectionError:
+            pass
+        finally:
+            await pending.put(None)
+            await responder
+            writer.close()
+            self._connections.discard(connection)
+            connection.set_result(None)
+
+    @staticmethod
+    async def _respond(pending, writer):
+        broken = False
+        while True:
+            evaluation = await pending.get()
+            if evaluation is None:
+                return
+            try:
+                response = await evaluation
+            except Exception as e:  # e.g. a worker process died: answer an error, then go on with the next requests
+                response = (json.dumps(_error(None, e.__class__.__name__, str(e))) + '\n').encode('utf-8')
+            if not broken:  # once the client is gone, keep consuming evaluations so that the reader is never blocked
+                try:
+                    writer.write(response)
+                    await writer.drain()
+                except ConnectionError:
+                    broken = True
+
+
+def _done(result):
+    future = asyncio.Future()
+    future.set_result(result)
+    return future
+
+
+##################################
+###       LOAD GENERATOR       ###
+##################################
+
+async def load(connect, expression='5*(2+4)-2*-2^5+1/8*8-2', connections=8, requests=10000, pipeline=16):
+    """
+    Send requests to a server and measure its responses
+    :param connect: coroutine function returning a (reader, writer) connection to the server
+    :param expression: expression of the requests
+    :param connections: number of concurrent connections
+    :param requests: total number of requests, spread over connections
+    :param pipeline: maximum number of requests of a connection waiting for their response
+    :return: dict of statistics: requests, errors, seconds, rps, p50 and p99 latencies in milliseconds
+    """
+    line = (json.dumps({'expression': expression}) + '\n').encode('utf-8')
+    latencies = []
+    errors = [0]
+
+    async def client(count):
+        reader, writer = await connect()
+        window = asyncio.Semaphore(pipeline)
+        sent = collections.deque()
+
+        async def send():
+            for _ in range(count):
+                await window.acquire()
+                sent.append(time.perf_counter())
+                writer.write(line)
+                await writer.drain()
+
+        sender = asyncio.ensure_future(send())
+        for _ in range(count):
+            response = await reader.readline()
+            latencies.append(time.perf_counter() - sent.popleft())
+            window.release()
+            if b'"error"' in response:
+                errors[0] += 1
+        await sender
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client(requests // connections + (1 if i < requests % connections else 0))
+                           for i in range(connections)])
+    seconds = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'seconds': seconds,
+        'rps': len(latencies) / seconds,
+        'p50_ms': latencies[int(0.50 * (len(latencies) - 1))] * 1000,
+        'p99_ms': latencies[int(0.99 * (len(latencies) - 1))] * 1000,
+    }
+
+
+def main(argv=None):
+    """
+    Command line entry point
+    :param argv: command line arguments, sys.argv[1:] when None
+    """
+    parser = argparse.ArgumentParser(description="Calculator server, JSON lines over TCP or Unix sockets")
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    serve = commands.add_parser('serve', help="Run the server")
+    bench = commands.add_parser('bench', help="Measure latency and throughput of a server. Without address, a local "
+                                              "server is started")
+    for command in (serve, bench):
+        address = command.add_mutually_exclusive_group(required=command is serve)
+        address.add_argument('--tcp', metavar='HOST:PORT', help="TCP address")
+        address.add_argument('--unix', metavar='PATH', help="Unix socket path")
+    for command in (serve, bench):
+        command.add_argument('--workers', type=int, default=None,
+                             help="Number of evaluation processes, one per CPU by default, 0 evaluates in the loop")
+        command.add_argument('--max-concurrency', type=int, default=64, help="Maximum evaluations in progress")
+        command.add_argument('--pipeline', type=int, default=32,
+                             help="Maximum requests of a connection waiting for their response")
+    bench.add_argument('--connections', type=int, default=8, help="Number of concurrent connections")
+    bench.add_argument('--requests', type=int, default=10000, help="Total number of requests")
+    bench.add_argument('--expression', default='5*(2+4)-2*-2^5+1/8*8-2', help="Expression of the requests")
+    args = parser.parse_args(argv)
+
+    host = port = None
+    if args.tcp:
+        host, port = args.tcp.rsplit(':', 1)
+        port = int(port)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        if args.command == 'serve':
+            server = CalcServer(args.workers, args.max_concurrency, args.pipeline)
+            loop.run_until_complete(server.start(host, port, args.unix))
+            try:
+                loop.run_forever()
+            except KeyboardInterrupt:
+                pass
+            loop.run_until_complete(server.close())
+        else:
+            server = None
+            if not args.tcp and not args.unix:
+                server = CalcServer(args.workers, args.max_concurrency, args.pipeline)
+                host, port = loop.run_until_complete(server.start('127.0.0.1', 0)).sockets[0].getsockname()[:2]
+            if args.unix:
+                connect = lambda: asyncio.open_unix_connection(args.unix)
+            else:
+                connect = lambda: asyncio.open_connection(host, port)
+            stats = loop.run_until_complete(
+                load(connect, args.expression, args.connections, args.requests, args.pipeline))
+            if server is not None:
+                loop.run_until_complete(server.close())
+            print("%(requests)d requests in %(seconds).2f s, %(errors)d errors: %(rps).0f requests/s, "
+                  "p50 %(p50_ms).2f ms, p99 %(p99_ms).2f ms" % stats)
+    finally:
+        loop.close()
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
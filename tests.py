@@ -1,6 +1,24 @@
 import unittest
 import calc
+import io
 import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    import json
+    import server
+else:
+    server = None
 
 
 class TokenizeTest(unittest.TestCase):
@@ -77,6 +95,120 @@ class ValidateTokenTest(unittest.TestCase):
             calc.validate_token('azerty')
 
 
+class ScanTest(unittest.TestCase):
+    """
+    Unit tests for calc.scan()
+    """
+
+    def test_empty(self):
+        self.assertEqual([], calc.scan(''))
+        self.assertEqual([], calc.scan('  \'\' '))
+
+    def test_typed(self):
+        self.assertEqual([calc.Token(calc.NUMBER, 12, 0)], calc.scan('12'))
+        self.assertEqual([calc.Token(calc.NUMBER, 1.5, 2)], calc.scan(' \t1.5 '))
+        self.assertEqual([calc.Token(calc.NUMBER, 1000.0, 0)], calc.scan('10e2'))
+        self.assertIsInstance(calc.scan('12')[0].value, int)
+        self.assertIsInstance(calc.scan('12.')[0].value, float)
+
+    def test_expressions(self):
+        self.assertEqual([calc.Token('-', None, 0), calc.Token(calc.NUMBER, 1.5, 2), calc.Token('+', None, 5),
+                          calc.Token(calc.NUMBER, 2, 6)], calc.scan('- 1.5+2'))
+        self.assertEqual(['(', calc.NUMBER, '+', calc.NUMBER, ')', '*', calc.NUMBER],
+                         [token.kind for token in calc.scan('(2+3)*4')])
+        self.assertEqual([calc.NUMBER, calc.NUMBER], [token.kind for token in calc.scan('12 34')])
+
+    def test_same_as_tokenize(self):
+        for expr in ['1+-2*-3/4', ' 10 + 20 * 30 / 40 - 50 ', '-1-1', '(5)^2']:
+            self.assertEqual([token if token in calc.VALID_TOKENS_SET else int(token) for token in calc.tokenize(expr)],
+                             [token.value if token.kind == calc.NUMBER else token.kind for token in calc.scan(expr)])
+
+    def test_quotes(self):
+        self.assertEqual([calc.Token(calc.NUMBER, 12, 0)], calc.scan('\'1\'2'))
+
+    def test_invalid(self):
+        with self.assertRaises(calc.InvalidTokenError):
+            calc.scan('2+1a')
+        with self.assertRaises(calc.InvalidTokenError):
+            calc.scan('1.5.5')
+
+    def test_long_int(self):
+        digits = '12345678' * 1000
+        self.assertEqual(10 ** 8000, calc.scan('1' + digits)[0].value - calc.scan(digits)[0].value)
+        self.assertEqual(10 ** 8000, calc.calc('\'1' + '0' * 8000 + '\''))
+        self.assertEqual([10 ** 8000 + 1], [token.value for token in calc.iscan('1' + '0' * 7999 + '1')])
+
+
+class StreamTest(unittest.TestCase):
+    def test_iscan(self):
+        for expr in ['', '5*(2+4)-2*-2^5+1/8*8-2', ' 12.5e3 + price//x ', "'2'+inf"]:
+            self.assertEqual(calc.scan(expr), list(calc.iscan(expr)))
+            for chunk_size in (1, 2, 7):
+                self.assertEqual(calc.scan(expr), list(calc.iscan(StringIO(expr), chunk_size)))
+        with self.assertRaises(calc.InvalidTokenError):
+            list(calc.iscan(StringIO('2+$'), 1))
+
+    def test_same_as_calc(self):
+        for expr in ['5*(2+4)-2*-2^5+1/8*8-2', '2^3^2', '-2^2', 'x*-x', '(((1)))']:
+            for evaluator_class in (calc.PrecedenceClimbingEvaluator, calc.ShuntingYardEvaluator,
+                                    calc.IterativePrecedenceClimbingEvaluator, calc.IterativeShuntingYardEvaluator,
+                                    calc.PrattEvaluator):
+                self.assertEqual(calc.calc(expr, evaluator_class, variables={'x': 3}),
+                                 calc.calc_stream(StringIO(expr), evaluator_class, {'x': 3}, chunk_size=3))
+
+    def test_tokenize(self):
+        evaluator = calc._streaming_class(calc.ShuntingYardEvaluator)(iter(calc.tokenize('1 + 2 * 3')))
+        self.assertEqual(7, evaluator.evaluate())
+
+    def test_errors(self):
+        with self.assertRaises(calc.MalformedExpressionError):
+            calc.calc_stream('2*(3')
+        with self.assertRaises(calc.MalformedExpressionError):
+            calc.calc_stream('2 3')
+        with self.assertRaises(ValueError):
+            calc.calc_stream('2', calc.CodegenEvaluator)
+
+    def test_deep(self):
+        expr = '(' * 10000 + '1' + ')' * 10000
+        self.assertEqual(1, calc.calc_stream(StringIO(expr), calc.IterativePrecedenceClimbingEvaluator))
+
+    def test_limits(self):
+        with self.assertRaises(calc.LimitExceededError):
+            calc.calc_stream('1' + '+1' * 100, limits=calc.Limits(max_tokens=50))
+        with self.assertRaises(calc.LimitExceededError):
+            calc.calc_stream('-' * 20 + '1', limits=calc.Limits(max_depth=10))
+        self.assertEqual(101, calc.calc_stream('1' + '+1' * 100, limits=calc.Limits(max_tokens=201)))
+
+
+class CompactTokensTest(unittest.TestCase):
+    """
+    Unit tests for calc.CompactTokens
+    """
+
+    expr = '5 + x*2.5 - 99999999999999999999^(3)'
+
+    def test_tokens(self):
+        tokens = calc.CompactTokens(calc.scan(self.expr))
+        self.assertEqual(calc.scan(self.expr), list(tokens))
+        self.assertEqual(len(calc.scan(self.expr)), len(tokens))
+        self.assertEqual(calc.Token(')', None, 35), tokens[-1])
+        self.assertEqual(calc.Token('number', 99999999999999999999, 12), tokens[6])
+        self.assertEqual(calc.Token('number', 1, None), calc.CompactTokens([calc.Token('number', 1, None)])[0])
+        self.assertEqual(calc.Token('+', None, 2 ** 33), calc.CompactTokens([calc.Token('+', None, 2 ** 33)])[0])
+
+    def test_evaluators(self):
+        tokens = calc.CompactTokens(calc.scan(self.expr))
+        for algo in sorted(calc.EVALUATORS):
+            self.assertEqual(calc.calc(self.expr, variables={'x': 2}),
+                             calc.EVALUATORS[algo](tokens, {'x': 2}).evaluate())
+
+    def test_slots(self):
+        self.assertFalse(hasattr(calc.BINARY_OPS['+'], '__dict__'))
+        self.assertFalse(hasattr(calc.compile('1+1'), '__dict__'))
+        for evaluator_class in calc.EVALUATORS.values():
+            self.assertFalse(hasattr(evaluator_class([]), '__dict__'))
+
+
 class OperatorTest(unittest.TestCase):
     def test_compare(self):
         self.assertTrue(calc.Divide() > calc.Plus())
@@ -153,6 +285,12 @@ class SYEvaluatorTest(unittest.TestCase):
     def test_bug_sl(self):
         self.assertEqual(-2, calc.ShuntingYardEvaluator(['-', '1', '-', '1']).evaluate())
 
+    def test_left_associativity(self):
+        self.assertEqual(5, calc.calc('8-2-1', calc.ShuntingYardEvaluator))
+        self.assertEqual(2, calc.calc('8/2/2', calc.ShuntingYardEvaluator))
+        self.assertEqual(-1, calc.calc('1-2+3-3', calc.IterativeShuntingYardEvaluator))
+        self.assertEqual(512, calc.calc('2^3^2', calc.ShuntingYardEvaluator))
+
 
 class PCEvaluatorTest(unittest.TestCase):
     def test_evaluate_unary(self):
@@ -191,12 +329,1033 @@ class PCEvaluatorTest(unittest.TestCase):
             calc.PrecedenceClimbingEvaluator(['(', '6']).evaluate()
         with self.assertRaises(calc.MalformedExpressionError):
             calc.PrecedenceClimbingEvaluator(['abc']).evaluate()
+        for expr, message in [('(6 2', "Expected ), got 2"), ('(6 x', "Expected ), got x"), ('(6', "Expected ), got None")]:
+            with self.assertRaises(calc.MalformedExpressionError) as context:
+                calc.calc(expr)
+            self.assertEqual(message, str(context.exception))
     
     def test_bug_sl(self):
         self.assertEqual(-2, calc.PrecedenceClimbingEvaluator(['-', '1', '-', '1']).evaluate())
 
 
+class PrattEvaluatorTest(unittest.TestCase):
+    def test_evaluate(self):
+        for expr in ['5*(2+4)-2*-2^5+1/8*8-2', '8-2-1', '2^3^2', '-2^2', '-(-(1))', '2*-3', 'x*2-1']:
+            self.assertEqual(calc.calc(expr, variables={'x': 3}),
+                             calc.calc(expr, calc.PrattEvaluator, variables={'x': 3}))
+
+    def test_malformed(self):
+        for expr in ['1+', '(6', ')', '1)', '', '1 2', '-', '()']:
+            with self.assertRaises(calc.MalformedExpressionError):
+                calc.calc(expr, calc.PrattEvaluator)
+
+
+class Modulo(calc.OperatorBase):
+    def __init__(self):
+        super(Modulo, self).__init__('%', 5)
+
+    def do_eval(self, *args):
+        return args[0] % args[1]
+
+
+class FloorDivide(calc.OperatorBase):
+    def __init__(self):
+        super(FloorDivide, self).__init__('//', 5)
+
+    def do_eval(self, *args):
+        return args[0] // args[1]
+
+
+class RegistryTest(unittest.TestCase):
+    """
+    Unit tests for calc.register_operator() and calc.unregister_operator()
+    """
+
+    def setUp(self):
+        calc.register_operator(Modulo())
+        calc.register_operator(FloorDivide())
+
+    def tearDown(self):
+        calc.unregister_operator('%')
+        calc.unregister_operator('//')
+
+    def test_binding_powers(self):
+        plus, pow = calc.BINARY_CODES['+'], calc.BINARY_CODES['^']
+        self.assertLess(calc._LBP[plus], calc._RBP[plus])  # left associative
+        self.assertEqual(calc._LBP[pow], calc._RBP[pow])  # right associative
+        self.assertLess(calc._RBP[calc.UNARY_CODES['-']], calc._LBP[pow])
+
+    def test_custom_operators(self):
+        self.assertEqual(['7', '%', '4'], [str(token.value) if token.value else token.kind
+                                           for token in calc.scan('7%4')])
+        self.assertEqual('//', calc.scan('7//2')[1].kind)
+        for algo in sorted(calc.EVALUATORS):
+            evaluator_class = calc.EVALUATORS[algo]
+            self.assertEqual(4.5, calc.calc('7 % 4 + 17//5*2 - 9/2', evaluator_class))
+            self.assertEqual(1, calc.calc('9 // 2 % 3', evaluator_class))
+            self.assertEqual(4, calc.compile('x//2', evaluator_class).evaluate({'x': 9}))
+
+    def test_unregister(self):
+        compiled = calc.compile('7//2')
+        calc.unregister_operator('//')
+        try:
+            self.assertRaises(calc.MalformedExpressionError, calc.calc, '7//2')
+            self.assertEqual(3, compiled.evaluate())
+            self.assertRaises(KeyError, calc.unregister_operator, '//')
+        finally:
+            calc.register_operator(FloorDivide())
+
+    def test_register_again(self):
+        code = calc.BINARY_CODES['%']
+        for _ in range(300):
+            calc.unregister_operator('%')
+            calc.register_operator(Modulo())
+        self.assertEqual(code, calc.BINARY_CODES['%'])
+        self.assertEqual(3, calc.calc('7 % 4'))
+
+    def test_invalid_token(self):
+        for token in ['mod', '', '.', '( ']:
+            operator = Modulo()
+            operator.token = token
+            self.assertRaises(ValueError, calc.register_operator, operator)
+
+
+class IterativeEvaluatorTest(unittest.TestCase):
+    PAIRS = [(calc.ShuntingYardEvaluator, calc.IterativeShuntingYardEvaluator),
+             (calc.PrecedenceClimbingEvaluator, calc.IterativePrecedenceClimbingEvaluator)]
+
+    def test_same_as_recursive(self):
+        for expr in ['1', '-1.5', '2*3-1', '2-3*3', '-3*(-3)', '-3*-3', '9/(-3)', '(7-4)/2', '1+2+3+0', '2^2^3',
+                     '-1-1', '5*(2+4)-2*-2^5+1/8*8-2', '2^-(1+1)*--3', '((2))*((3-(4)))']:
+            for recursive, iterative in self.PAIRS:
+                self.assertEqual(calc.calc(expr, recursive), calc.calc(expr, iterative))
+
+    def test_deep_nesting(self):
+        expr = '(' * 5000 + '1' + '+1)' * 5000
+        for evaluator_class in (calc.IterativeShuntingYardEvaluator, calc.IterativePrecedenceClimbingEvaluator):
+            self.assertEqual(5001, calc.calc(expr, evaluator_class))
+            self.assertEqual(2, calc.calc('- ' * 5000 + '2', evaluator_class))
+
+    def test_compile(self):
+        expr = '(' * 5000 + '2' + ')' * 5000 + '^' + '-' * 5001 + '1'
+        self.assertEqual(0.5, calc.compile(expr, calc.IterativePrecedenceClimbingEvaluator).evaluate())
+
+    def test_invalid(self):
+        for expr in ['1+', '(6', '6)', '()', '1 2', '-', '']:
+            for evaluator_class in (calc.IterativeShuntingYardEvaluator, calc.IterativePrecedenceClimbingEvaluator):
+                with self.assertRaises(calc.MalformedExpressionError):
+                    calc.calc(expr, evaluator_class)
+
+
+class VariablesTest(unittest.TestCase):
+    def test_scan(self):
+        self.assertEqual([calc.Token(calc.NAME, 'x_1', 0), calc.Token('*', None, 3), calc.Token(calc.NAME, 'y', 4)],
+                         calc.scan('x_1*y'))
+        self.assertEqual(calc.NUMBER, calc.scan('inf')[0].kind)
+
+    def test_calc(self):
+        for evaluator_class in calc.EVALUATORS.values():
+            self.assertEqual(7, calc.calc('a*2+b', evaluator_class, variables={'a': 3, 'b': 1}))
+            self.assertEqual(-2.5, calc.calc('-(x)', evaluator_class, variables={'x': 2.5}))
+
+    def test_compile(self):
+        compiled = calc.compile('(x-y)^2 / x')
+        self.assertEqual(('x', 'y'), compiled.variables)
+        self.assertEqual(0.5, compiled.evaluate({'x': 2, 'y': 1}))
+        self.assertEqual(9, calc.calc('a*a', cache=calc.ParseCache(), variables={'a': 3}))
+
+    def test_undefined(self):
+        with self.assertRaises(calc.UndefinedVariableError):
+            calc.calc('1+a')
+        with self.assertRaises(calc.InvalidTokenError):
+            calc.compile('a+b').evaluate({'a': 1})
+
+    @unittest.skipIf(calc.numpy is None, "NumPy is not installed")
+    def test_columns(self):
+        compiled = calc.compile('a*(b+1)-a^2')
+        result = compiled.evaluate_columns({'a': [1, 2, 3], 'b': [1.5, 2.5, 3.5]})
+        self.assertEqual([compiled.evaluate({'a': a, 'b': b}) for a, b in [(1, 1.5), (2, 2.5), (3, 3.5)]],
+                         result.tolist())
+        self.assertEqual([4, 4], calc.compile('2+2').evaluate_columns({'a': [1, 2]}).tolist())
+
+    def test_columns_without_numpy(self):
+        numpy, calc.numpy = calc.numpy, None
+        try:
+            with self.assertRaises(ImportError):
+                calc.compile('a').evaluate_columns({'a': [1]})
+        finally:
+            calc.numpy = numpy
+
+
+class LimitsTest(unittest.TestCase):
+    """
+    Unit tests for calc.Limits
+    """
+
+    def test_tokens(self):
+        limits = calc.Limits(max_tokens=3)
+        self.assertEqual(3, calc.calc('1+2', limits=limits))
+        self.assertRaises(calc.LimitExceededError, calc.calc, '1+2+3', limits=limits)
+        self.assertRaises(calc.LimitExceededError, calc.compile, '1+2+3', limits=limits)
+
+    def test_depth(self):
+        limits = calc.Limits(max_depth=4)
+        self.assertEqual(1, calc.calc('-(-(1))', calc.ShuntingYardEvaluator, limits=limits))
+        self.assertEqual(3, calc.calc('(1)+(1)+(1)', limits=limits))
+        for expr in ['-(-(-1))', '((((((1)))))', '- - - - -1']:
+            self.assertRaises(calc.LimitExceededError, calc.calc, expr, limits=limits)
+
+    def test_int_bits(self):
+        limits = calc.Limits(max_int_bits=64)
+        self.assertEqual(2 ** 63, calc.calc('2^63', limits=limits))
+        self.assertEqual(2.0 ** 100, calc.calc('2.0^100', limits=limits))
+        self.assertEqual(0.5 ** 100, calc.calc('2^-100', limits=limits))
+        self.assertEqual(1, calc.calc('1^1000000000000', limits=limits))
+        for expr in ['9^9^9', '2^63*2', '18446744073709551616']:
+            for algo in sorted(calc.EVALUATORS):
+                self.assertRaises(calc.LimitExceededError, calc.calc, expr, calc.EVALUATORS[algo], limits=limits)
+            self.assertRaises(calc.LimitExceededError, calc.calc, expr, cache=calc.ParseCache(), limits=limits)
+
+    def test_compiled(self):
+        compiled = calc.compile('x^y', calc.CodegenEvaluator)
+        self.assertEqual(2 ** 100, compiled.evaluate({'x': 2, 'y': 100}))
+        self.assertRaises(calc.LimitExceededError, compiled.evaluate, {'x': 2, 'y': 100}, calc.Limits(max_int_bits=64))
+
+    def test_batch(self):
+        results = list(calc.calc_many(['2^10', '9^9^9'], workers=1, limits=calc.Limits(max_int_bits=64)))
+        self.assertEqual(1024, results[0])
+        self.assertIsInstance(results[1], calc.LimitExceededError)
+
+
+class CheckTest(unittest.TestCase):
+    """
+    Unit tests for calc.check and calc.validate_many
+    """
+
+    def test_valid(self):
+        for expr in ['2+2', ' -(1.5e3 * x) ^ -2 ', "'2*3'", '--1', 'inf-nan', '((1))']:
+            self.assertIsNone(calc.check(expr), expr)
+
+    def test_diagnostics(self):
+        self.assertEqual(calc.Diagnostic(2, calc.UNBALANCED_PARENTHESIS, "'(' is never closed"), calc.check('2*(3'))
+        self.assertEqual((4, calc.UNEXPECTED_END), calc.check('2 + ')[:2])
+        self.assertEqual((2, calc.UNEXPECTED_TOKEN), calc.check('1 2')[:2])
+        self.assertEqual((1, calc.UNEXPECTED_TOKEN), calc.check('1(2)')[:2])
+        self.assertEqual((2, calc.UNEXPECTED_TOKEN), calc.check('1+*2')[:2])
+        self.assertEqual((1, calc.UNEXPECTED_TOKEN), calc.check('()')[:2])
+        self.assertEqual((3, calc.UNBALANCED_PARENTHESIS), calc.check('(1))')[:2])
+        self.assertEqual((4, calc.INVALID_TOKEN), calc.check('1 + 3a')[:2])
+        self.assertEqual((0, calc.UNEXPECTED_END), calc.check('')[:2])
+
+    def test_agrees_with_evaluation(self):
+        for expr in ['2+2', '2*(3', '1 2', '(1))', '1+$', '', '-', '()', '2^-3', '((1)', "'1+'", '1+(2))']:
+            try:
+                calc.compile(expr)
+                valid = True
+            except (calc.InvalidTokenError, calc.MalformedExpressionError):
+                valid = False
+            self.assertEqual(valid, calc.check(expr) is None, expr)
+
+    def test_validate_many(self):
+        diagnostics = list(calc.validate_many(['1+1', '1+', '2']))
+        self.assertEqual([None, calc.UNEXPECTED_END, None], [d and d.kind for d in diagnostics])
+
+    def test_registered_operator(self):
+        self.assertEqual(calc.INVALID_TOKEN, calc.check('7%2').kind)
+        calc.register_operator(Modulo())
+        try:
+            self.assertIsNone(calc.check('7%2'))
+        finally:
+            calc.unregister_operator('%')
+
+
+class CompileTest(unittest.TestCase):
+    def test_evaluate(self):
+        for evaluator_class in (calc.ShuntingYardEvaluator, calc.PrecedenceClimbingEvaluator):
+            expected = calc.calc('5*(2+4)-2*-2^5+1/8*8-2', evaluator_class)
+            compiled = calc.compile('5*(2+4)-2*-2^5+1/8*8-2', evaluator_class)
+            self.assertEqual(expected, compiled.evaluate())
+            self.assertEqual(expected, compiled.evaluate())
+
+    def test_same_as_calc(self):
+        for expr in ['1', '-1.5', '2^2^3', '-1-1', '9/(-3)', '-3*-3', '(7-4)/2']:
+            self.assertEqual(calc.calc(expr), calc.compile(expr).evaluate())
+
+    def test_tree(self):
+        tree = calc.compile('1+2*3').tree
+        self.assertIsInstance(tree.operator, calc.Plus)
+        self.assertEqual(calc.Leaf(1), tree.operands[0])
+        self.assertIsInstance(tree.operands[1].operator, calc.Multiply)
+        self.assertEqual(5, len(calc.compile('1+2*3').program))
+
+    def test_compact(self):
+        # constants of every kind survive the compact program
+        tree = calc.Node(calc.BINARY_OPS['+'], (calc.Leaf(2 ** 70), calc.Node(calc.BINARY_OPS['*'], (
+            calc.Leaf(1.5), calc.Node(calc.UNARY_OPS['-'], (calc.Variable('x'),))))))
+        tree = calc.Node(calc.BINARY_OPS['-'], (tree, calc.Leaf(1j)))
+        compiled = calc.CompiledExpression(tree)
+        self.assertEqual(tree, compiled.tree)
+        self.assertEqual(2 ** 70 - 3 - 1j, compiled.evaluate({'x': 2}))
+
+    def test_immutable(self):
+        compiled = calc.compile('2+2')
+        with self.assertRaises(AttributeError):
+            compiled.program = ()
+
+    def test_invalid(self):
+        with self.assertRaises(calc.InvalidTokenError):
+            calc.compile('2+$')
+        with self.assertRaises(calc.MalformedExpressionError):
+            calc.compile('2+', calc.ShuntingYardEvaluator)
+
+
+class OptimizeTest(unittest.TestCase):
+    def test_fold(self):
+        optimized, eliminated = calc.optimize(calc.compile('(60*60*24)*x + 2^10'))
+        self.assertEqual(calc.Leaf(86400), optimized.tree.operands[0].operands[0])
+        self.assertEqual(calc.Leaf(1024), optimized.tree.operands[1])
+        self.assertEqual(6, eliminated)
+        self.assertEqual(87424, optimized.evaluate({'x': 1}))
+
+    def test_types(self):
+        self.assertEqual(calc.Leaf(2.0), calc.optimize(calc.compile('4/2'))[0].tree)
+        self.assertEqual(calc.Leaf(-4), calc.optimize(calc.compile('-2^2'))[0].tree)
+        self.assertIsInstance(calc.optimize(calc.compile('x*1.0'))[0].tree, calc.Node)
+
+    def test_identities(self):
+        for expr in ['x*1', '1*x', 'x-0', 'x^1', '--x', '- - -(-x)', '(x*1)^1*1']:
+            optimized, eliminated = calc.optimize(calc.compile(expr))
+            self.assertEqual(calc.Variable('x'), optimized.tree)
+            self.assertEqual(calc._size(calc.compile(expr).tree) - 1, eliminated)
+
+    def test_strength_reduction(self):
+        optimized, eliminated = calc.optimize(calc.compile('x^2'))
+        self.assertIsInstance(optimized.tree.operator, calc.Multiply)
+        self.assertEqual(0, eliminated)
+        self.assertEqual(9, optimized.evaluate({'x': 3}))
+        self.assertIsInstance(calc.optimize(calc.compile('(x+1)^2'))[0].tree.operator, calc.Pow)
+
+    def test_errors_not_folded(self):
+        optimized, eliminated = calc.optimize(calc.compile('1/0'))
+        self.assertEqual(0, eliminated)
+        with self.assertRaises(ZeroDivisionError):
+            optimized.evaluate()
+        self.assertEqual(2, calc.optimize(calc.compile('9^9^9'))[1])  # 9^9 only
+
+
+class ExpressionDagTest(unittest.TestCase):
+    def test_same_as_calc(self):
+        expressions = ['1000*(1+0.05)^12', '2000*(1+0.05)^12', '2^3^2', '-2^2', '4/2', '5*(2+4)-2*-2^5+1/8*8-2']
+        self.assertEqual([calc.calc(expr) for expr in expressions], calc.ExpressionDag(expressions).evaluate())
+
+    def test_shared(self):
+        dag = calc.ExpressionDag(['x*(1+0.05)^12', 'y*(1+0.05)^12', 'x*(1+0.05)^12'])
+        self.assertEqual([2 * 1.05 ** 12, 3 * 1.05 ** 12, 2 * 1.05 ** 12], dag.evaluate({'x': 2, 'y': 3}))
+        stats = dag.stats()
+        self.assertEqual((3, 21, 9), stats[:3])
+        self.assertEqual(21.0 / 9, stats.ratio)
+        self.assertEqual(3, len(dag))
+
+    def test_ints_floats_not_merged(self):
+        self.assertEqual([2, 2.0], calc.ExpressionDag(['1+1', '1.0+1']).evaluate())
+
+    def test_errors(self):
+        dag = calc.ExpressionDag(['1/0+9^9^9', '2+', 'x+1', '9^2'])
+        results = dag.evaluate(limits=calc.Limits(max_int_bits=64))
+        self.assertIsInstance(results[0], ZeroDivisionError)
+        self.assertIsInstance(results[1], calc.MalformedExpressionError)
+        self.assertIsInstance(results[2], calc.UndefinedVariableError)
+        self.assertEqual(81, results[3])
+        self.assertIsInstance(calc.ExpressionDag(['9^9^9']).evaluate(limits=calc.Limits(max_int_bits=64))[0],
+                              calc.LimitExceededError)
+
+
+class SheetTest(unittest.TestCase):
+    def setUp(self):
+        self.sheet = calc.Sheet()
+        self.sheet.update({'price': 100, 'rate': 0.2, 'qty': 3})
+        self.sheet.set_formula('unit', 'price * (1 + rate)')
+        self.sheet.set_formula('total', 'unit * qty')
+        self.sheet.set_formula('count', 'qty * 2')
+
+    def test_values(self):
+        self.assertEqual(360.0, self.sheet['total'])
+        self.assertEqual(6, self.sheet['count'])
+        self.assertEqual(calc.SheetStats(3, 1, 3, 0), self.sheet.stats())
+
+    def test_incremental(self):
+        self.sheet.recalculate()
+        self.sheet.set_input('rate', 0.5)
+        self.assertEqual(2, self.sheet.recalculate())
+        self.assertEqual(450.0, self.sheet['total'])
+        self.assertEqual(calc.SheetStats(3, 2, 5, 1), self.sheet.stats())
+        self.sheet.set_input('rate', 0.5)
+        self.assertEqual(0, self.sheet.recalculate())
+
+    def test_unchanged_value_stops(self):
+        self.sheet.set_formula('abs_rate', 'rate * 0')
+        self.sheet.set_formula('fee', 'abs_rate + 1')
+        self.sheet.recalculate()
+        self.sheet.set_input('rate', 0.3)
+        self.assertEqual(3, self.sheet.recalculate())  # unit, total and abs_rate, not fee
+        self.assertEqual(1.0, self.sheet['fee'])
+
+    def test_formula_changes(self):
+        self.sheet.recalculate()
+        self.sheet.set_formula('unit', 'price')
+        self.assertEqual(300, self.sheet['total'])
+        self.sheet.set_input('unit', 10)
+        self.assertEqual(30, self.sheet['total'])
+        self.sheet.set_input('price', 1)
+        self.assertEqual(0, self.sheet.recalculate())
+
+    def test_cycles(self):
+        with self.assertRaises(calc.CircularReferenceError):
+            self.sheet.set_formula('price', 'total / qty')
+        with self.assertRaises(calc.CircularReferenceError):
+            self.sheet.set_formula('x', 'x + 1')
+        self.assertEqual(100, self.sheet['price'])
+        with self.assertRaises(calc.MalformedExpressionError):
+            self.sheet.set_formula('x', '1+')
+        self.assertNotIn('x', self.sheet)
+
+    def test_errors(self):
+        self.sheet.set_input('qty', 0)
+        self.sheet.set_formula('average', 'total / qty')
+        self.sheet.set_formula('double', 'average * 2')
+        with self.assertRaises(ZeroDivisionError):
+            self.sheet['double']
+        del self.sheet['price']
+        self.assertIsInstance(self.sheet.results()['total'], calc.UndefinedVariableError)
+        self.sheet.set_input('price', 1)
+        self.sheet.set_input('qty', 2)
+        self.assertEqual(2.4, self.sheet['double'])
+
+
+class EditSessionTest(unittest.TestCase):
+    def assertSameAsCompile(self, session):
+        try:
+            expected = calc.compile(session.text).evaluate(session.variables)
+        except calc.CALC_ERRORS as e:
+            with self.assertRaises(e.__class__) as raised:
+                session.evaluate()
+            self.assertEqual(str(e), str(raised.exception))
+        else:
+            result = session.evaluate()
+            self.assertEqual(expected, result)
+            self.assertIs(type(expected), type(result))
+
+    def test_edits(self):
+        session = calc.EditSession('2*(3+4)')
+        self.assertEqual(14, session.evaluate())
+        for offset, deleted, inserted in [(5, 1, '40'), (7, 1, ''), (0, 0, '-'), (3, 0, '1.5+'), (8, 0, ' '),
+                                          (1, 1, '2 2'), (0, 3, ''), (0, 0, '2^'), (2, 0, '('), (2, 1, '4'),
+                                          (15, 0, ')/2')]:
+            session.edit(offset, deleted, inserted)
+            self.assertSameAsCompile(session)
+        self.assertEqual('2^42*1.5+( 3+40)/2', session.text)
+        self.assertEqual(calc.calc('2^42*1.5+( 3+40)/2'), session.evaluate())
+
+    def test_tokens(self):
+        session = calc.EditSession('12 + 3')
+        for offset, deleted, inserted in [(2, 1, ''), (2, 2, ''), (1, 0, '.'), (0, 0, 'x'), (1, 0, ' '), (2, 0, "'"),
+                                          (0, 3, '$'), (0, 1, '')]:
+            session.edit(offset, deleted, inserted)
+            self.assertEqual(calc._scan_range(session.text, 0, len(session.text)),
+                             (session._tokens, session._starts, session._ends))
+            self.assertSameAsCompile(session)
+
+    def test_reuse(self):
+        session = calc.EditSession('+'.join('(%d*x-%d/(x+%d))' % (i, i, i) for i in range(1000)), {'x': 3})
+        session.evaluate()
+        before = session.stats()
+        session.edit(len(session.text), 0, '+1')
+        self.assertEqual(calc.calc(session.text, variables={'x': 3}), session.evaluate())
+        edits, scanned, reused, parsed, evaluated = [b - a for a, b in zip(before, session.stats())]
+        self.assertEqual(1, edits)
+        self.assertLess(scanned, 4)
+        self.assertLess(parsed, 5)
+        self.assertLess(evaluated, 5)
+
+    def test_variables(self):
+        session = calc.EditSession('x*(y+1)', {'x': 2, 'y': 3})
+        self.assertEqual(8, session.evaluate())
+        session.variables = {'x': 2, 'y': 0.5}
+        self.assertEqual(3.0, session.evaluate())
+        session.variables = {'x': 2}
+        with self.assertRaises(calc.UndefinedVariableError):
+            session.evaluate()
+
+    def test_set_variable(self):
+        variables = {'x': 1}
+        session = calc.EditSession('x+1', variables)
+        self.assertEqual(2, session.evaluate())
+        variables['x'] = 10
+        session.variables['x'] = 10
+        self.assertEqual(2, session.evaluate())  # copies are not watched
+        session.set_variable('x', 10)
+        self.assertEqual(11, session.evaluate())
+
+    def test_errors(self):
+        session = calc.EditSession('1/0')
+        with self.assertRaises(ZeroDivisionError):
+            session.evaluate()
+        session.edit(2, 1, '(')
+        self.assertSameAsCompile(session)
+        session.edit(3, 0, '2)')
+        self.assertEqual(0.5, session.evaluate())
+        with self.assertRaises(ValueError):
+            session.edit(4, 2, '')
+
+
+class CodegenTest(unittest.TestCase):
+    def test_same_as_calc(self):
+        for expr in ['1', '-1.5', '2*3-1', '-3*-3', '9/(-3)', '(7-4)/2', '2^2^3', '2^-1', '-1-1',
+                     '5*(2+4)-2*-2^5+1/8*8-2']:
+            self.assertEqual(calc.calc(expr), calc.compile(expr, calc.CodegenEvaluator).evaluate())
+            self.assertEqual(calc.calc(expr), calc.calc(expr, calc.CodegenEvaluator))
+
+    def test_variables(self):
+        compiled = calc.compile('x*y+x', calc.CodegenEvaluator)
+        self.assertIsInstance(compiled, calc.GeneratedExpression)
+        self.assertEqual(8, compiled.evaluate({'x': 2, 'y': 3}))
+        with self.assertRaises(calc.UndefinedVariableError):
+            compiled.evaluate({'x': 2})
+
+    def test_literals(self):
+        optimized, _ = calc.optimize(calc.compile('-2^2 * inf + x', calc.CodegenEvaluator))
+        self.assertEqual(float('-inf'), optimized.evaluate({'x': 1}))
+        self.assertEqual(-4, calc.generate_function(calc.Leaf(-4))(None))
+
+    def test_deep_nesting(self):
+        self.assertEqual(5001, calc.calc('(' * 5000 + '1' + '+1)' * 5000, calc.CodegenEvaluator))
+
+    def test_operator_without_template(self):
+        class Modulo(calc.OperatorBase):
+            def __init__(self):
+                super(Modulo, self).__init__('%', 5)
+
+            def do_eval(self, *args):
+                return args[0] % args[1]
+
+        tree = calc.Node(Modulo(), (calc.Leaf(7), calc.Variable('x')))
+        self.assertEqual(1, calc.generate_function(tree)({'x': 3}))
+
+    def test_inherited_template(self):
+        class SaturatedPlus(calc.Plus):
+            def do_eval(self, *args):
+                return min(args[0] + args[1], 10)
+
+        tree = calc.Node(SaturatedPlus(), (calc.Leaf(7), calc.Variable('x')))
+        self.assertEqual(10, calc.generate_function(tree)({'x': 5}))
+
+    def test_errors_order(self):
+        for algo in sorted(calc.EVALUATORS):
+            with self.assertRaises(ZeroDivisionError):
+                calc.calc('3/0-ey31^5', calc.EVALUATORS[algo])
+            with self.assertRaises(calc.UndefinedVariableError):
+                calc.calc('x/0', calc.EVALUATORS[algo])
+
+
+class ParseCacheTest(unittest.TestCase):
+    def test_hits_misses(self):
+        cache = calc.ParseCache(maxsize=10)
+        self.assertEqual(4, calc.calc('2+2', cache=cache))
+        self.assertEqual(4, calc.calc('2+2', cache=cache))
+        self.assertEqual(4, calc.calc('2+2', calc.ShuntingYardEvaluator, cache=cache))
+        self.assertEqual(calc.CacheInfo(1, 2, 0, 10, 2), cache.info())
+
+    def test_lru_eviction(self):
+        cache = calc.ParseCache(maxsize=2)
+        cache.get('1')
+        cache.get('2')
+        cache.get('1')
+        cache.get('3')  # evicts '2', the least recently used
+        self.assertEqual(1, cache.info().evictions)
+        cache.get('1')
+        self.assertEqual(2, cache.info().hits)
+        cache.get('2')
+        self.assertEqual(4, cache.info().misses)
+
+    def test_clear(self):
+        cache = calc.ParseCache()
+        cache.get('1+1')
+        cache.clear()
+        self.assertEqual(0, len(cache))
+        self.assertEqual(calc.CacheInfo(0, 0, 0, 1024, 0), cache.info())
+
+    def test_errors_not_cached(self):
+        cache = calc.ParseCache()
+        with self.assertRaises(calc.InvalidTokenError):
+            calc.calc('1+$', cache=cache)
+        self.assertEqual(0, len(cache))
+
+    def test_limits_on_hit(self):
+        cache = calc.ParseCache()
+        self.assertEqual(5, calc.calc('1+1+1+1+1', cache=cache))
+        with self.assertRaises(calc.LimitExceededError):
+            calc.calc('1+1+1+1+1', cache=cache, limits=calc.Limits(max_tokens=3))
+        with self.assertRaises(calc.LimitExceededError):
+            calc.calc('-(-(1))', cache=cache, limits=calc.Limits(max_depth=2))
+        self.assertEqual(1, calc.calc('-(-(1))', cache=cache))
+
+
+class DiskCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_shared(self):
+        for algo in sorted(calc.EVALUATORS):
+            evaluator_class = calc.EVALUATORS[algo]
+            self.assertEqual(7.5, calc.DiskCache(self.path).get('2*x+1.5^2-(3/4)', evaluator_class).evaluate({'x': 3}))
+            cache = calc.DiskCache(self.path)
+            compiled = cache.get('2*x+1.5^2-(3/4)', evaluator_class)
+            self.assertIsInstance(compiled, evaluator_class.compiled_class or calc.CompiledExpression)
+            self.assertEqual(7.5, compiled.evaluate({'x': 3}))
+            self.assertEqual(1, cache.info().hits)
+
+    def test_backing(self):
+        cache = calc.ParseCache(backing=calc.DiskCache(self.path))
+        self.assertEqual(4, calc.calc('2+2', cache=cache))
+        cache = calc.ParseCache(backing=calc.DiskCache(self.path))
+        self.assertEqual(4, calc.calc('2+2', cache=cache))
+        self.assertEqual(1, cache.backing.info().hits)
+        with self.assertRaises(calc.MalformedExpressionError):
+            cache.get('2*(3')
+        with self.assertRaises(calc.LimitExceededError):
+            calc.calc('2+2', cache=calc.ParseCache(backing=calc.DiskCache(self.path)), limits=calc.Limits(max_tokens=2))
+
+    def test_version(self):
+        calc.DiskCache(self.path).get('2+2')
+        version, calc.__version__ = calc.__version__, 'next'
+        try:
+            cache = calc.DiskCache(self.path)
+            cache.get('2+2')
+            self.assertEqual(0, cache.info().hits)
+            cache._evict()
+            self.assertEqual(1, len(os.listdir(cache.path)))
+        finally:
+            calc.__version__ = version
+        self.assertEqual(0, len(os.listdir(calc.DiskCache(self.path).path)))  # removed by the eviction of 'next'
+
+    def test_eviction(self):
+        cache = calc.DiskCache(self.path, maxbytes=1000)
+        for i in range(100):
+            cache.get('%d*x+%d' % (i, i))
+        self.assertLessEqual(cache.info().currsize, 1000)
+        self.assertGreater(cache.info().evictions, 0)
+        self.assertEqual(cache.info().currsize, sum(os.path.getsize(os.path.join(cache.path, name))
+                                                    for name in os.listdir(cache.path)))
+        cache.clear()
+        self.assertEqual([], os.listdir(cache.path))
+
+    def test_corrupted(self):
+        cache = calc.DiskCache(self.path)
+        cache.get('1+1')
+        for name in os.listdir(cache.path):
+            with open(os.path.join(cache.path, name), 'wb') as f:
+                f.write(b'calc\x01garbage')
+        self.assertEqual(2, cache.get('1+1').evaluate())
+        self.assertEqual(2, cache.get('1+1').evaluate())
+        self.assertEqual(1, cache.info().hits)
+
+    def test_registered_operator(self):
+        calc.register_operator(FloorDivide())
+        try:
+            calc.DiskCache(self.path).get('7//2+1')
+        finally:
+            calc.unregister_operator('//')
+        self.assertRaises(calc.MalformedExpressionError, calc.DiskCache(self.path).get, '7//2+1')
+        calc.register_operator(Modulo())
+        calc.register_operator(FloorDivide())  # new opcode
+        try:
+            cache = calc.DiskCache(self.path)
+            self.assertEqual(4, cache.get('7//2+1').evaluate())
+            self.assertEqual(1, cache.info().hits)
+        finally:
+            calc.unregister_operator('//')
+            calc.unregister_operator('%')
+
+
+class MetricsTest(unittest.TestCase):
+    """
+    Unit tests for calc() metrics
+    """
+
+    def setUp(self):
+        self.metrics = calc.enable_metrics()
+
+    def tearDown(self):
+        calc.disable_metrics()
+
+    def test_disabled(self):
+        self.assertIs(self.metrics, calc.disable_metrics())
+        self.assertIsNone(calc.get_metrics())
+        calc.calc('1+1')
+        self.assertEqual(0, self.metrics.snapshot()['calls'])
+
+    def test_counters(self):
+        calc.calc('-1-(-2)^2')
+        self.assertRaises(calc.MalformedExpressionError, calc.calc, '2*(3')
+        self.assertRaises(calc.InvalidTokenError, calc.calc, '1+$')
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(3, snapshot['calls'])
+        self.assertEqual(13, snapshot['tokens'])
+        self.assertEqual({'UnaryMinus': 2, 'Minus': 1, 'Pow': 1}, snapshot['operators'])
+        self.assertEqual({'MalformedExpressionError': 1, 'InvalidTokenError': 1}, snapshot['errors'])
+        self.assertEqual({'scan', 'evaluate'}, set(snapshot['phases']))
+        self.metrics.reset()
+        self.assertEqual(0, self.metrics.snapshot()['calls'])
+
+    def test_cache(self):
+        cache = calc.ParseCache()
+        for _ in range(2):
+            calc.calc('x*2+1', cache=cache, variables={'x': 1})
+        snapshot = self.metrics.snapshot()
+        self.assertEqual({'Multiply': 2, 'Plus': 2}, snapshot['operators'])
+        self.assertEqual({'cache', 'evaluate'}, set(snapshot['phases']))
+
+    def test_prometheus(self):
+        calc.calc('1+1')
+        text = self.metrics.to_prometheus()
+        self.assertIn('# TYPE calc_calls_total counter\ncalc_calls_total 1\n', text)
+        self.assertIn('calc_operator_evaluations_total{operator="Plus"} 1\n', text)
+
+
+class BatchTest(unittest.TestCase):
+    def test_evaluate_lines(self):
+        results = list(calc.evaluate_lines(['1+1\n', '2*(3\n', '5/2', '1/0']))
+        self.assertEqual(2, results[0])
+        self.assertIsInstance(results[1], calc.MalformedExpressionError)
+        self.assertEqual(2.5, results[2])
+        self.assertIsInstance(results[3], ZeroDivisionError)
+
+    def test_lazy(self):
+        results = calc.evaluate_lines(iter(['1', '$']))
+        self.assertEqual(1, next(results))
+        self.assertIsInstance(next(results), calc.InvalidTokenError)
+
+    def test_format_result(self):
+        self.assertEqual('2.5', calc.format_result(2.5))
+        self.assertEqual('error: InvalidTokenError: $', calc.format_result(calc.InvalidTokenError('$')))
+
+    def test_huge_int_line(self):
+        results = [calc.format_result(result) for result in calc.evaluate_lines(['9^9999', '1+1'])]
+        if sys.version_info >= (3, 11):  # ints of more than 4300 digits are not converted to strings
+            self.assertTrue(results[0].startswith('error: ValueError: '))
+        else:
+            self.assertEqual(str(9 ** 9999), results[0])
+        self.assertEqual('2', results[1])
+
+
+class TemplatesTest(unittest.TestCase):
+    def setUp(self):
+        self.expressions = ['%d*(%d+x)-%s/2' % (i, i % 7, i / 4) for i in range(50)]
+        self.expected = [calc.calc(expr, variables={'x': 3}) for expr in self.expressions]
+
+    def test_template(self):
+        key, literals = calc.template('2*(x+1.5) - 3')
+        self.assertEqual([2, 1.5, 3], literals)
+        self.assertEqual(key, calc.template('7*(x+0.25) - 1')[0])
+        self.assertNotEqual(key, calc.template('7*(x+1) - 1')[0])  # int instead of float
+        self.assertNotEqual(key, calc.template('7*(y+0.25) - 1')[0])
+        self.assertEqual([], calc.template('x1+inf')[1])
+
+    def test_same_results(self):
+        for algo in sorted(calc.EVALUATORS):
+            results = calc.evaluate_templates(self.expressions, calc.EVALUATORS[algo], {'x': 3})
+            self.assertEqual(self.expected, results)
+            self.assertEqual([type(value) for value in self.expected], [type(value) for value in results])
+
+    def test_without_numpy(self):
+        numpy, calc.numpy = calc.numpy, None
+        try:
+            self.assertEqual(self.expected, calc.evaluate_templates(self.expressions, variables={'x': 3}))
+        finally:
+            calc.numpy = numpy
+
+    def test_errors(self):
+        expressions = ['%d/%d' % (i, i % 10) for i in range(20)] + ['2*(3', '2*(4', '$1']
+        results = calc.evaluate_templates(expressions)
+        self.assertIsInstance(results[0], ZeroDivisionError)
+        self.assertIsInstance(results[10], ZeroDivisionError)
+        self.assertEqual(19.0 / 9, results[19])
+        self.assertIsInstance(results[20], calc.MalformedExpressionError)
+        self.assertIsInstance(results[22], calc.InvalidTokenError)
+        self.assertIsInstance(calc.evaluate_templates(['x+%d' % i for i in range(10)])[0], calc.UndefinedVariableError)
+
+    def test_int_overflow(self):
+        expressions = ['%d*%d' % (2 ** 40, i) for i in range(2 ** 22, 2 ** 22 + 20)] + ['9^%d' % i for i in range(20)]
+        self.assertEqual([calc.calc(expr) for expr in expressions], calc.evaluate_templates(expressions))
+
+    def test_limits(self):
+        results = calc.evaluate_templates(['2^%d' % (i * 100) for i in range(10)], limits=calc.Limits(max_int_bits=500))
+        self.assertEqual(2 ** 400, results[4])
+        self.assertIsInstance(results[5], calc.LimitExceededError)
+
+
+class EvaluateFileTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write(''.join('%d*(%d+1)\n' % (i, i) if i % 7 else '%d/0\n' % i for i in range(500)))
+        with open(self.path) as f:
+            self.expected = ''.join(calc.format_result(result) + '\n' for result in calc.evaluate_lines(f))
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def evaluate(self, **kwargs):
+        output = io.BytesIO()
+        stats = calc.evaluate_file(self.path, output, **kwargs)
+        return output.getvalue().decode('utf-8'), stats
+
+    def test_ranges(self):
+        for range_bytes in (1, 100, 1 << 20):
+            output, stats = self.evaluate(workers=1, range_bytes=range_bytes)
+            self.assertEqual(self.expected, output)
+            self.assertEqual(500, stats.lines)
+            self.assertEqual(os.path.getsize(self.path), stats.bytes)
+
+    def test_pool(self):
+        progress = []
+        output, stats = self.evaluate(workers=2, range_bytes=256, progress=progress.append)
+        self.assertEqual(self.expected, output)
+        self.assertEqual(stats.lines, progress[-1].lines)
+        self.assertEqual(sorted(progress), progress)
+
+    def test_empty(self):
+        open(self.path, 'w').close()
+        self.assertEqual(('', 0), (self.evaluate()[0], self.evaluate()[1].lines))
+
+
+@unittest.skipIf(calc.numpy is None, "NumPy is not installed")
+class ColumnarTest(unittest.TestCase):
+    def setUp(self):
+        numpy = calc.numpy
+        self.columns = {'x': numpy.arange(-10, 10), 'y': numpy.linspace(0, 2, 20, dtype=numpy.float32)}
+        self.rows = [{'x': x, 'y': y} for x, y in zip(self.columns['x'].tolist(), self.columns['y'].tolist())]
+        fd, self.path = tempfile.mkstemp(suffix='.npy')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_records(self):
+        results = [3, 2.5, 2 ** 70, calc.InvalidTokenError('$'), -2 ** 63, 1j]
+        records = calc.results_records(results)
+        self.assertEqual([0, 1, 3, 2, 0, 3], records['kind'].tolist())
+        self.assertEqual([3, 0, 0, 0, -2 ** 63, 0], records['int'].tolist())
+        self.assertEqual(2.5, records['float'][1])
+
+    def test_writer(self):
+        with open(self.path, 'wb') as f:
+            calc.write_results(iter([1, 0.5, ZeroDivisionError()] * 1000), f, npy=True)
+        records = calc.numpy.load(self.path, mmap_mode='r')
+        self.assertIsInstance(records, calc.numpy.memmap)
+        self.assertEqual(3000, len(records))
+        self.assertEqual((1, 1, 0.5), (records['int'][0], records['kind'][1], records['float'][1]))
+
+    def test_evaluate_rows(self):
+        for expr in ('x*2+y', 'x^2-x/y', '2^x', 'x*1000000000000', '2+3', 'x+z'):
+            expected = []
+            for row in self.rows:
+                try:
+                    expected.append(calc.calc(expr, variables=row))
+                except calc.CALC_ERRORS as e:
+                    expected.append(e)
+            results = calc.evaluate_rows(expr, self.columns)
+            self.assertEqual([type(value) for value in expected], [type(value) for value in results])
+            self.assertEqual([value for value in expected if not isinstance(value, Exception)],
+                             [value for value in results if not isinstance(value, Exception)])
+        self.assertIsInstance(calc.evaluate_rows('2^x', self.columns, limits=calc.Limits(max_int_bits=4))[-1],
+                              calc.LimitExceededError)
+        with self.assertRaises(calc.MalformedExpressionError):
+            calc.evaluate_rows('x*(y', self.columns)
+
+    def test_int64_bounds(self):
+        numpy = calc.numpy
+        columns = {'x': numpy.array([-2 ** 63, 0] * 8, dtype=numpy.int64)}
+        self.assertEqual([2 ** 63, 0] * 8, calc.evaluate_rows('-x', columns))
+        self.assertEqual([-2 ** 63, 0] * 8, calc.evaluate_rows('x', columns))
+        self.assertEqual([2 ** 63 - 1, -1] * 8, calc.evaluate_rows('-x-1', columns))
+
+    def test_read_columns(self):
+        records = calc.numpy.zeros(4, [('x', 'i8'), ('y', 'f8')])
+        records['x'] = range(4)
+        calc.numpy.save(self.path, records)
+        self.assertEqual([0, 2, 4, 6], calc.evaluate_rows('x*2', calc.read_columns(self.path)))
+        calc.numpy.save(self.path, calc.numpy.arange(4))
+        with self.assertRaises(ValueError):
+            calc.read_columns(self.path)
+        path = self.path[:-4] + '.npz'
+        try:
+            calc.numpy.savez(path, **self.columns)
+            self.assertEqual(['x', 'y'], sorted(calc.read_columns(path)))
+        finally:
+            os.remove(path)
+
+    def test_evaluate_file(self):
+        with open(self.path, 'w') as f:
+            f.write('1+1\n2*(3\n7/2\n')
+        with io.BytesIO() as output:
+            calc.evaluate_file(self.path, output, workers=1, npy=True)
+            records = calc.numpy.frombuffer(output.getvalue()[128:], calc.RESULTS_DTYPE)
+        self.assertEqual([0, 2, 1], records['kind'].tolist())
+
+
+class CalcManyTest(unittest.TestCase):
+    def test_pool(self):
+        expressions = ['1+%d' % i for i in range(100)] + ['$', '2*(3', '1/0', '2^0.5']
+        results = list(calc.calc_many(expressions, calc.ShuntingYardEvaluator, workers=2, chunksize=8))
+        self.assertEqual(list(range(1, 101)), results[:100])
+        self.assertIsInstance(results[100], calc.InvalidTokenError)
+        self.assertIsInstance(results[101], calc.MalformedExpressionError)
+        self.assertIsInstance(results[102], ZeroDivisionError)
+        self.assertEqual(2 ** 0.5, results[103])
+
+    def test_in_process(self):
+        self.assertEqual([4, 9], list(calc.calc_many(['2+2', '3*3'], workers=1)))
+
+
+class CalcParallelTest(unittest.TestCase):
+    def assertSameAsCalc(self, expr, **kwargs):
+        try:
+            expected = calc.calc(expr, variables=kwargs.get('variables'), limits=kwargs.get('limits'))
+        except calc.CALC_ERRORS as e:
+            with self.assertRaises(e.__class__):
+                calc.calc_parallel(expr, workers=2, min_operands=2, chunk_operands=3, **kwargs)
+        else:
+            result = calc.calc_parallel(expr, workers=2, min_operands=2, chunk_operands=3, **kwargs)
+            self.assertEqual(expected, result)
+            self.assertIs(type(expected), type(result))
+
+    def test_chain(self):
+        operators, operands = calc._chain(calc.compile('1-2+3').tree)
+        self.assertEqual([None, calc.BINARY_OPS['-'], calc.BINARY_OPS['+']], operators)
+        self.assertEqual([calc.Leaf(1), calc.Leaf(2), calc.Leaf(3)], operands)
+        self.assertEqual(2, len(calc._chain(calc.compile('1*2/3*4').tree)[1]))
+        self.assertIsNone(calc._chain(calc.compile('1/2/3').tree))
+
+    def test_same_as_calc(self):
+        self.assertSameAsCalc('+'.join(str(i) for i in range(100)))
+        self.assertSameAsCalc('-'.join(str(i) for i in range(100)))
+        self.assertSameAsCalc('*'.join(str(i) for i in range(1, 100)))
+        self.assertSameAsCalc('1+2*3-0.1+2^70-0.7-0.2+x*2', variables={'x': 3})
+        self.assertSameAsCalc('1*2*0.1*3*2^70*0.3*0.7*x', variables={'x': 3})
+        self.assertSameAsCalc('1e308+1e308+1-1e308+2+3')
+
+    def test_errors(self):
+        self.assertSameAsCalc('1+2+3+1/0+5+x')
+        self.assertSameAsCalc('1+2+3+4+5+x')
+        self.assertSameAsCalc('0*2^40*2^40*2^40*2^40', limits=calc.Limits(max_int_bits=100))
+        self.assertSameAsCalc('2^40*2^40*2^40*0*5*7', limits=calc.Limits(max_int_bits=100))
+
+    def test_short(self):
+        self.assertEqual(7, calc.calc_parallel('1+2*3', workers=2))
+
+
 class MainTest(unittest.TestCase):
+    def run_main(self, *argv):
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            calc.main(list(argv))
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_main(self):
+        self.assertEqual('11.2\n', self.run_main('5.6 * 2'))
+        self.assertEqual('-2\n', self.run_main('--algo', 'ish', '--', '-1-1'))
+
+    def test_main_file(self):
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('1+1\n2*(3\n1+1\n')
+            self.assertEqual('2\nerror: MalformedExpressionError: Expected ), got None\n2\n',
+                             self.run_main('--file', path, '-a', 'cg'))
+            self.assertEqual('2\nerror: MalformedExpressionError: Expected ), got None\n2\n',
+                             self.run_main('--file', path, '--jobs', '2'))
+        finally:
+            os.remove(path)
+
+    def test_main_output(self):
+        fd, path = tempfile.mkstemp()
+        output = path + '.out'
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('1+1\n2*(3\n\n2^10\n7/2')
+            for jobs in ('1', '2'):
+                self.assertEqual('', self.run_main('--file', path, '--output', output, '--jobs', jobs))
+                with open(output) as f:
+                    self.assertEqual('2\nerror: MalformedExpressionError: Expected ), got None\n'
+                                     'error: MalformedExpressionError: None\n1024\n3.5\n', f.read())
+        finally:
+            os.remove(path)
+            if os.path.exists(output):
+                os.remove(output)
+
+    @unittest.skipIf(calc.numpy is None, "NumPy is not installed")
+    def test_main_columns(self):
+        fd, path = tempfile.mkstemp(suffix='.npz')
+        os.close(fd)
+        output = path + '.npy'
+        try:
+            calc.numpy.savez(path, x=calc.numpy.arange(3))
+            self.assertEqual('error: ZeroDivisionError: 0.0 cannot be raised to a negative power\n1.0\n0.5\n',
+                             self.run_main('x^-1', '--columns', path))
+            self.assertEqual('', self.run_main('x+1', '--columns', path, '--output', output, '--npy'))
+            self.assertEqual([1, 2, 3], calc.numpy.load(output)['int'].tolist())
+        finally:
+            os.remove(path)
+            if os.path.exists(output):
+                os.remove(output)
+
+    def test_main_stream(self):
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('1+2*3\n-(4')
+            with self.assertRaises(calc.MalformedExpressionError):
+                self.run_main('--file', path, '--stream', '-a', 'ipc')
+            with open(path, 'a') as f:
+                f.write(')\n')
+            self.assertEqual('3\n', self.run_main('--file', path, '--stream', '-a', 'ipc'))
+        finally:
+            os.remove(path)
+
+    def test_main_parallel(self):
+        self.assertEqual('4950\n', self.run_main('--jobs', '2', '+'.join(str(i) for i in range(100))))
+
+    def test_main_templates(self):
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('1+1\n2*(3\n1+2\n')
+            self.assertEqual('2\nerror: MalformedExpressionError: Expected ), got None\n3\n',
+                             self.run_main('--file', path, '--templates'))
+        finally:
+            os.remove(path)
+
+    def test_main_check(self):
+        self.assertEqual('ok\n', self.run_main('--check', '2+2'))
+        self.assertEqual("error: 2: unbalanced parenthesis: '(' is never closed\n", self.run_main('--check', '2*(3'))
+
+    def test_main_stats(self):
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            self.assertEqual('4\n', self.run_main('--stats', '2+2'))
+            self.assertIn('operators: Plus 1', sys.stderr.getvalue())
+            with self.assertRaises(SystemExit):  # would count nothing
+                self.run_main('--stats', '--check', '2+2')
+        finally:
+            sys.stderr = stderr
+        self.assertIsNone(calc.get_metrics())
+
     def test_calc_sye(self):
         self.assertEqual(4, calc.calc('2+2', calc.ShuntingYardEvaluator))
 
@@ -210,5 +1369,80 @@ class MainTest(unittest.TestCase):
         self.assertEqual(-2, calc.calc('-1-1', calc.ShuntingYardEvaluator))
 
 
+@unittest.skipIf(server is None, "The server requires Python 3.5+")
+class ServerTest(unittest.TestCase):
+    """
+    Unit tests for server.py, with a server evaluating in its event loop, run by a thread
+    """
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.server = server.CalcServer(workers=0, pipeline=4)
+        listening = self.loop.run_until_complete(self.server.start('127.0.0.1', 0))
+        self.port = listening.sockets[0].getsockname()[1]
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        asyncio.run_coroutine_threadsafe(self.server.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def request(self, *lines):
+        connection = socket.create_connection(('127.0.0.1', self.port))
+        try:
+            connection.sendall(b''.join(line.encode('utf-8') + b'\n' for line in lines))
+            responses = connection.makefile('rb')
+            return [json.loads(responses.readline().decode('utf-8')) for _ in lines]
+        finally:
+            connection.close()
+
+    def test_handle_line(self):
+        self.assertEqual(b'{"id": 1, "result": 7}\n',
+                         server.handle_line(b'{"id": 1, "expression": "2*x+1", "variables": {"x": 3}}'))
+        self.assertEqual({'id': None, 'error': {'type': 'BadRequest', 'message': "expression must be a string"}},
+                         json.loads(server.handle_line(b'{}').decode('utf-8')))
+
+    def test_errors(self):
+        responses = self.request('{"id": 1, "expression": "2*(3"}', 'not json', '{"id": 3, "expression": "1/0"}',
+                                 '{"id": 4, "expression": "1", "evaluator": "xx"}')
+        self.assertEqual({'id': 1, 'error': {'type': 'MalformedExpressionError', 'message': "Expected ), got None"}},
+                         responses[0])
+        self.assertEqual([None, 'BadRequest'], [responses[1]['id'], responses[1]['error']['type']])
+        self.assertEqual('ZeroDivisionError', responses[2]['error']['type'])
+        self.assertEqual('BadRequest', responses[3]['error']['type'])
+
+    def test_bad_variables(self):
+        responses = self.request('{"id": 1, "expression": "x*2", "variables": {"x": "ab"}}',
+                                 '{"id": 2, "expression": "x+1", "variables": {"x": null}}',
+                                 '{"id": 3, "expression": "x+1", "variables": {"x": true}}',
+                                 '{"id": 4, "expression": "x+1", "variables": {"x": 1.5}}')
+        self.assertEqual(['BadRequest'] * 3, [response['error']['type'] for response in responses[:3]])
+        self.assertEqual({'id': 4, 'result': 2.5}, responses[3])
+
+    def test_unencodable_results(self):
+        responses = self.request('{"id": 1, "expression": "9^9999"}', '{"id": 2, "expression": "x*2", '
+                                 '"variables": {"x": 1e308}}', '{"id": 3, "expression": "1+1"}')
+        if sys.version_info >= (3, 11):  # ints of more than 4300 digits are not converted to strings
+            self.assertEqual('ValueError', responses[0]['error']['type'])
+        self.assertEqual('ValueError', responses[1]['error']['type'])
+        self.assertEqual({'id': 3, 'result': 2}, responses[2])
+
+    def test_pipelining(self):
+        # more requests than the pipeline bound, answered in order
+        lines = ['{"id": %d, "expression": "%d*2", "evaluator": "%s"}' % (i, i, algo)
+                 for i, algo in enumerate(sorted(calc.EVALUATORS) * 4)]
+        self.assertEqual([{'id': i, 'result': i * 2} for i in range(len(lines))], self.request(*lines))
+
+    def test_load(self):
+        connect = lambda: asyncio.open_connection('127.0.0.1', self.port)
+        stats = asyncio.run_coroutine_threadsafe(server.load(connect, '1+x', connections=3, requests=100),
+                                                 self.loop).result()
+        self.assertEqual(100, stats['requests'])
+        self.assertEqual(100, stats['errors'])  # x is undefined
+        self.assertLessEqual(stats['p50_ms'], stats['p99_ms'])
+
+
 if __name__ == "__main__":
     unittest.main()